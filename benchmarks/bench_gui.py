@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from snub.gui.main import ProjectTab
+from snub.gui.tracks import Heatmap
+from snub.gui.utils import evict
+
+
+@pytest.fixture
+def project_tab(qt_app, synthetic_project):
+    tab = ProjectTab(synthetic_project)
+    tab.resize(1600, 1000)
+    tab.show()
+    tab.finish_loading()
+    qt_app.processEvents()
+    yield tab
+    tab.close()
+    tab.deleteLater()
+    qt_app.processEvents()
+
+
+def bench_project_tab_construction(benchmark, qt_app, synthetic_project):
+    """Time loading a project and showing it for the first time"""
+
+    def construct():
+        evict()
+        tab = ProjectTab(synthetic_project)
+        tab.show()
+        tab.finish_loading()
+        qt_app.processEvents()
+        return tab
+
+    tabs = []
+    benchmark.pedantic(lambda: tabs.append(construct()), rounds=3)
+    for tab in tabs:
+        tab.close()
+
+
+def bench_project_tab_responsive(benchmark, qt_app, synthetic_project):
+    """Time until a project is shown (with data still loading in the background)"""
+
+    def construct():
+        evict()
+        tab = ProjectTab(synthetic_project)
+        tab.show()
+        qt_app.processEvents()
+        return tab
+
+    tabs = []
+    benchmark.pedantic(lambda: tabs.append(construct()), rounds=3)
+    for tab in tabs:
+        tab.finish_loading()
+        tab.close()
+
+
+def bench_playback_tick(benchmark, qt_app, project_tab):
+    """Time advancing the current time by one animation step and repainting"""
+
+    def tick():
+        project_tab.increment_current_time()
+        qt_app.processEvents()
+
+    benchmark(tick)
+
+
+def bench_zoom_step(benchmark, qt_app, project_tab):
+    """Time one zoom step of the track stack, alternating in and out"""
+    start, end = project_tab.bounds
+    ranges = [(start, start + (end - start) / 2), (start, start + (end - start) / 4)]
+    steps = iter(range(10**9))
+
+    def zoom():
+        project_tab.trackStack.update_current_range(ranges[next(steps) % 2])
+        qt_app.processEvents()
+
+    benchmark(zoom)
+
+
+def bench_selection_update(benchmark, qt_app, project_tab):
+    """Time selecting and deselecting a random interval"""
+    start, end = project_tab.bounds
+    rng = np.random.default_rng(0)
+
+    def select():
+        s = rng.uniform(start, end)
+        e = s + rng.uniform(0, (end - start) / 20)
+        project_tab.update_selected_intervals(np.array([[s, e]]), True)
+        qt_app.processEvents()
+        project_tab.update_selected_intervals(np.array([[s, e]]), False)
+        qt_app.processEvents()
+
+    benchmark(select)
+
+
+def bench_heatmap_reorder(benchmark, qt_app, project_tab):
+    """Time reordering heatmap rows by the current selection"""
+    start, end = project_tab.bounds
+    project_tab.update_selected_intervals(np.array([[start, (start + end) / 2]]), True)
+    heatmaps = [
+        t for t in project_tab.trackStack.tracks_flat() if isinstance(t, Heatmap)
+    ]
+
+    def reorder():
+        for heatmap in heatmaps:
+            heatmap.reorder_by_selection()
+        qt_app.processEvents()
+        for heatmap in heatmaps:
+            heatmap.restore_original_order()
+        qt_app.processEvents()
+
+    benchmark(reorder)
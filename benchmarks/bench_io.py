@@ -0,0 +1,13 @@
+import os
+from conftest import make_synthetic_project
+
+
+def bench_create_project(benchmark, tmp_path, project_size):
+    """Time writing a complete synthetic project with snub.io.project"""
+    counter = iter(range(10**6))
+
+    def setup():
+        project_directory = os.path.join(tmp_path, "project{}".format(next(counter)))
+        return (project_directory,), project_size
+
+    benchmark.pedantic(make_synthetic_project, setup=setup, rounds=3)
@@ -0,0 +1,120 @@
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+import imageio
+import pytest
+import snub.io.project
+from PyQt5.QtWidgets import QApplication
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("snub", "synthetic project size")
+    group.addoption("--rows", type=int, default=200, help="heatmap rows")
+    group.addoption("--duration", type=float, default=600, help="seconds")
+    group.addoption("--points", type=int, default=20000, help="scatter points")
+    group.addoption("--spikes", type=int, default=200000, help="spike count")
+    group.addoption("--frames", type=int, default=300, help="video frames")
+
+
+def make_synthetic_project(
+    project_directory,
+    rows=200,
+    duration=600,
+    points=20000,
+    spikes=200000,
+    frames=300,
+    seed=0,
+):
+    """
+    Generate a project with a heatmap, scatter plot, spike plot, trace plot and
+    video filled with random data.
+
+    Parameters
+    ----------
+    project_directory: str
+        Project path. Will be overwritten if it already exists.
+
+    rows: int, default=200
+        Number of heatmap rows (and spike plot units)
+
+    duration: float, default=600
+        Duration of the project in seconds
+
+    points: int, default=20000
+        Number of scatter plot points (and heatmap columns)
+
+    spikes: int, default=200000
+        Total number of spikes
+
+    frames: int, default=300
+        Number of video frames (spread evenly over the project duration)
+
+    seed: int, default=0
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    snub.io.project.create_project(
+        project_directory, overwrite=True, start_time=0, end_time=duration
+    )
+    binsize = duration / points
+
+    heatmap_data = rng.normal(size=(rows, points)).cumsum(1)
+    snub.io.project.add_heatmap(
+        project_directory, "heatmap", heatmap_data, binsize=binsize, start_time=0
+    )
+
+    xy = rng.normal(size=(points, 2))
+    variables = rng.uniform(size=(points, 10))
+    snub.io.project.add_scatter(
+        project_directory,
+        "scatter",
+        xy,
+        binsize=binsize,
+        start_time=0,
+        variables=variables,
+        variable_labels=["variable {}".format(i) for i in range(10)],
+    )
+
+    spike_times = np.sort(rng.uniform(0, duration, size=spikes))
+    spike_labels = rng.integers(0, rows, size=spikes)
+    snub.io.project.add_spikeplot(
+        project_directory, "spikes", np.stack([spike_times, spike_labels], axis=1)
+    )
+
+    timestamps = np.linspace(0, duration, 10 * points)
+    trace = np.stack([timestamps, np.sin(timestamps)], axis=1)
+    snub.io.project.add_traceplot(project_directory, "trace", {"sin": trace})
+
+    video_path = os.path.join(project_directory, "synthetic.mp4")
+    with imageio.get_writer(video_path, fps=30, macro_block_size=1) as writer:
+        for i in range(frames):
+            writer.append_data(rng.integers(0, 255, (96, 128), dtype=np.uint8))
+    snub.io.project.add_video(
+        project_directory,
+        video_path,
+        name="video",
+        timestamps=np.linspace(0, duration, frames),
+    )
+    return project_directory
+
+
+@pytest.fixture(scope="session")
+def project_size(request):
+    return {
+        k: request.config.getoption(k)
+        for k in ["rows", "duration", "points", "spikes", "frames"]
+    }
+
+
+@pytest.fixture(scope="session")
+def synthetic_project(tmp_path_factory, project_size):
+    project_directory = str(tmp_path_factory.mktemp("benchmarks") / "project")
+    return make_synthetic_project(project_directory, **project_size)
+
+
+@pytest.fixture(scope="session")
+def qt_app():
+    app = QApplication.instance() or QApplication([])
+    yield app
@@ -4,9 +4,19 @@ from PyQt5.QtGui import *
 import sys, os, json
 import numpy as np
 from functools import partial
-from snub.gui.utils import IntervalIndex, CheckBox, CustomContextMenu
+from snub.gui.utils import (
+    IntervalIndex,
+    CheckBox,
+    CustomContextMenu,
+    Placeholder,
+    Profiler,
+    ProfilerWidget,
+    data_paths,
+    evict,
+)
 from snub.gui.stacks import PanelStack, TrackStack
-from snub.gui.tracks import TracePlot
+from snub.gui.tracks import TracePlot, TrackGroup
+from snub.gui.panels import Panel
 from snub.gui.help import HelpMenu
 
 WIDGET_NAMES = [
@@ -55,6 +65,7 @@ class ProjectTab(QWidget):
     """
 
     new_current_position = pyqtSignal(int)
+    widget_hydrated = pyqtSignal(object)
 
     def __init__(self, project_directory):
         super().__init__()
@@ -65,6 +76,15 @@ class ProjectTab(QWidget):
         config_path = os.path.join(self.project_directory, "config.json")
         config = json.load(open(config_path, "r"))
         config, error_messages = self.validate_and_autofill_config(config)
+
+        # data files that may be cached, including linked files outside the
+        # project directory (evicted when the tab is closed)
+        self.data_paths = [
+            path
+            for widget_name in WIDGET_NAMES
+            for props in config[widget_name]
+            for path in data_paths(props)
+        ]
         if len(error_messages) > 0:
             self.config_error(config_path, error_messages)
             return
@@ -100,14 +120,11 @@ class ProjectTab(QWidget):
         self.play_button.clicked.connect(self.toggle_play_state)
         self.trackStack.new_current_time.connect(self.update_current_time)
         self.trackStack.selection_change.connect(self.update_selected_intervals)
-        for panel in self.panelStack.widgets:
-            panel.new_current_time.connect(self.update_current_time)
-            panel.selection_change.connect(self.update_selected_intervals)
-        for track in self.trackStack.tracks_flat():
-            track.new_current_time.connect(self.update_current_time)
-            if isinstance(track, TracePlot):
-                if track.bound_rois is not None:
-                    track.bind_rois(self.panelStack.get_by_name(track.bound_rois))
+        self.trackStack.widget_hydrated.connect(self.connect_widget)
+        self.panelStack.widget_hydrated.connect(self.connect_widget)
+        for widget in self.panelStack.widgets + self.trackStack.widgets[1:]:
+            if not isinstance(widget, Placeholder):
+                self.connect_widget(widget, sync=False)
         self.timer.timeout.connect(self.increment_current_time)
 
         # initialize layout
@@ -115,6 +132,10 @@ class ProjectTab(QWidget):
         self.trackStack.update_current_range()
         self.update_current_time(self.current_time)
 
+        # load data for placeholder widgets in the background
+        self.panelStack.load_widgets()
+        self.trackStack.load_widgets()
+
     def initUI(self):
         self.splitter = QSplitter(Qt.Horizontal)
         self.splitter.addWidget(self.panelStack)
@@ -167,6 +188,42 @@ class ProjectTab(QWidget):
         layout.addLayout(buttons)
         self.change_layout_mode(self.layout_mode)
 
+    def connect_widget(self, widget, sync=True):
+        """Connect a track or panel to the rest of the project. When ``sync`` is
+        True (i.e. for widgets that were loaded lazily), also bring the widget up to
+        date with the current time and selection."""
+        if isinstance(widget, Panel):
+            widget.new_current_time.connect(self.update_current_time)
+            widget.selection_change.connect(self.update_selected_intervals)
+            if sync:
+                widget.update_current_time(self.current_time)
+                widget.update_selected_intervals()
+        else:
+            tracks = (
+                widget.tracks.values() if isinstance(widget, TrackGroup) else [widget]
+            )
+            for track in tracks:
+                track.new_current_time.connect(self.update_current_time)
+                if sync:
+                    track.update_current_time(self.current_time)
+        self.bind_rois()
+        if sync:
+            self.widget_hydrated.emit(widget)
+
+    def bind_rois(self):
+        for track in self.trackStack.tracks_flat():
+            if isinstance(track, TracePlot) and track.bound_rois is not None:
+                panel = self.panelStack.get_by_name(track.bound_rois)
+                if panel is None or isinstance(panel, Placeholder):
+                    continue  # the ROI plot is missing or not loaded yet
+                if not track.rois_are_bound:
+                    track.bind_rois(panel)
+
+    def finish_loading(self):
+        """Block until all widgets that have started loading are ready"""
+        self.panelStack.finish_loading()
+        self.trackStack.finish_loading()
+
     def update_track_playhead(self, checkstate):
         self.track_playhead = checkstate
         if self.track_playhead:
@@ -193,6 +250,10 @@ class ProjectTab(QWidget):
             "min_step": 1 / 30,
             "zoom_gain": 0.003,
             "min_range": 0.01,
+            "interaction_settle_time": 150,
+            "lazy_loading": True,
+            "cache_directory": ".snub_cache",
+            "cache_size_limit": 2000,
             "initial_playspeed": 1,
             "animation_fps": 30,
             "track_playhead": True,
@@ -230,6 +291,10 @@ class ProjectTab(QWidget):
                         )
 
         # resolve paths
+        if not os.path.isabs(config["cache_directory"]):
+            config["cache_directory"] = os.path.join(
+                self.project_directory, config["cache_directory"]
+            )
         for widget_name in WIDGET_NAMES:
             for widget_config in config[widget_name]:
                 for k, v in widget_config.items():
@@ -277,14 +342,15 @@ class ProjectTab(QWidget):
 
     def deselect_all(self):
         self.selected_intervals.clear()
-        self.update_selected_intervals([], [])
+        self.update_selected_intervals(np.empty((0, 2)), False)
 
     def update_selected_intervals(self, intervals, is_selected):
-        for (start, end), sel in zip(intervals, is_selected):
-            if sel:
-                self.selected_intervals.add_interval(start, end)
-            else:
-                self.selected_intervals.remove_interval(start, end)
+        """Select (or deselect if ``is_selected=False``) an ``(N,2)`` array of
+        intervals and notify the tracks and panels"""
+        if is_selected:
+            self.selected_intervals.add_intervals(intervals)
+        else:
+            self.selected_intervals.remove_intervals(intervals)
         self.trackStack.update_selected_intervals()
         self.panelStack.update_selected_intervals()
 
@@ -361,10 +427,20 @@ class MainWindow(QMainWindow):
     """
     Main window that contains menu bar and tab widget. Contains methods for
     opening, reloading, and closing project tabs.
+
+    Parameters
+    ----------
+    args: list of str
+        Project directories to open.
+
+    profile: bool, default=False
+        Start with profiling mode enabled (see :py:class:`snub.gui.utils.Profiler`).
     """
 
-    def __init__(self, args):
+    def __init__(self, args, profile=False):
         super().__init__()
+        self.profiler = None
+        self.profiler_widget = None
         self.tabs = QTabWidget()
         self.tabs.setTabBar(CustomTabBar(self.tabs))
         self.tabs.setTabsClosable(True)
@@ -401,6 +477,10 @@ class MainWindow(QMainWindow):
             partial(self.change_layout_mode, "columns")
         )
 
+        self.toggle_profiling = QAction("&Profiling", self)
+        self.toggle_profiling.setCheckable(True)
+        self.toggle_profiling.toggled.connect(self.set_profiling)
+
         mainMenu = self.menuBar()
         mainMenu.setNativeMenuBar(False)
 
@@ -417,12 +497,34 @@ class MainWindow(QMainWindow):
         layoutMenu = windowMenu.addMenu("&Layout...")
         layoutMenu.addAction(self.set_layout_to_cols)
         layoutMenu.addAction(self.set_layout_to_rows)
+        windowMenu.addAction(self.toggle_profiling)
 
         helpMenu = HelpMenu(self)
         mainMenu.addMenu(helpMenu.get_menu())
 
         # try to open projects that are passed as command line arguments
         self.open(project_directories=args)
+        self.toggle_profiling.setChecked(profile)
+
+    def set_profiling(self, enabled):
+        """Turn profiling mode on or off. When on, the latency of each track and
+        panel's hot-path methods is recorded and shown in a dockable table."""
+        if self.profiler is not None:
+            self.profiler.uninstrument()
+        if enabled:
+            if self.profiler is None:
+                self.profiler = Profiler()
+                self.profiler_widget = ProfilerWidget(self.profiler, self)
+                self.addDockWidget(Qt.BottomDockWidgetArea, self.profiler_widget)
+            for i in range(self.tabs.count()):
+                self.profiler.instrument_project(self.tabs.widget(i))
+            self.profiler_widget.show()
+        elif self.profiler_widget is not None:
+            self.profiler_widget.hide()
+
+    def instrument_widget(self, widget):
+        if self.toggle_profiling.isChecked():
+            self.profiler.instrument_project(widget)
 
     def deselect_all(self):
         self.tabs.currentWidget().deselect_all()
@@ -440,7 +542,18 @@ class MainWindow(QMainWindow):
             self.set_layout_to_rows.setChecked(current_tab.layout_mode == "rows")
 
     def close_tab(self, i):
+        tab = self.tabs.widget(i)
         self.tabs.removeTab(i)
+        # delete the tab so that its widgets release their resources (e.g. the
+        # video readers of ROI plots are closed when the plot is destroyed)
+        tab.deleteLater()
+        open_tabs = [self.tabs.widget(j) for j in range(self.tabs.count())]
+        if not any(t.project_directory == tab.project_directory for t in open_tabs):
+            evict(tab.project_directory)
+        open_paths = set(path for t in open_tabs for path in t.data_paths)
+        closed_paths = [path for path in tab.data_paths if path not in open_paths]
+        if len(closed_paths) > 0:
+            evict(*closed_paths)
 
     def open(self, *args, project_directories=None):
         if project_directories is None:
@@ -469,10 +582,14 @@ class MainWindow(QMainWindow):
         current_tab = self.tabs.currentWidget()
         project_dir = current_tab.project_directory
         self.close_tab(current_index)
+        evict(project_dir, *current_tab.data_paths)
         self.load_project(project_dir)
 
     def load_project(self, project_directory):
         project_tab = ProjectTab(project_directory)
+        project_tab.widget_hydrated.connect(self.instrument_widget)
+        if self.toggle_profiling.isChecked():
+            self.profiler.instrument_project(project_tab)
         self.tabs.addTab(project_tab, project_tab.name)
         self.tabs.setCurrentWidget(project_tab)
 
@@ -521,9 +638,8 @@ class MainWindow(QMainWindow):
                 self.deselect_all()
                 intervals = np.loadtxt(file_name, delimiter=",", skiprows=1)
                 if len(intervals) > 0:
-                    is_selected = np.ones(len(intervals)) > 0
                     self.tabs.currentWidget().update_selected_intervals(
-                        intervals, is_selected
+                        intervals.reshape(-1, 2), True
                     )
             except Exception as e:
                 QMessageBox.warning(
@@ -577,7 +693,8 @@ def run():
     )
     app.setWindowIcon(QIcon(icon_path))
 
-    window = MainWindow(sys.argv[1:])
+    args = [arg for arg in sys.argv[1:] if arg != "--profile"]
+    window = MainWindow(args, profile=("--profile" in sys.argv[1:]))
     window.resize(1500, 900)
 
     window.show()
@@ -6,7 +6,8 @@ from snub.gui.utils import HeaderMixin
 
 class Panel(QWidget):
     new_current_time = pyqtSignal(float)
-    selection_change = pyqtSignal(list, list)
+    # emits an (N,2) array of intervals and whether to select or deselect them
+    selection_change = pyqtSignal(object, bool)
 
     def __init__(self, config, size_ratio=1, order=0, **kwargs):
         super().__init__()
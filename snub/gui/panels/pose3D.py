@@ -1,6 +1,9 @@
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
 import numpy as np
 import os
 
@@ -8,10 +11,77 @@ from vispy.scene import SceneCanvas
 from vispy.scene.visuals import Markers, Line
 
 from snub.gui.panels import Panel
-from snub.gui.utils import HeaderMixin
+from snub.gui.utils import (
+    HeaderMixin,
+    CustomContextMenu,
+    load_data,
+    load_mmap,
+    data_paths,
+)
+from snub.gui.utils.loading import submit
+
+
+def prepare_pose3D(props):
+    """Load a 3D pose plot's data (used to hydrate placeholders in the background).
+    Keypoints are memory-mapped rather than loaded."""
+    for path in data_paths(props):
+        if path == props["data_path"]:
+            load_mmap(path)
+        else:
+            load_data(path)
+
+
+def _rgba(colors):
+    """Append an opaque alpha channel to an array of RGB colors"""
+    alpha = np.ones(colors.shape[:-1] + (1,))
+    return np.concatenate([colors, alpha], axis=-1).astype(np.float32)
+
+
+def set_marker_positions(markers, pos, **kwargs):
+    """
+    Move the markers of a vispy ``Markers`` visual without re-preparing their
+    sizes and colors (``Markers.set_data`` resets any attribute that is not
+    passed). This writes the positions into the visual's interleaved vertex
+    buffer (the private ``_data`` and ``_vbo`` attributes, tested with vispy
+    0.17). If those are unavailable, or the number of markers changed, falls
+    back to ``set_data``, passing ``kwargs`` (e.g. ``face_color`` and
+    ``size``) so that the other attributes are kept.
+    """
+    data = getattr(markers, "_data", None)
+    if (
+        data is None
+        or not hasattr(markers, "_vbo")
+        or "a_position" not in (data.dtype.names or ())
+        or len(data) != len(pos)
+    ):
+        markers.set_data(pos=pos, **kwargs)
+        return
+    data["a_position"] = pos
+    markers._vbo.set_data(data)
+    markers.update()
+
+
+def time_lookup_table(bounds, origin, step, max_size=1 << 20):
+    """
+    Precompute ``searchsorted(bounds, t)`` on a grid of times ``origin + k*step``
+    (``bounds`` must be sorted). The step is increased if necessary so that the
+    table has at most ``max_size`` entries or two entries per bound (enough for
+    the search from a table entry to take about one step when the bounds are
+    evenly spaced). Returns the table (as int32) and the step.
+    """
+    max_size = max(min(max_size, 2 * len(bounds)), 2)
+    num_bins = int(np.ceil((bounds[-1] - origin) / step)) + 1
+    if num_bins > max_size:
+        step = (bounds[-1] - origin) / (max_size - 1)
+        num_bins = max_size
+    grid = origin + np.arange(max(num_bins, 1)) * step
+    return np.searchsorted(bounds, grid).astype(np.int32), step
 
 
 class Pose3DPanel(Panel, HeaderMixin):
+    read_ahead = 256
+    max_blocks = 3
+
     def __init__(
         self,
         config,
@@ -21,6 +91,8 @@ class Pose3DPanel(Panel, HeaderMixin):
         joint_colors_path=None,
         link_colors_path=None,
         links_path=None,
+        animal_labels_path=None,
+        animal_colors_path=None,
         joint_size=5,
         link_width=2,
         scaling=True,
@@ -28,35 +100,78 @@ class Pose3DPanel(Panel, HeaderMixin):
         floor_height=0,
         floor_spacing=10,
         floor_color=(1, 1, 1, 0.5),
+        interpolate=False,
         **kwargs
     ):
         super().__init__(config, **kwargs)
+        self.interpolate = interpolate
 
-        self.data = np.load(data_path)
-        self.intervals = np.load(intervals_path)
+        self.data = load_mmap(data_path)
+        if self.data.ndim == 3:
+            self.data = self.data[:, None]
+        self.intervals = load_data(intervals_path)
+        num_animals, num_joints = self.data.shape[1:3]
+
+        # lookup tables for finding the frame that contains a given time, and
+        # the frame whose center precedes it (for interpolation), in O(1)
+        self.frame_ends = self.intervals[:, 1]
+        self.frame_centers = self.intervals.mean(1)
+        self.lookup_origin = self.intervals[0, 0]
+        self.end_lookup, self.lookup_step = time_lookup_table(
+            self.frame_ends, self.lookup_origin, config["min_step"]
+        )
+        self.center_lookup, _ = time_lookup_table(
+            self.frame_centers, self.lookup_origin, self.lookup_step
+        )
 
         if labels_path is None:
-            self.labels = [str(i) for i in range(self.data.shape[0])]
+            self.labels = [str(i) for i in range(num_joints)]
         else:
-            self.labels = open(labels_path, "r").read().split("\n")
+            self.labels = load_data(labels_path).split("\n")
         if links_path is None:
             self.link_indexes = np.zeros((0, 2), dtype=int)
         else:
-            self.link_indexes = np.load(links_path).astype(int)
+            self.link_indexes = load_data(links_path).astype(int)
         if joint_colors_path is None:
-            self.joint_colors = np.ones((self.data.shape[0], 3))
+            self.joint_colors = np.ones((num_joints, 3))
         else:
-            self.joint_colors = np.load(joint_colors_path)
+            self.joint_colors = load_data(joint_colors_path)
 
         if link_colors_path is None:
-            self.link_colors = np.ones((len(self.links) * 2, 3))
+            self.link_colors = np.ones((len(self.link_indexes) * 2, 3))
         else:
-            self.link_colors = np.repeat(np.load(link_colors_path), 2, axis=0)
+            self.link_colors = np.repeat(load_data(link_colors_path), 2, axis=0)
+
+        if animal_labels_path is None:
+            self.animal_labels = [str(i) for i in range(num_animals)]
+        else:
+            self.animal_labels = load_data(animal_labels_path).split("\n")
+        self.animal_visible = np.ones(num_animals, dtype=bool)
+
+        # per-animal colors for joints and links, shape (animals, vertices, 4)
+        joint_colors = np.tile(self.joint_colors, (num_animals, 1, 1))
+        link_colors = np.tile(self.link_colors, (num_animals, 1, 1))
+        if animal_colors_path is not None:
+            animal_colors = load_data(animal_colors_path)[:, None]
+            joint_colors = np.broadcast_to(animal_colors, joint_colors.shape)
+            link_colors = np.broadcast_to(animal_colors, link_colors.shape)
+        self.animal_joint_colors = _rgba(joint_colors)
+        self.animal_link_colors = _rgba(link_colors)
+
+        # vertex indexes into a flattened (animals*joints, 3) frame
+        joint_vertices = np.arange(num_animals * num_joints).reshape(num_animals, -1)
+        self.animal_joint_vertices = joint_vertices
+        self.animal_link_vertices = joint_vertices[:, self.link_indexes.ravel()]
 
         self.joint_size = joint_size
         self.link_width = link_width
         self.scaling = scaling
 
+        self.frame_blocks = OrderedDict()
+        self.current_time = self.lookup_origin
+        self.current_frame_index = None
+        self.displayed_frame_index = None
+
         self.canvas = SceneCanvas(keys="interactive", show=True)
         self.view = self.canvas.central_widget.add_view(camera="arcball")
         self.view.camera.scale_factor = 500
@@ -134,37 +249,158 @@ class Pose3DPanel(Panel, HeaderMixin):
                     parent=self.view.scene,
                 )
 
+        self.canvas.events.mouse_release.connect(self.mouse_release)
+
         # self.update_current_time(config['init_current_time'])
         self.initUI(**kwargs)
+        self.update_visible_animals()
 
     def initUI(self, **kwargs):
         super().initUI(**kwargs)
         self.layout.addWidget(self.canvas.native, 1)
 
+    def update_visible_animals(self):
+        """
+        Set up the vertex buffers for the visible animals. Joint and link
+        vertices are gathered from each frame with fixed indexes into
+        preallocated buffers, so only their positions change between frames.
+        """
+        visible = self.animal_visible
+        self.joint_vertices = self.animal_joint_vertices[visible].ravel()
+        self.link_vertices = self.animal_link_vertices[visible].ravel()
+        self.joint_colors_visible = self.animal_joint_colors[visible].reshape(-1, 4)
+        self.joint_pos = np.zeros((len(self.joint_vertices), 3), dtype=np.float32)
+        self.link_pos = np.zeros((len(self.link_vertices), 3), dtype=np.float32)
+        self.joints.visible = len(self.joint_vertices) > 0
+        self.links.visible = len(self.link_vertices) > 0
+        if len(self.joint_vertices) > 0:
+            self.joints.set_data(
+                pos=self.joint_pos,
+                size=self.joint_size,
+                face_color=self.joint_colors_visible,
+            )
+        self.links.set_data(
+            pos=self.link_pos,
+            color=self.animal_link_colors[visible].reshape(-1, 4),
+        )
+        self.displayed_frame_index = None
+        if self.is_visible:
+            self.update_plot()
+
+    def toggle_animal_visibility(self, animal, state):
+        self.animal_visible[animal] = bool(state)
+        self.update_visible_animals()
+
+    def mouse_release(self, event):
+        # right-click (without dragging the camera) opens the context menu
+        if event.button == 2 and event.press_event is not None:
+            if np.abs(event.pos - event.press_event.pos).max() < 3:
+                self.context_menu(event)
+
+    def context_menu(self, event):
+        contextMenu = CustomContextMenu(self)
+        checkbox = contextMenu.add_item(
+            "Interpolate between frames",
+            self.toggle_interpolate,
+            item_type="checkbox",
+        )
+        checkbox.setChecked(self.interpolate)
+        if len(self.animal_labels) > 1:
+            contextMenu.addSeparator()
+            for i, label in enumerate(self.animal_labels):
+                checkbox = contextMenu.add_item(
+                    "Show " + label,
+                    partial(self.toggle_animal_visibility, i),
+                    item_type="checkbox",
+                )
+                checkbox.setChecked(bool(self.animal_visible[i]))
+        contextMenu.exec_(event.native.globalPos())
+
+    def toggle_interpolate(self, state):
+        self.interpolate = bool(state)
+        self.update_current_time(self.current_time)
+
+    def lookup(self, table, bounds, t):
+        """``searchsorted(bounds, t)``, starting from a precomputed lower bound"""
+        k = int((t - self.lookup_origin) // self.lookup_step)
+        ix = int(table[min(max(k, 0), len(table) - 1)])
+        while ix < len(bounds) and bounds[ix] < t:
+            ix += 1
+        return ix
+
     def update_current_time(self, t):
-        ix = self.intervals[:, 1].searchsorted(t)
-        if (
-            ix < self.intervals.shape[0]
-            and self.intervals[ix, 0] <= t
-            and t <= self.intervals[ix, 1]
-        ):
-            self.current_frame_index = ix
+        self.current_time = t
+        if self.interpolate:
+            # fractional frame index, linearly interpolated between frame
+            # centers (this also fills gaps between frames)
+            ix = self.lookup(self.center_lookup, self.frame_centers, t)
+            if ix < len(self.frame_centers) and self.frame_centers[ix] == t:
+                self.current_frame_index = float(ix)
+            elif 0 < ix < len(self.frame_centers):
+                c0, c1 = self.frame_centers[ix - 1], self.frame_centers[ix]
+                self.current_frame_index = ix - 1 + (t - c0) / (c1 - c0)
+            else:
+                self.current_frame_index = None
         else:
-            self.current_frame_index = None
+            ix = self.lookup(self.end_lookup, self.frame_ends, t)
+            if ix < self.intervals.shape[0] and self.intervals[ix, 0] <= t:
+                self.current_frame_index = ix
+            else:
+                self.current_frame_index = None
         if self.is_visible:
             self.update_plot()
 
+    def read_block(self, start):
+        return np.asarray(self.data[start : start + self.read_ahead], dtype=np.float32)
+
+    def get_frame(self, ix):
+        """
+        Keypoints for frame ``ix``. Frames are read from the memory-mapped data
+        in blocks of ``read_ahead`` frames, and the next block is read in the
+        background once playback passes the middle of the current one.
+        """
+        start = ix - ix % self.read_ahead
+        if start not in self.frame_blocks:
+            self.frame_blocks[start] = self.read_block(start)
+        self.frame_blocks.move_to_end(start)
+        block = self.frame_blocks[start]
+        if isinstance(block, Future):
+            block = self.frame_blocks[start] = block.result()
+
+        next_start = start + self.read_ahead
+        if ix - start >= self.read_ahead // 2 and next_start < len(self.data):
+            if next_start not in self.frame_blocks:
+                self.frame_blocks[next_start] = submit(self.read_block, next_start)
+        while len(self.frame_blocks) > self.max_blocks:
+            self.frame_blocks.popitem(last=False)
+        return block[ix - start]
+
+    def get_interpolated_frame(self, ix):
+        """Keypoints at a (possibly fractional) frame index, blending the two
+        neighbouring frames"""
+        i = int(ix)
+        w = ix - i
+        if w == 0:
+            return self.get_frame(i)
+        return (1 - w) * self.get_frame(i) + w * self.get_frame(i + 1)
+
     def update_plot(self):
-        if self.current_frame_index is not None:
-            self.joints.set_data(
-                pos=self.data[self.current_frame_index],
-                size=self.joint_size,
-                face_color=self.joint_colors,
-            )
-            self.links.set_data(
-                pos=self.data[self.current_frame_index, self.link_indexes.flat],
-                color=self.link_colors,
-            )
+        # skip frames that are already displayed (e.g. when several ticks fall
+        # within the same frame), so that they are not uploaded again
+        ix = self.current_frame_index
+        if ix is not None and ix != self.displayed_frame_index:
+            frame = self.get_interpolated_frame(ix).reshape(-1, 3)
+            if len(self.joint_vertices) > 0:
+                np.take(frame, self.joint_vertices, axis=0, out=self.joint_pos)
+                set_marker_positions(
+                    self.joints,
+                    self.joint_pos,
+                    size=self.joint_size,
+                    face_color=self.joint_colors_visible,
+                )
+            np.take(frame, self.link_vertices, axis=0, out=self.link_pos)
+            self.links.set_data(pos=self.link_pos)
+            self.displayed_frame_index = ix
 
     def toggle_visiblity(self, *args):
         super().toggle_visiblity(*args)
@@ -3,29 +3,53 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 import numpy as np
 import os
-import cv2
-from scipy.sparse import load_npz
-from vidio import VideoReader
 
 from vispy.scene import SceneCanvas
 from vispy.scene.visuals import Image, Line
 
 from snub.gui.panels import Panel
-from snub.gui.utils import HeaderMixin, AdjustColormapDialog, CustomContextMenu
+from snub.gui.utils import (
+    HeaderMixin,
+    AdjustColormapDialog,
+    CustomContextMenu,
+    derived,
+    load_data,
+    data_paths,
+    get_disk_cache,
+    FrameCache,
+)
 from snub.io.project import _random_color
-
-
-def _roi_contours(rois, dims, threshold_max_ratio=0.2, blur_kernel=2):
-    rois = np.array(rois.todense()).reshape(rois.shape[0], *dims)
-    contour_coordinates = []
-    for roi in rois:
-        roi_blur = cv2.GaussianBlur(roi, (11, 11), blur_kernel)
-        roi_mask = roi_blur > roi_blur.max() * threshold_max_ratio
-        xy = cv2.findContours(
-            roi_mask.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
-        )[0][0].squeeze()
-        contour_coordinates.append(np.vstack((xy, xy[:1])))
-    return contour_coordinates
+from snub.io.roi import roi_contours, split_contours
+
+
+def load_roi_contours(rois_path, contours_path, dims, disk_cache=None):
+    """Load the contours saved at ``contours_path``, or (for projects that were
+    created without a contour file) compute contours from the ROIs saved at
+    ``rois_path`` (cached in memory and optionally in a
+    :py:class:`snub.gui.utils.DiskCache`)"""
+    num_rois = load_data(rois_path).shape[0]
+    if contours_path is not None:
+        return split_contours(load_data(contours_path), num_rois)
+    return derived(
+        "roi_contours",
+        [rois_path],
+        tuple(dims),
+        lambda: roi_contours(load_data(rois_path), dims),
+        disk_cache,
+    )
+
+
+def prepare_roiplot(config, props):
+    """Load ROIs and their contours (used to hydrate placeholders in the
+    background)"""
+    for path in data_paths(props):
+        load_data(path)
+    load_roi_contours(
+        props["rois_path"],
+        props.get("contours_path"),
+        props["dimensions"],
+        get_disk_cache(config),
+    )
 
 
 class ROIPanel(Panel, HeaderMixin):
@@ -35,6 +59,7 @@ class ROIPanel(Panel, HeaderMixin):
         self,
         config,
         rois_path=None,
+        contours_path=None,
         labels_path=None,
         timestamps_path=None,
         dimensions=None,
@@ -56,13 +81,13 @@ class ROIPanel(Panel, HeaderMixin):
         self.current_frame_index = None
         self.is_visible = True
 
-        self.rois = load_npz(rois_path)
-        self.timestamps = np.load(timestamps_path)
+        self.rois = load_data(rois_path)
+        self.timestamps = load_data(timestamps_path)
 
         if labels_path is None:
             self.labels = [str(i) for i in range(self.rois.shape[0])]
         else:
-            self.labels = open(labels_path, "r").read().split("\n")
+            self.labels = load_data(labels_path).split("\n")
 
         self.adjust_colormap_dialog = AdjustColormapDialog(self, self.vmin, self.vmax)
         self.adjust_colormap_dialog.new_range.connect(self.update_colormap_range)
@@ -77,32 +102,52 @@ class ROIPanel(Panel, HeaderMixin):
         )
         self.viewbox.camera.aspect = 1
 
-        self.contours = {}
-        for label, coordinates in zip(self.labels, _roi_contours(self.rois, self.dims)):
-            color = (
-                contour_colors[label] if label in contour_colors else _random_color()
-            )
-            self.contours[label] = Line(
-                coordinates,
-                color=np.array(color) / 255,
-                width=self.linewidth,
-                connect="strip",
-                parent=None,
-            )
-
-        self.vids = {
-            name: VideoReader(video_path) for name, video_path in video_paths.items()
-        }
+        # all contours are drawn by a single visual: vertices of every ROI are
+        # packed into one buffer and visibility is set by choosing which
+        # segments (pairs of consecutive vertices from the same ROI) to draw
+        contours = load_roi_contours(
+            rois_path, contours_path, self.dims, get_disk_cache(config)
+        )
+        self.vertex_rois = np.repeat(
+            np.arange(len(contours)), [len(c) for c in contours]
+        )
+        vertices = np.vstack([np.zeros((0, 2))] + list(contours)).astype(np.float32)
+        roi_colors = np.array(
+            [
+                contour_colors[l] if l in contour_colors else _random_color()
+                for l in self.labels
+            ]
+        ).reshape(-1, 3)
+        vertex_colors = np.ones((len(vertices), 4), dtype=np.float32)
+        vertex_colors[:, :3] = roi_colors[self.vertex_rois] / 255
+        starts = np.nonzero(self.vertex_rois[:-1] == self.vertex_rois[1:])[0]
+        self.segments = np.column_stack((starts, starts + 1)).astype(np.uint32)
+        self.segment_rois = self.vertex_rois[starts]
+        self.label_indexes = {l: i for i, l in enumerate(self.labels)}
+        self.visible_rois = np.zeros(len(self.labels), dtype=bool)
+        self.contours = Line(
+            vertices,
+            color=vertex_colors,
+            width=self.linewidth,
+            connect=self.segments[:1],
+            parent=self.viewbox.scene,
+        )
+        self.contours.visible = False
+
+        self.frames = FrameCache(video_paths, channel=0)
+        self.destroyed.connect(self.frames.close)
 
         self.dropDown = QComboBox()
         self.dropDown.addItems(list(video_paths.keys())[::-1])
         self.dropDown.activated.connect(self.update_image)
 
+        # frames are uploaded as uint8 and normalized on the GPU using clim
         self.image = Image(
-            np.zeros(self.dims, dtype=np.float32),
+            np.zeros(self.dims, dtype=np.uint8),
             cmap=colormap,
             parent=self.viewbox.scene,
-            clim=(0, 1),
+            clim=(self.vmin * 255, self.vmax * 255),
+            texture_format="auto",
         )
         self.update_current_time(config["init_current_time"])
         self.initUI(**kwargs)
@@ -112,8 +157,7 @@ class ROIPanel(Panel, HeaderMixin):
         self.layout.addWidget(self.dropDown)
         self.layout.addWidget(self.canvas.native)
         self.image.order = 1
-        for c in self.contours.values():
-            c.order = 0
+        self.contours.order = 0
         self.dropDown.setStyleSheet(
             """
             QComboBox::item { color: white; background-color : #3E3E3E;}
@@ -121,11 +165,15 @@ class ROIPanel(Panel, HeaderMixin):
         )
 
     def update_visible_contours(self, visible_contours):
-        for l, c in self.contours.items():
-            if l in visible_contours:
-                c.parent = self.viewbox.scene
-            else:
-                c.parent = None
+        self.visible_rois[:] = False
+        self.visible_rois[
+            [self.label_indexes[l] for l in visible_contours if l in self.label_indexes]
+        ] = True
+        connect = self.segments[self.visible_rois[self.segment_rois]]
+        if len(connect) > 0:
+            self.contours.set_data(connect=connect)
+        self.contours.visible = len(connect) > 0
+        self.canvas.update()
 
     def update_current_time(self, t):
         self.current_frame_index = min(
@@ -142,16 +190,17 @@ class ROIPanel(Panel, HeaderMixin):
     def update_image(self):
         name = self.dropDown.currentText()
         if self.current_frame_index is None:
-            x = np.zeros(self.dims)
+            image = np.zeros(self.dims, dtype=np.uint8)
         else:
-            x = self.vids[name][self.current_frame_index][:, :, 0] / 255
-        image = (np.clip(x, self.vmin, self.vmax) - self.vmin) / (self.vmax - self.vmin)
-        self.image.set_data(image.astype(np.float32))
+            image = self.frames.get(name, self.current_frame_index)
+            self.frames.prefetch(name, self.current_frame_index)
+        self.image.set_data(image)
         self.canvas.update()
 
     def update_colormap_range(self, vmin, vmax):
         self.vmin, self.vmax = vmin, vmax
-        self.update_image()
+        self.image.clim = (self.vmin * 255, self.vmax * 255)
+        self.canvas.update()
 
     def show_adjust_colormap_dialog(self):
         self.adjust_colormap_dialog.show()
@@ -5,9 +5,12 @@ import numpy as np
 import os
 import cmapy
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from scipy.stats import rankdata
 
 from vispy.scene import SceneCanvas
-from vispy.scene.visuals import Markers, Rectangle
+from vispy.scene.visuals import Markers, Rectangle, Image
+from vispy.visuals.transforms import STTransform
 from vispy.util import keys
 
 from snub.gui.panels import Panel
@@ -15,10 +18,132 @@ from snub.gui.utils import (
     HeaderMixin,
     AdjustColormapDialog,
     IntervalIndex,
+    GridIndex,
+    rectangle_difference,
     UNCHECKED_ICON_PATH,
     CHECKED_ICON_PATH,
     CustomContextMenu,
+    load_data,
+    derived,
+    get_disk_cache,
 )
+from snub.io.manifold import scatter_density
+
+
+ENRICHMENT_SCORES = {
+    "zscore": "z-score",
+    "effect_size": "effect size",
+    "auc": "AUC",
+}
+
+
+def _chunked_moments(variables, rows=None, chunk_size=100000):
+    # mean and sum of squared deviations of each column (over a subset of rows),
+    # accumulated in chunks using the parallel variance algorithm of Chan et al.
+    n, mean, m2 = 0, np.zeros(variables.shape[1]), np.zeros(variables.shape[1])
+    num_rows = variables.shape[0] if rows is None else len(rows)
+    for i in range(0, num_rows, chunk_size):
+        ixs = slice(i, i + chunk_size) if rows is None else rows[i : i + chunk_size]
+        chunk = np.asarray(variables[ixs], dtype=np.float64)
+        n_chunk, mean_chunk = chunk.shape[0], chunk.mean(0)
+        m2_chunk = ((chunk - mean_chunk) ** 2).sum(0)
+        delta = mean_chunk - mean
+        total = n + n_chunk
+        mean = mean + delta * n_chunk / total
+        m2 = m2 + m2_chunk + delta**2 * n * n_chunk / total
+        n = total
+    return n, mean, m2
+
+
+def _auc(values, rows):
+    # Mann-Whitney U statistic of values[rows] vs. the other values, normalized
+    n_sel, n_unsel = len(rows), len(values) - len(rows)
+    u = rankdata(values)[rows].sum() - n_sel * (n_sel + 1) / 2
+    return u / max(n_sel * n_unsel, 1)
+
+
+def variable_statistics(variables, chunk_size=100000):
+    """
+    Mean and standard deviation of each column of ``variables``, computed in
+    chunks of rows so that no full-size temporary arrays are allocated.
+
+    Returns
+    -------
+    stats: ndarray
+        ``(2,M)`` array containing the mean and standard deviation of each column
+    """
+    n, mean, m2 = _chunked_moments(variables, chunk_size=chunk_size)
+    return np.vstack((mean, np.sqrt(m2 / max(n, 1))))
+
+
+def variable_enrichment(
+    variables, is_selected, stats=None, score="zscore", n_workers=None
+):
+    """
+    Score how much each variable is enriched in the selected rows.
+
+    Parameters
+    ----------
+    variables: ndarray
+        ``(N,M)`` array of variables
+
+    is_selected: ndarray
+        Boolean array of length ``N``
+
+    stats: ndarray, default=None
+        Precomputed output of :py:func:`variable_statistics`
+
+    score: str, default="zscore"
+        - ``"zscore"``: mean z-scored value in the selected rows
+        - ``"effect_size"``: difference between the mean of the selected and
+          unselected rows divided by the pooled standard deviation (Cohen's d)
+        - ``"auc"``: probability that a selected row has a higher value than an
+          unselected one (area under the ROC curve), computed for each variable
+          in parallel
+
+    n_workers: int, default=None
+        Number of threads used to compute ``"auc"`` scores.
+
+    Returns
+    -------
+    enrichment: ndarray
+        Score for each variable (higher means more enriched)
+    """
+    eps = 1e-10
+    if not score in ENRICHMENT_SCORES:
+        raise AssertionError(
+            "`score` must be one of {}".format(list(ENRICHMENT_SCORES.keys()))
+        )
+    if stats is None:
+        stats = variable_statistics(variables)
+    rows = np.nonzero(is_selected)[0]
+    n_all, n_sel = variables.shape[0], len(rows)
+    n_unsel = n_all - n_sel
+
+    if score == "zscore":
+        _, mean_sel, _ = _chunked_moments(variables, rows)
+        return (mean_sel - stats[0]) / (stats[1] + eps)
+
+    elif score == "effect_size":
+        _, mean_sel, m2_sel = _chunked_moments(variables, rows)
+        m2_all = stats[1] ** 2 * n_all
+        mean_unsel = (stats[0] * n_all - mean_sel * n_sel) / max(n_unsel, 1)
+        m2_unsel = (
+            m2_all
+            - m2_sel
+            - n_sel * (mean_sel - stats[0]) ** 2
+            - n_unsel * (mean_unsel - stats[0]) ** 2
+        )
+        pooled_std = np.sqrt(np.maximum(m2_sel + m2_unsel, 0) / max(n_all - 2, 1))
+        return (mean_sel - mean_unsel) / (pooled_std + eps)
+
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            aucs = executor.map(
+                lambda column: _auc(variables[:, column], rows),
+                range(variables.shape[1]),
+            )
+            return np.array(list(aucs))
 
 
 class ScatterPanel(Panel, HeaderMixin):
@@ -42,6 +167,9 @@ class ScatterPanel(Panel, HeaderMixin):
         colormap="viridis",
         selection_intersection_threshold=0.5,
         variable_labels=[],
+        density_path=None,
+        density_extent=None,
+        max_markers=200000,
         **kwargs,
     ):
         super().__init__(config, **kwargs)
@@ -64,13 +192,62 @@ class ScatterPanel(Panel, HeaderMixin):
         self.sort_nodes_by_variable = True
         self.show_marker_trail = False
 
-        self.data = np.load(data_path)
+        self.data = load_data(data_path).copy()
+        self.variable_stats = derived(
+            "scatter_variable_stats",
+            [data_path],
+            (),
+            lambda: variable_statistics(self.data[:, 4:]),
+            get_disk_cache(config),
+        )
         self.data[:, 2:4] = self.data[:, 2:4] + np.array([-self.eps, self.eps])
         self.is_selected = np.zeros(self.data.shape[0]) > 0
+        self.selection_version = None
         self.plot_order = np.arange(self.data.shape[0])
+        self.sort_orders = {}
+        self.colormap_lut = cmapy.cmap(self.colormap).squeeze()[:, ::-1] / 255
         self.interval_index = IntervalIndex(
             min_step=self.min_step, intervals=self.data[:, 2:4]
         )
+        self.spatial_index = GridIndex(self.data[:, :2])
+        self.drag_state = None
+
+        # level of detail: when more than `max_markers` points are in view, the
+        # scatter is drawn as a density image; otherwise only markers for points
+        # in (or near) the view are uploaded
+        self.max_markers = max_markers
+        self.use_lod = self.data.shape[0] > max_markers
+        self.density_mode = self.use_lod
+        self.loaded_rect = None
+        self.in_view = None
+        if self.use_lod:
+            if density_path is None:
+                density, density_extent = derived(
+                    "scatter_density",
+                    [data_path],
+                    (),
+                    lambda: scatter_density(self.data[:, :2]),
+                    get_disk_cache(config),
+                )
+            else:
+                density = load_data(density_path)
+            self.density_extent = np.array(density_extent)
+            self.density_counts = density.cumsum(0).cumsum(1)
+            self.density_image = Image(
+                np.log1p(density).astype(np.float32), cmap="grays"
+            )
+            xmin, xmax, ymin, ymax = self.density_extent
+            self.density_image.transform = STTransform(
+                scale=(
+                    (xmax - xmin) / density.shape[1],
+                    (ymax - ymin) / density.shape[0],
+                ),
+                translate=(xmin, ymin),
+            )
+            self.lod_timer = QTimer(self)
+            self.lod_timer.setSingleShot(True)
+            self.lod_timer.setInterval(50)
+            self.lod_timer.timeout.connect(self.update_lod)
 
         self.adjust_colormap_dialog = AdjustColormapDialog(self, self.vmin, self.vmax)
         self.adjust_colormap_dialog.new_range.connect(self.update_colormap_range)
@@ -122,6 +299,12 @@ class ScatterPanel(Panel, HeaderMixin):
         if ylim is None:
             ylim = [self.data[:, 1].min(), self.data[:, 1].max()]
         self.viewbox.camera.set_range(x=xlim, y=ylim, margin=0.1)
+        if self.use_lod:
+            self.density_image.order = -1
+            self.density_image.parent = self.viewbox.scene
+            self.viewbox.scene.transform.changed.connect(
+                lambda event: self.lod_timer.start()
+            )
         self.rect.order = 0
         self.current_node_marker.order = 1
         self.scatter_selected.order = 2
@@ -133,38 +316,112 @@ class ScatterPanel(Panel, HeaderMixin):
             QListWidget { background-color : #3E3E3E; }"""
         )
 
+    def sort_order(self, column):
+        """Indexes of points sorted by decreasing value of a data column (cached)"""
+        if not column in self.sort_orders:
+            self.sort_orders[column] = np.argsort(self.data[:, column])[::-1]
+        return self.sort_orders[column]
+
     def update_scatter(self):
         if self.current_variable_label in self.variable_labels:
-            x = self.data[
-                :, 2 + self.variable_labels.index(self.current_variable_label)
-            ]
+            column = 2 + self.variable_labels.index(self.current_variable_label)
             if self.sort_nodes_by_variable:
-                self.plot_order = np.argsort(x)[::-1]
+                self.plot_order = self.sort_order(column)
             else:
-                self.plot_order = np.arange(len(x))
-            x = np.clip((x - self.vmin) / (self.vmax - self.vmin), 0, 1)[
-                self.plot_order
-            ]
-            face_color = (
-                cmapy.cmap(self.colormap).squeeze()[:, ::-1][(255 * x).astype(int)]
-                / 255
+                self.plot_order = np.arange(self.data.shape[0])
+            x = self.data[self.plot_order, column]
+            x = np.clip((x - self.vmin) / (self.vmax - self.vmin), 0, 1)
+            self.face_color = self.colormap_lut[(255 * x).astype(int)]
+        else:
+            self.plot_order = np.arange(self.data.shape[0])
+            self.face_color = np.repeat(
+                self.facecolor[None], self.data.shape[0], axis=0
             )
+
+        if self.in_view is not None:
+            keep = self.in_view[self.plot_order]
+            self.plot_order = self.plot_order[keep]
+            self.face_color = self.face_color[keep]
+
+        if self.density_mode:
+            self.scatter.parent = None
         else:
-            face_color = np.repeat(self.facecolor[None], self.data.shape[0], axis=0)
-
-        self.scatter.set_data(
-            pos=self.data[self.plot_order, :2],
-            face_color=face_color,
-            edge_color=self.edgecolor,
-            edge_width=self.linewidth,
-            size=self.pointsize,
+            self.scatter.set_data(
+                pos=self.data[self.plot_order, :2],
+                face_color=self.face_color,
+                edge_color=self.edgecolor,
+                edge_width=self.linewidth,
+                size=self.pointsize,
+            )
+            self.scatter.parent = self.viewbox.scene
+        self.update_selected_scatter()
+
+    def points_in_rect(self, lo, hi):
+        """Approximate number of points in a rectangle (from the density image)"""
+        xmin, xmax, ymin, ymax = self.density_extent
+        rows, cols = self.density_counts.shape
+        c0, c1 = np.clip(
+            ((np.array([lo[0], hi[0]]) - xmin) / (xmax - xmin) * cols).astype(int),
+            0,
+            cols - 1,
+        )
+        r0, r1 = np.clip(
+            ((np.array([lo[1], hi[1]]) - ymin) / (ymax - ymin) * rows).astype(int),
+            0,
+            rows - 1,
         )
+        counts = self.density_counts
+        total = counts[r1, c1]
+        if r0 > 0:
+            total -= counts[r0 - 1, c1]
+        if c0 > 0:
+            total -= counts[r1, c0 - 1]
+        if r0 > 0 and c0 > 0:
+            total += counts[r0 - 1, c0 - 1]
+        return total
+
+    def update_lod(self):
+        """Switch between density and marker rendering based on the current view.
+        In marker mode, points within a margin around the view are uploaded so
+        that small pans do not require another upload."""
+        rect = self.viewbox.camera.rect
+        lo = np.array([rect.left, rect.bottom])
+        hi = np.array([rect.right, rect.top])
+        if self.points_in_rect(lo, hi) > self.max_markers:
+            if not self.density_mode:
+                self.density_mode = True
+                self.in_view = None
+                self.loaded_rect = None
+                self.density_image.parent = self.viewbox.scene
+                self.update_scatter()
+            return
+        if (
+            not self.density_mode
+            and self.loaded_rect is not None
+            and np.all(lo >= self.loaded_rect[0])
+            and np.all(hi <= self.loaded_rect[1])
+        ):
+            return
+        margin = (hi - lo) / 2
+        loaded_rect = (lo - margin, hi + margin)
+        ixs = self.spatial_index.query(*loaded_rect)
+        if len(ixs) > self.max_markers:
+            loaded_rect = (lo, hi)
+            ixs = self.spatial_index.query(*loaded_rect)
+        self.in_view = np.zeros(self.data.shape[0], dtype=bool)
+        self.in_view[ixs] = True
+        self.loaded_rect = loaded_rect
+        self.density_mode = False
+        self.density_image.parent = None
+        self.update_scatter()
 
+    def update_selected_scatter(self):
+        # only the (usually small) set of selected points is re-uploaded
         if self.is_selected.any():
             is_selected = self.is_selected[self.plot_order]
             self.scatter_selected.set_data(
-                pos=self.data[self.plot_order, :2][is_selected],
-                face_color=face_color[is_selected],
+                pos=self.data[self.plot_order[is_selected], :2],
+                face_color=self.face_color[is_selected],
                 edge_color=self.selected_edgecolor,
                 edge_width=(self.linewidth * 2),
                 size=self.pointsize,
@@ -201,12 +458,13 @@ class ScatterPanel(Panel, HeaderMixin):
             contextMenu.add_item("Show variables menu", self.show_variable_menu)
 
         # get enriched variables (only available is nodes are selected)
-        label = contextMenu.add_item(
-            "Sort variables by enrichment",
-            self.get_enriched_variables,
-        )
-        if self.is_selected.sum() == 0:
-            label.setStyleSheet("QLabel { color: rgb(120,120,120); }")
+        for score, score_name in ENRICHMENT_SCORES.items():
+            label = contextMenu.add_item(
+                "Sort variables by enrichment ({})".format(score_name),
+                partial(self.get_enriched_variables, score),
+            )
+            if self.is_selected.sum() == 0:
+                label.setStyleSheet("QLabel { color: rgb(120,120,120); }")
 
         contextMenu.add_item(
             "Restore original variable order",
@@ -261,14 +519,16 @@ class ScatterPanel(Panel, HeaderMixin):
             self.variable_menu.addItem(name)
         self.variable_menu.show()
 
-    def get_enriched_variables(self):
-        if self.is_selected.sum() > 0 and len(self.variable_labels) > 0:
-            variables_zscore = (self.data[:, 2:] - self.data[:, 2:].mean(0)) / (
-                np.std(self.data[:, 2:], axis=0) + self.eps
+    def get_enriched_variables(self, score="zscore"):
+        """Sort the variables menu by enrichment in the selected points (see
+        :py:func:`variable_enrichment`). The interval start/end are listed last."""
+        if self.is_selected.sum() > 0 and len(self.variable_labels) > 2:
+            enrichment = variable_enrichment(
+                self.data[:, 4:], self.is_selected, self.variable_stats, score
             )
-            enrichment = variables_zscore[self.is_selected].mean(0)
-            print(enrichment, self.data.shape, self.variable_labels)
-            variable_order = [self.variable_labels[i] for i in np.argsort(-enrichment)]
+            variable_order = [
+                self.variable_labels[i + 2] for i in np.argsort(-enrichment)
+            ] + self.variable_labels[:2]
             self.show_variable_menu(variable_order=variable_order)
 
     def update_colormap_range(self, vmin, vmax):
@@ -308,6 +568,7 @@ class ScatterPanel(Panel, HeaderMixin):
 
     def mouse_release(self, event):
         self.rect.parent = None
+        self.drag_state = None
         if event.button == 2:
             self.context_menu(event)
 
@@ -324,24 +585,60 @@ class ScatterPanel(Panel, HeaderMixin):
                     self.rect.parent = self.viewbox.scene
 
                 selection_value = int(mods[0] == keys.SHIFT)
-                enclosed_points = np.all(
-                    [
-                        self.data[:, :2] >= np.minimum(current_pos, start_pos),
-                        self.data[:, :2] <= np.maximum(current_pos, start_pos),
-                    ],
-                    axis=(0, 2),
-                )
-                self.selection_change.emit(
-                    list(self.data[enclosed_points, 2:4]),
-                    [selection_value] * len(enclosed_points),
+                new_points = self.newly_enclosed_points(
+                    event.press_event,
+                    selection_value,
+                    np.minimum(current_pos, start_pos),
+                    np.maximum(current_pos, start_pos),
                 )
+                if len(new_points) > 0:
+                    self.selection_change.emit(
+                        self.data[new_points, 2:4], bool(selection_value)
+                    )
+
+    def newly_enclosed_points(self, press_event, selection_value, lo, hi):
+        """Points enclosed by the selection rectangle that were not enclosed earlier
+        in the same drag. Only the area added to the rectangle since the last
+        mouse move is queried."""
+        if self.drag_state is None or self.drag_state[:2] != (
+            press_event,
+            selection_value,
+        ):
+            enclosed = np.zeros(self.data.shape[0], dtype=bool)
+            self.drag_state = (press_event, selection_value, enclosed, None)
+        enclosed, previous_rect = self.drag_state[2:]
+        new_points = []
+        for rect in rectangle_difference((lo, hi), previous_rect):
+            ixs = self.spatial_index.query(*rect)
+            ixs = ixs[~enclosed[ixs]]
+            enclosed[ixs] = True
+            new_points.append(ixs)
+        self.drag_state = (press_event, selection_value, enclosed, (lo, hi))
+        return np.concatenate(new_points + [np.empty(0, dtype=int)])
 
     def update_selected_intervals(self):
-        intersections = self.selected_intervals.intersection_proportions(
-            self.data[:, 2:4]
+        selected_intervals = self.selected_intervals
+        if selected_intervals.version == self.selection_version:
+            return
+        incremental = (
+            self.selection_version is not None
+            and selected_intervals.version == self.selection_version + 1
+            and selected_intervals.changed_span is not None
         )
-        self.is_selected = intersections > self.selection_intersection_threshold
-        self.update_scatter()
+        if incremental:
+            # only points overlapping the changed time span can change
+            ixs = self.interval_index.overlapping(*selected_intervals.changed_span)
+        else:
+            ixs = np.arange(self.data.shape[0])
+        if len(ixs) > 0:
+            intersections = selected_intervals.intersection_proportions(
+                self.data[ixs, 2:4]
+            )
+            self.is_selected[ixs] = (
+                intersections > self.selection_intersection_threshold
+            )
+        self.selection_version = selected_intervals.version
+        self.update_selected_scatter()
 
 
 class AdjustMarkerDialog(QDialog):
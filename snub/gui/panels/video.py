@@ -5,7 +5,7 @@ import numpy as np
 import os
 
 from vidio import VideoReader
-from snub.gui.utils import HeaderMixin
+from snub.gui.utils import HeaderMixin, load_data
 from snub.gui.panels import Panel
 
 """
@@ -32,7 +32,7 @@ class VideoPanel(Panel, HeaderMixin):
     def __init__(self, config, video_path=None, timestamps_path=None, **kwargs):
         super().__init__(config, **kwargs)
         self.video_frame = VideoFrame(video_path)
-        self.timestamps = np.load(timestamps_path)
+        self.timestamps = load_data(timestamps_path)
         self.current_frame_index = None
         self.is_visible = True
         self.update_current_time(config["init_current_time"])
@@ -2,13 +2,80 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 import numpy as np
+from functools import partial
+
+from snub.gui.utils import Placeholder, load_data, data_paths
+
+
+def _load_data_paths(props):
+    for path in data_paths(props):
+        load_data(path)
 
 
 class Stack(QWidget):
+    widget_hydrated = pyqtSignal(object)
+
     def __init__(self, config, selected_intervals):
         super().__init__()
         self.widgets = []
         self.selected_intervals = selected_intervals
+        self.lazy_loading = config["lazy_loading"]
+        self.config = config
+
+    def add_widget(self, widget_type, props, factory, prepare=_load_data_paths):
+        """
+        Add a widget constructed by ``factory(**props)``. When lazy loading is on,
+        a :py:class:`snub.gui.utils.Placeholder` is added instead, and replaced
+        once ``prepare(props)`` has run in the background (see ``load_widgets``).
+        """
+        if self.lazy_loading:
+            widget = Placeholder(self.config, widget_type, props, factory, prepare)
+            widget.loaded.connect(partial(self.hydrate, widget))
+        else:
+            widget = factory(**props)
+        self.widgets.append(widget)
+        self.setup_widget(widget)
+
+    def setup_widget(self, widget):
+        """Connect a newly added widget (or placeholder) to the stack"""
+        pass
+
+    def load_widgets(self):
+        """Start loading data for every placeholder that is expanded"""
+        for widget in self.widgets:
+            if isinstance(widget, Placeholder) and widget.is_visible:
+                widget.load()
+
+    def finish_loading(self):
+        """Block until every placeholder that has started loading is replaced"""
+        for widget in list(self.widgets):
+            if isinstance(widget, Placeholder) and widget.future is not None:
+                widget.wait()
+                self.hydrate(widget)
+
+    def hydrate(self, placeholder):
+        """Replace a placeholder with the widget it stands in for"""
+        if not placeholder in self.widgets:
+            return
+        if placeholder.error is not None:
+            placeholder.status.setText(
+                "Failed to load {}\n{}".format(placeholder.name, placeholder.error)
+            )
+            return
+        props = dict(
+            placeholder.props,
+            initial_visibility=placeholder.is_visible,
+            initial_saved_size=placeholder.saved_size,
+        )
+        widget = placeholder.factory(**props)
+        closed = placeholder.isHidden()
+        self.splitter.replaceWidget(self.splitter.indexOf(placeholder), widget)
+        widget.setVisible(not closed)
+        self.widgets[self.widgets.index(placeholder)] = widget
+        placeholder.deleteLater()
+        widget.change_layout_mode(placeholder.layout_mode)
+        self.setup_widget(widget)
+        self.widget_hydrated.emit(widget)
 
     def change_layout_mode(self, layout_mode):
         for widget in self.widgets:
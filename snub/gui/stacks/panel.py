@@ -2,8 +2,12 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
+from functools import partial
+
 from snub.gui.stacks import Stack
 from snub.gui.panels import VideoPanel, ScatterPanel, ROIPanel, Pose3DPanel
+from snub.gui.panels.roi import prepare_roiplot
+from snub.gui.panels.pose3D import prepare_pose3D
 
 
 class PanelStack(Stack):
@@ -12,23 +16,25 @@ class PanelStack(Stack):
         self.size_ratio = config["panels_size_ratio"]
 
         for props in config["scatter"]:  # initialize scatter plots
-            panel = ScatterPanel(config, self.selected_intervals, **props)
-            self.widgets.append(panel)
+            self.add_widget(
+                "scatter", props, partial(ScatterPanel, config, self.selected_intervals)
+            )
 
         for props in config["video"]:  # initialize video
-            panel = VideoPanel(config, **props)
-            self.widgets.append(panel)
+            self.add_widget("video", props, partial(VideoPanel, config))
 
         for props in config["pose3D"]:  # initialize 3D pose viewer
-            panel = Pose3DPanel(config, **props)
-            self.widgets.append(panel)
+            self.add_widget(
+                "pose3D", props, partial(Pose3DPanel, config), prepare=prepare_pose3D
+            )
 
         for props in config["roiplot"]:  # initialize ROI plot
-            panel = ROIPanel(config, **props)
-            self.widgets.append(panel)
-
-        for w in self.widgets:
-            w.closed.connect(self.widget_closed)
+            self.add_widget(
+                "roiplot",
+                props,
+                partial(ROIPanel, config),
+                prepare=partial(prepare_roiplot, config),
+            )
 
         self.initUI()
 
@@ -45,6 +51,9 @@ class PanelStack(Stack):
         self.splitter.setSizes([100000 * p.size_ratio for p in self.widgets])
         hbox.setContentsMargins(0, 0, 0, 0)
 
+    def setup_widget(self, widget):
+        widget.closed.connect(self.widget_closed)
+
     def get_by_name(self, name):
         for panel in self.widgets:
             if panel.name == name:
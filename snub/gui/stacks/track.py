@@ -2,14 +2,17 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 import numpy as np
+from functools import partial
 
 from snub.gui.stacks import Stack
 from snub.gui.tracks import *
+from snub.gui.tracks.heatmap import prepare_heatmap
+from snub.gui.tracks.spike import prepare_spikeplot
 
 
 class TrackStack(Stack):
     new_current_time = pyqtSignal(float)
-    selection_change = pyqtSignal(list, list)
+    selection_change = pyqtSignal(object, bool)
 
     def __init__(self, config, selected_intervals):
         super().__init__(config, selected_intervals)
@@ -19,6 +22,7 @@ class TrackStack(Stack):
         self.min_range = config["min_range"]
         self.size_ratio = config["tracks_size_ratio"]
         self.current_range = self.bounds
+        self.pending_range = None
         self.selection_drag_mode = 0  # +1 for shift-click, -1 for command-click
         self.selection_drag_initial_time = None
 
@@ -31,33 +35,57 @@ class TrackStack(Stack):
         )
         self.overlays = [self.selection_overlay, self.current_time_marker]
 
+        for w in self.widgets + self.overlays:
+            self.timeline.toggle_units_signal.connect(w.update_time_unit)
+
         for props in config["heatmap"]:
             if props["add_traceplot"]:
-                track = HeatmapTraceGroup(config, self.selected_intervals, **props)
+                factory = partial(HeatmapTraceGroup, config, self.selected_intervals)
             else:
-                track = HeadedHeatmap(config, self.selected_intervals, **props)
-            self.widgets.append(track)
+                factory = partial(HeadedHeatmap, config, self.selected_intervals)
+            self.add_widget(
+                "heatmap", props, factory, prepare=partial(prepare_heatmap, config)
+            )
 
         for props in config["spikeplot"]:
             if props["add_traceplot"]:
-                track = SpikePlotTraceGroup(config, self.selected_intervals, **props)
+                factory = partial(SpikePlotTraceGroup, config, self.selected_intervals)
             else:
-                track = HeadedSpikePlot(config, self.selected_intervals, **props)
-            self.widgets.append(track)
+                factory = partial(HeadedSpikePlot, config, self.selected_intervals)
+            self.add_widget(
+                "spikeplot", props, factory, prepare=partial(prepare_spikeplot, config)
+            )
 
         for props in config["traceplot"]:
-            track = HeadedTracePlot(config, **props)
-            self.widgets.append(track)
+            self.add_widget("traceplot", props, partial(HeadedTracePlot, config))
 
         for props in config["annotator"]:
+            # annotations are small and can be edited, so they are not cached
             track = HeadedAnnotator(config, **props)
             self.widgets.append(track)
-
-        for w in self.widgets + self.overlays:
-            self.timeline.toggle_units_signal.connect(w.update_time_unit)
+            self.setup_widget(track)
+
+        # coalesce range changes so they are applied at most once per display
+        # refresh, and render a full-quality pass once the interaction settles
+        refresh_rate = QApplication.primaryScreen().refreshRate()
+        self.range_update_timer = QTimer(self)
+        self.range_update_timer.setSingleShot(True)
+        self.range_update_timer.setInterval(int(1000 / max(refresh_rate, 1)))
+        self.range_update_timer.timeout.connect(self.apply_pending_range)
+        self.interaction_timer = QTimer(self)
+        self.interaction_timer.setSingleShot(True)
+        self.interaction_timer.setInterval(config["interaction_settle_time"])
+        self.interaction_timer.timeout.connect(self.end_interaction)
 
         self.initUI()
 
+    def setup_widget(self, widget):
+        self.timeline.toggle_units_signal.connect(widget.update_time_unit)
+        widget.update_time_unit(self.timeline.show_min_step)
+        widget.update_current_range(self.current_range)
+        for w in self.overlays:
+            w.raise_()
+
     def _time_to_position(self, t):
         p = time_to_position(self.current_range, self.width(), t)
         return p
@@ -81,43 +109,73 @@ class TrackStack(Stack):
             w.raise_()
 
     def wheelEvent(self, event):
+        # accumulate on top of any range change that has not been applied yet
+        if self.pending_range is not None:
+            current_range = self.pending_range
+        else:
+            current_range = self.current_range
+
         if np.abs(event.angleDelta().y()) > np.abs(event.angleDelta().x()):
             # vertical motion -> zoom
-            event_t = self._position_to_time(event.x())
+            event_t = position_to_time(current_range, self.width(), event.x())
             scale_change = max(
                 1 + event.angleDelta().y() * self.zoom_gain,
-                self.min_range / (self.current_range[1] - self.current_range[0]),
+                self.min_range / (current_range[1] - current_range[0]),
             )
             new_range = [
                 max(
-                    (self.current_range[0] - event_t) * scale_change + event_t,
+                    (current_range[0] - event_t) * scale_change + event_t,
                     self.bounds[0],
                 ),
                 min(
-                    (self.current_range[1] - event_t) * scale_change + event_t,
+                    (current_range[1] - event_t) * scale_change + event_t,
                     self.bounds[1],
                 ),
             ]
-            self.update_current_range(new_range=new_range)
+            self.request_range_update(new_range)
 
         if np.abs(event.angleDelta().y()) < np.abs(event.angleDelta().x()):
             # horizontal motion -> pan
             delta_t = (
                 -event.angleDelta().x()
                 / self.width()
-                * (self.current_range[1] - self.current_range[0])
+                * (current_range[1] - current_range[0])
             )
             delta_t = np.clip(
                 delta_t,
-                self.bounds[0] - self.current_range[0],
-                self.bounds[1] - self.current_range[1],
+                self.bounds[0] - current_range[0],
+                self.bounds[1] - current_range[1],
             )
             new_range = [
-                self.current_range[0] + delta_t,
-                self.current_range[1] + delta_t,
+                current_range[0] + delta_t,
+                current_range[1] + delta_t,
             ]
+            self.request_range_update(new_range)
+
+    def request_range_update(self, new_range):
+        """Schedule a range change. Repeated requests before the next display
+        refresh are coalesced, and tracks render a cheap preview until the
+        interaction settles."""
+        self.pending_range = new_range
+        if not self.interaction_timer.isActive():
+            self.set_interacting(True)
+        self.interaction_timer.start()
+        if not self.range_update_timer.isActive():
+            self.range_update_timer.start()
+
+    def apply_pending_range(self):
+        if self.pending_range is not None:
+            new_range, self.pending_range = self.pending_range, None
             self.update_current_range(new_range=new_range)
 
+    def end_interaction(self):
+        self.apply_pending_range()
+        self.set_interacting(False)
+
+    def set_interacting(self, interacting):
+        for child in self.widgets + self.overlays:
+            child.set_interacting(interacting)
+
     def mouseMoveEvent(self, event):
         t = np.clip(self._position_to_time(event.x()), *self.bounds)
         modifiers = QApplication.keyboardModifiers()
@@ -153,7 +211,7 @@ class TrackStack(Stack):
     def selection_drag_move(self, t, mode):
         if self.selection_drag_mode == mode:
             s, e = sorted([self.selection_drag_initial_time, t])
-            self.selection_change.emit([(s, e)], [mode == 1])
+            self.selection_change.emit(np.array([[s, e]]), mode == 1)
 
     def update_current_range(self, new_range=None):
         if new_range is not None:
@@ -4,6 +4,7 @@ from PyQt5.QtGui import *
 import numpy as np
 import json
 from snub.gui.tracks import Track, TrackGroup, position_to_time
+from snub.io.annotations import AnnotationStore, load_annotations
 from snub.gui.utils import (
     IntervalIndex,
     CHECKED_ICON_PATH,
@@ -89,8 +90,8 @@ class Annotator(Track):
         **kwargs,
     ):
         super().__init__(config, **kwargs)
-        with open(data_path, "r") as f:
-            annotations = json.load(f)
+        self.store = AnnotationStore(data_path)
+        annotations = self.store.load()
         self.labels = sorted(annotations.keys())
 
         self.data_path = data_path
@@ -103,6 +104,7 @@ class Annotator(Track):
         self.drag_mode = 0  # +1 for shift-click, -1 for command-click
         self.drag_label_ix = None
         self.drag_initial_time = None
+        self.drag_span = None
 
         self.label_widget = AnnotatorLabels(
             self.labels,
@@ -111,7 +113,9 @@ class Annotator(Track):
             parent=self,
         )
         self.annotation_intervals = [IntervalIndex() for k in self.labels]
-        self._load(data_path)
+        self._set_annotations(annotations)
+        if self.store.log_length > 0:
+            self._save()
 
     def paintEvent(self, event):
         num_labels = len(self.labels)
@@ -128,12 +132,11 @@ class Annotator(Track):
 
         for ix in range(num_labels):
             y_low = section_height * ix
-            y_high = section_height * (ix + 1)
-            for s, e in self.annotation_intervals[ix].intervals:
-                s_pos = int(self._time_to_position(s))
-                e_pos = int(self._time_to_position(e))
-                if e_pos > s_pos and e_pos > 0 and s_pos < self.width():
-                    qp.drawRect(s_pos, y_low, e_pos - s_pos, y_high - y_low)
+            runs = self.annotation_intervals[ix].pixel_runs(
+                self.current_range, self.width()
+            )
+            for s_pos, e_pos in runs.tolist():
+                qp.drawRect(QRectF(s_pos, y_low, e_pos - s_pos, section_height))
 
     def update_current_range(self, current_range):
         self.current_range = current_range
@@ -176,15 +179,23 @@ class Annotator(Track):
             self.new_current_time.emit(t)
 
     def drag_end(self):
+        # every interval added (or removed) during a drag contains the initial
+        # time, so the drag amounts to a single edit spanning all of them
+        if self.autosave and self.drag_span is not None:
+            self.store.append(self.drag_mode, self.drag_label_ix, *self.drag_span)
+            if self.store.needs_compaction:
+                self._save()
         self.drag_mode = 0
         self.drag_initial_time = None
         self.drag_label_ix = None
-        if self.autosave:
-            self._save()
+        self.drag_span = None
 
     def drag_move(self, t, mode):
         if self.drag_mode == mode:
             s, e = sorted([self.drag_initial_time, t])
+            if self.drag_span is not None:
+                s, e = min(s, self.drag_span[0]), max(e, self.drag_span[1])
+            self.drag_span = (s, e)
             if mode == 1:
                 self.annotation_intervals[self.drag_label_ix].add_interval(s, e)
             elif mode == -1:
@@ -200,31 +211,38 @@ class Annotator(Track):
         t = position_to_time(self.current_range, self.width(), p)
         return np.clip(t, *self.bounds)
 
-    def _save(self, file_name=None):
-        annotations = {}
+    def _annotations(self):
+        return {
+            label: self.annotation_intervals[ix].intervals
+            for ix, label in enumerate(self.labels)
+        }
+
+    def _set_annotations(self, annotations):
         for ix, label in enumerate(self.labels):
-            annotations[label] = self.annotation_intervals[ix].intervals.tolist()
+            self.annotation_intervals[ix].set_intervals(annotations[label])
+        self.update()
+
+    def _save(self, file_name=None):
         if file_name is None:
-            file_name = self.data_path
-        with open(file_name, "w") as f:
-            json.dump(annotations, f, indent=4)
+            # compact the edit log into a new snapshot in the background
+            self.store.compact(self._annotations())
+        else:
+            annotations = {k: v.tolist() for k, v in self._annotations().items()}
+            with open(file_name, "w") as f:
+                json.dump(annotations, f, indent=4)
 
     def _load(self, file_name):
-        with open(file_name, "r") as f:
-            annotations = json.load(f)
-
-            if not set(annotations.keys()) == set(self.labels):
-                error_msg = (
-                    "The imported labels must match the labels for this widget.\n\n"
-                    f"Imported labels:\n{list(annotations.keys())} "
-                    f"\n\nRequired labels:\n{self.labels}"
-                )
-                QMessageBox.warning(self, "Error", error_msg)
-                return
-            else:
-                for ix, label in enumerate(self.labels):
-                    self.annotation_intervals[ix].set_intervals(annotations[label])
-                self.update()
+        annotations = load_annotations(file_name)
+        if not set(annotations.keys()) == set(self.labels):
+            error_msg = (
+                "The imported labels must match the labels for this widget.\n\n"
+                f"Imported labels:\n{list(annotations.keys())} "
+                f"\n\nRequired labels:\n{self.labels}"
+            )
+            QMessageBox.warning(self, "Error", error_msg)
+            return
+        else:
+            self._set_annotations(annotations)
 
     def contextMenuEvent(self, event):
         contextMenu = CustomContextMenu(self)
@@ -259,6 +277,8 @@ class Annotator(Track):
 
     def toggle_autosave(self, state):
         self.autosave = state
+        if self.autosave:
+            self._save()
 
     def toggle_update_time_on_drag(self, state):
         self.update_time_on_drag = state
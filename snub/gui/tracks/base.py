@@ -59,6 +59,7 @@ class Track(QWidget):
         self.min_step = config["min_step"]
         self.show_min_step = False
         self.show_subsecond = False
+        self.interacting = False
         self.height_ratio = height_ratio
         self.order = order
 
@@ -76,6 +77,12 @@ class Track(QWidget):
     def update_current_time(self, t):
         self.current_time = t
 
+    def set_interacting(self, interacting):
+        """Called when continuous interaction (e.g. scrolling) starts or stops.
+        Tracks that are expensive to draw can render a cheap preview while
+        ``self.interacting`` is True."""
+        self.interacting = interacting
+
     def update_time_unit(self, show_min_step):
         self.show_min_step = show_min_step
         self.update()
@@ -278,7 +285,7 @@ class LineOverlay(Track):
         qp = QPainter()
         qp.begin(self)
         qp.setRenderHint(QPainter.Antialiasing)
-        r = self._time_to_position(self.timepoint)
+        r = int(self._time_to_position(self.timepoint))
         if r > 0 and r < self.width():
             qp.drawLine(r, 0, r, self.parent().height())
             font = QFont(self.FONT, self.FONTSIZE)
@@ -361,3 +368,8 @@ class TrackGroup(Track, HeaderMixin):
     def update_current_range(self, current_range):
         for track in self.tracks.values():
             track.update_current_range(current_range)
+
+    def set_interacting(self, interacting):
+        super().set_interacting(interacting)
+        for track in self.tracks.values():
+            track.set_interacting(interacting)
@@ -7,12 +7,23 @@ import numpy as np
 import cmapy
 from numba import njit, prange
 
+from vispy.scene import SceneCanvas
+from vispy.scene.cameras import PanZoomCamera
+from vispy.scene.visuals import Image
+from vispy.visuals.transforms import STTransform
+from vispy.color import Colormap
+
 from snub.gui.tracks import Track, TracePlot, TrackGroup
 from snub.gui.utils import (
     AdjustColormapDialog,
     CHECKED_ICON_PATH,
     UNCHECKED_ICON_PATH,
     CustomContextMenu,
+    cached,
+    derived,
+    load_data,
+    data_paths,
+    get_disk_cache,
 )
 from snub.io.project import _random_color
 
@@ -24,7 +35,7 @@ def cvImage_to_Qimage(cvImage):
     return QImage(img_data, width, height, bytesPerLine, QImage.Format_RGB888)
 
 
-@njit
+@njit(nogil=True, cache=True)
 def map_heatmap_by_intervals(data, intervals, min_step):
     intervals = intervals - intervals[0, 0]
     num_cols = int(intervals[-1, 1] / min_step)
@@ -36,13 +47,214 @@ def map_heatmap_by_intervals(data, intervals, min_step):
     return output
 
 
+@njit(nogil=True, cache=True)
+def map_heatmap_block(data, starts, ends, col_start, col_end):
+    """Columns ``col_start:col_end`` of :py:func:`map_heatmap_by_intervals`, where
+    ``starts`` and ``ends`` are the interval bounds in units of ``min_step``"""
+    output = np.zeros((data.shape[0], col_end - col_start))
+    for i in range(len(starts)):
+        start = max(starts[i], col_start)
+        end = min(ends[i], col_end)
+        if start < end:
+            output[:, start - col_start : end - col_start] = data[:, i : i + 1]
+    return output
+
+
+def heatmap_values(data_path, intervals_path, min_step):
+    """Heatmap data resampled to a uniform time grid (cached). Only used by the
+    vispy backend; the qpainter backend builds its pyramid blockwise so the
+    resampled values are never held in memory."""
+    return cached(
+        ("heatmap_values", data_path, intervals_path, min_step),
+        lambda: map_heatmap_by_intervals(
+            load_data(data_path), load_data(intervals_path), min_step
+        ),
+    )
+
+
+def colorize(values, colormap, vmin, vmax):
+    """Map values to RGB using a cmapy colormap"""
+    data_scaled = np.clip((values - vmin) / (vmax - vmin), 0, 1) * 255
+    return cmapy.cmap(colormap).squeeze()[:, ::-1][data_scaled.astype(np.uint8)]
+
+
+def downsample_values(values, downsample_ratio):
+    """Average groups of ``downsample_ratio`` columns, ignoring NaNs (columns
+    that are entirely NaN stay NaN)"""
+    cols = values.shape[1] // downsample_ratio
+    if cols == 0:
+        return values
+    values = values[:, : cols * downsample_ratio].reshape(values.shape[0], cols, -1)
+    finite = np.isfinite(values)
+    counts = finite.sum(2)
+    sums = np.where(finite, values, 0).sum(2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan).astype(values.dtype)
+
+
+def build_pyramid(image_data, downsample_ratio, downsample_powers):
+    """Successively downsample an RGB image along its columns"""
+    binned_images = [image_data]
+    for i in range(downsample_powers):
+        cols = image_data.shape[1] // downsample_ratio
+        if cols > 0:
+            image_data = (
+                image_data[:, : cols * downsample_ratio]
+                .reshape(image_data.shape[0], cols, -1, 3)
+                .mean(2)
+            )
+        binned_images.append(np.uint8(image_data))
+    return binned_images
+
+
+def build_pyramid_blockwise(
+    data,
+    intervals,
+    min_step,
+    colormap,
+    vmin,
+    vmax,
+    downsample_ratio,
+    downsample_powers,
+    row_order=None,
+    block_size=64,
+):
+    """
+    Equivalent to ``build_pyramid(colorize(map_heatmap_by_intervals(data,
+    intervals, min_step), ...), ...)``, but computed on blocks of roughly
+    ``block_size`` megabytes of columns. Columns left over after downsampling
+    a block are carried into the next one, so the resampled values are never
+    held in memory all at once and peak memory is the pyramid plus one block.
+    If ``row_order`` is given, the rows of each block are put in that order.
+    """
+    bins = (intervals - intervals[0, 0]) / min_step
+    starts, ends = bins.astype(np.int64).T
+    num_rows, num_cols = data.shape[0], int(bins[-1, 1])
+
+    # allocate pyramid levels (a level that is too narrow to downsample is a
+    # copy of the previous level, as in build_pyramid)
+    widths = [num_cols]
+    for i in range(downsample_powers):
+        cols = widths[-1] // downsample_ratio
+        widths.append(cols if cols > 0 else widths[-1])
+    levels = [np.zeros((num_rows, w, 3), dtype=np.uint8) for w in widths]
+    num_levels = 1 + np.sum(np.array(widths[1:]) < np.array(widths[:-1]))
+
+    block_cols = max(int(block_size * 1e6 / max(num_rows * 8, 1)), 1)
+    positions = [0] * len(levels)
+    carry = [None] * len(levels)
+    for col_start in range(0, num_cols, block_cols):
+        col_end = min(col_start + block_cols, num_cols)
+        overlapping = np.nonzero((starts < col_end) & (ends > col_start))[0]
+        block = np.asarray(data[:, overlapping])
+        if row_order is not None:
+            block = block[row_order]
+        values = map_heatmap_block(
+            block,
+            starts[overlapping],
+            ends[overlapping],
+            col_start,
+            col_end,
+        )
+        image_data = colorize(values, colormap, vmin, vmax)
+        for k in range(num_levels):
+            if k > 0:
+                if carry[k] is not None:
+                    image_data = np.concatenate([carry[k], image_data], axis=1)
+                cols = image_data.shape[1] // downsample_ratio
+                carry[k] = image_data[:, cols * downsample_ratio :]
+                image_data = (
+                    image_data[:, : cols * downsample_ratio]
+                    .reshape(num_rows, cols, downsample_ratio, 3)
+                    .mean(2)
+                )
+            cols = image_data.shape[1]
+            levels[k][:, positions[k] : positions[k] + cols] = image_data
+            positions[k] += cols
+
+    for k in range(num_levels, len(levels)):
+        levels[k][:] = levels[k - 1]
+    return levels
+
+
+def initial_heatmap_pyramid(
+    data_path,
+    intervals_path,
+    row_order_path,
+    min_step,
+    colormap,
+    vmin,
+    vmax,
+    disk_cache=None,
+):
+    """Display pyramid of a heatmap in its initial row order (cached in memory
+    and optionally in a :py:class:`snub.gui.utils.DiskCache`)"""
+
+    def build():
+        if row_order_path is None:
+            row_order = None
+        else:
+            row_order = load_data(row_order_path)
+        return build_pyramid_blockwise(
+            load_data(data_path),
+            load_data(intervals_path),
+            min_step,
+            colormap,
+            vmin,
+            vmax,
+            HeatmapImage.downsample_ratio,
+            HeatmapImage.downsample_powers,
+            row_order=row_order,
+        )
+
+    sources = [data_path, intervals_path]
+    if row_order_path is not None:
+        sources.append(row_order_path)
+    params = (
+        min_step,
+        colormap,
+        vmin,
+        vmax,
+        HeatmapImage.downsample_ratio,
+        HeatmapImage.downsample_powers,
+    )
+    return derived("heatmap_pyramid", sources, params, build, disk_cache)
+
+
+def prepare_heatmap(config, props):
+    """Load a heatmap's data and build its display pyramid (used to hydrate
+    placeholders in the background)"""
+    for path in data_paths(props):
+        load_data(path)
+    if props.get("backend", "qpainter") == "qpainter":
+        initial_heatmap_pyramid(
+            props["data_path"],
+            props["intervals_path"],
+            props.get("row_order_path"),
+            config["min_step"],
+            props.get("colormap", "viridis"),
+            props.get("vmin", 0),
+            props.get("vmax", 1),
+            disk_cache=get_disk_cache(config),
+        )
+    else:
+        heatmap_values(props["data_path"], props["intervals_path"], config["min_step"])
+
+
 class HeatmapImage(Track):
     downsample_ratio = 3
     downsample_powers = 10
     max_display_resolution = 2000
 
     def __init__(
-        self, config, image, start_time, binsize, vertical_range=None, parent=None
+        self,
+        config,
+        image,
+        start_time,
+        binsize,
+        vertical_range=None,
+        parent=None,
+        pyramid=None,
     ):
         super().__init__(config, parent=parent)
         self.binsize = binsize
@@ -54,21 +266,25 @@ class HeatmapImage(Track):
             self.vertical_range = [0, image.shape[0]]
         else:
             self.vertical_range = vertical_range
-        self.set_image(image)
+        self.initUI()
+        if pyramid is not None:
+            self.binned_images = pyramid
+        else:
+            self.set_image(image)
+
+    def initUI(self):
+        pass
 
     def set_image(self, image_data):
-        self.binned_images = [image_data]
-        for i in range(self.downsample_powers):
-            cols = image_data.shape[1] // self.downsample_ratio
-            if cols > 0:
-                image_data = (
-                    image_data[:, : cols * self.downsample_ratio]
-                    .reshape(image_data.shape[0], cols, -1, 3)
-                    .mean(2)
-                )
-            self.binned_images.append(np.uint8(image_data))
+        self.binned_images = build_pyramid(
+            image_data, self.downsample_ratio, self.downsample_powers
+        )
 
-    def get_current_pixmap(self):
+    def set_pyramid(self, pyramid):
+        self.binned_images = pyramid
+        self.update()
+
+    def current_downsample_index(self):
         ### NOTE: CAN BE ABSTRACTED: SEE SIMILAR TIMELINE METHOD
         visible_bins = (self.current_range[1] - self.current_range[0]) / self.binsize
         downsample_ix = np.min(
@@ -76,6 +292,18 @@ class HeatmapImage(Track):
                 visible_bins / self.downsample_options < self.max_display_resolution
             )[0]
         )
+        return downsample_ix
+
+    def set_interacting(self, interacting):
+        super().set_interacting(interacting)
+        if not interacting:
+            self.update()
+
+    def get_current_pixmap(self):
+        downsample_ix = self.current_downsample_index()
+        if self.interacting:
+            # cheap preview using the next coarser level of the pyramid
+            downsample_ix = min(downsample_ix + 1, len(self.downsample_options) - 1)
         use_image_data = self.binned_images[downsample_ix]
         use_image_data = use_image_data[self.vertical_range[0] : self.vertical_range[1]]
         use_range = [
@@ -121,6 +349,113 @@ class HeatmapImage(Track):
         self.update()
 
 
+class HeatmapImageGL(HeatmapImage):
+    """
+    OpenGL alternative to :py:class:`HeatmapImage`. Each level of the downsampling
+    pyramid is uploaded to the GPU once (split into tiles that respect texture size
+    limits), the colormap is applied in the shader, and panning/zooming only changes
+    the camera transform. Changing the colormap range therefore does not require the
+    image to be rebuilt. Missing values (NaN) are kept in the textures and drawn with
+    the lowest color of the colormap. Works with software GL implementations such as
+    Mesa llvmpipe.
+    """
+
+    max_tile_width = 4096
+
+    def __init__(
+        self,
+        config,
+        image,
+        start_time,
+        binsize,
+        colormap="viridis",
+        clim=(0, 1),
+        vertical_range=None,
+        parent=None,
+    ):
+        colors = cmapy.cmap(colormap).squeeze()[:, ::-1] / 255
+        self.cmap = Colormap(colors, bad_color=colors[0])
+        self.clim = clim
+        self.tiles = []
+        super().__init__(
+            config,
+            image,
+            start_time,
+            binsize,
+            vertical_range=vertical_range,
+            parent=parent,
+        )
+
+    def initUI(self):
+        self.canvas = SceneCanvas(parent=self, show=True)
+        self.canvas.native.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.view = self.canvas.central_widget.add_view()
+        self.view.camera = PanZoomCamera(flip=(False, True, False))
+        self.view.camera.interactive = False
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.canvas.native)
+
+    def set_image(self, image_data):
+        """Upload a 2D array of (uncolored) values as a pyramid of textures"""
+        for level, tile_range, tile in self.tiles:
+            tile.parent = None
+        self.tiles = []
+        image_data = image_data.astype(np.float32)
+        for level in range(self.downsample_powers):
+            scale = self.binsize * self.downsample_options[level]
+            for col in range(0, image_data.shape[1], self.max_tile_width):
+                tile_data = image_data[:, col : col + self.max_tile_width]
+                tile_range = (
+                    self.start_time + col * scale,
+                    self.start_time + (col + tile_data.shape[1]) * scale,
+                )
+                tile = Image(
+                    tile_data,
+                    cmap=self.cmap,
+                    clim=self.clim,
+                    texture_format="auto",
+                    interpolation="nearest",
+                    parent=self.view.scene,
+                )
+                tile.transform = STTransform(
+                    scale=(scale, 1), translate=(tile_range[0], 0)
+                )
+                self.tiles.append((level, tile_range, tile))
+            image_data = downsample_values(image_data, self.downsample_ratio)
+        self.update_view()
+
+    def set_clim(self, clim):
+        self.clim = clim
+        for level, tile_range, tile in self.tiles:
+            tile.clim = clim
+        self.canvas.update()
+
+    def update_view(self):
+        downsample_ix = self.current_downsample_index()
+        for level, tile_range, tile in self.tiles:
+            tile.visible = (
+                level == downsample_ix
+                and tile_range[1] > self.current_range[0]
+                and tile_range[0] < self.current_range[1]
+            )
+        self.view.camera.set_range(
+            x=self.current_range, y=self.vertical_range, margin=0
+        )
+        self.canvas.update()
+
+    def update_current_range(self, current_range):
+        super().update_current_range(current_range)
+        self.update_view()
+
+    def update_vertical_range(self, vrange):
+        super().update_vertical_range(vrange)
+        self.update_view()
+
+    def paintEvent(self, event):
+        self.resize(self.parent().size())
+
+
 class HeatmapLabels(QWidget):
     display_trace_signal = pyqtSignal(str)
     max_label_height = 20
@@ -254,6 +589,7 @@ class Heatmap(Track):
         vmax=1,
         add_traceplot=False,
         vertical_range=None,
+        backend="qpainter",
         **kwargs,
     ):
         super().__init__(config, **kwargs)
@@ -261,15 +597,18 @@ class Heatmap(Track):
         self.vmin, self.vmax = vmin, vmax
         self.colormap = colormap
         self.add_traceplot = add_traceplot
+        self.backend = backend
         self.min_step = config["min_step"]
+        self.data_path = data_path
+        self.intervals_path = intervals_path
 
-        self.data = np.load(data_path)
-        self.intervals = np.load(intervals_path)
+        self.data = load_data(data_path)
+        self.intervals = load_data(intervals_path)
 
         if labels_path is None:
             self.labels = [str(i) for i in range(self.data.shape[0])]
         else:
-            self.labels = open(labels_path, "r").read().split("\n")
+            self.labels = load_data(labels_path).split("\n")
 
         if row_colors is None:
             row_colors = [_random_color() for i in range(self.data.shape[0])]
@@ -278,7 +617,7 @@ class Heatmap(Track):
         if row_order_path is None:
             self.row_order = np.arange(self.data.shape[0])
         else:
-            self.row_order = np.load(row_order_path)
+            self.row_order = load_data(row_order_path)
 
         self.initial_row_order = self.row_order.copy()
 
@@ -290,14 +629,41 @@ class Heatmap(Track):
         self.adjust_colormap_dialog = AdjustColormapDialog(self, self.vmin, self.vmax)
         self.adjust_colormap_dialog.new_range.connect(self.update_colormap_range)
 
-        self.heatmap_image = HeatmapImage(
-            config,
-            image=self.get_image_data(),
-            start_time=self.intervals[0, 0],
-            binsize=self.min_step,
-            vertical_range=self.vertical_range,
-            parent=self,
-        )
+        if self.backend == "vispy":
+            self.heatmap_image = HeatmapImageGL(
+                config,
+                image=self.get_image_values(),
+                start_time=self.intervals[0, 0],
+                binsize=self.min_step,
+                colormap=self.colormap,
+                clim=(self.vmin, self.vmax),
+                vertical_range=self.vertical_range,
+                parent=self,
+            )
+        elif self.backend == "qpainter":
+            pyramid = initial_heatmap_pyramid(
+                data_path,
+                intervals_path,
+                row_order_path,
+                self.min_step,
+                self.colormap,
+                self.vmin,
+                self.vmax,
+                disk_cache=get_disk_cache(config),
+            )
+            self.heatmap_image = HeatmapImage(
+                config,
+                image=pyramid[0],
+                start_time=self.intervals[0, 0],
+                binsize=self.min_step,
+                vertical_range=self.vertical_range,
+                parent=self,
+                pyramid=pyramid,
+            )
+        else:
+            raise AssertionError(
+                f'Invalid heatmap backend "{backend}". Must be "qpainter" or "vispy"'
+            )
 
         self.heatmap_labels = HeatmapLabels(
             self.labels,
@@ -314,6 +680,10 @@ class Heatmap(Track):
         self.current_range = current_range
         self.heatmap_image.update_current_range(current_range)
 
+    def set_interacting(self, interacting):
+        super().set_interacting(interacting)
+        self.heatmap_image.set_interacting(interacting)
+
     def contextMenuEvent(self, event):
         contextMenu = CustomContextMenu(self)
 
@@ -382,29 +752,36 @@ class Heatmap(Track):
         self.heatmap_labels.update_label_order(order)
 
     def update_image_data(self):
-        image_data = self.get_image_data()
-        self.heatmap_image.set_image(image_data)
+        if self.backend == "vispy":
+            self.heatmap_image.set_image(self.get_image_values())
+        else:
+            self.heatmap_image.set_pyramid(self.get_pyramid())
 
-    def get_image_data(self):
-        data_remapped = map_heatmap_by_intervals(
-            self.data, self.intervals, self.min_step
+    def get_image_values(self):
+        data_remapped = heatmap_values(
+            self.data_path, self.intervals_path, self.min_step
         )
-        data_scaled = (
-            np.clip(
-                (data_remapped[self.row_order] - self.vmin) / (self.vmax - self.vmin),
-                0,
-                1,
-            )
-            * 255
+        return data_remapped[self.row_order]
+
+    def get_pyramid(self):
+        return build_pyramid_blockwise(
+            self.data,
+            self.intervals,
+            self.min_step,
+            self.colormap,
+            self.vmin,
+            self.vmax,
+            self.heatmap_image.downsample_ratio,
+            self.heatmap_image.downsample_powers,
+            row_order=self.row_order,
         )
-        image_data = cmapy.cmap(self.colormap).squeeze()[:, ::-1][
-            data_scaled.astype(np.uint8)
-        ]
-        return image_data
 
     def update_colormap_range(self, vmin, vmax):
         self.vmin, self.vmax = vmin, vmax
-        self.update_image_data()
+        if self.backend == "vispy":
+            self.heatmap_image.set_clim((vmin, vmax))
+        else:
+            self.update_image_data()
 
     def show_adjust_colormap_dialog(self):
         self.adjust_colormap_dialog.show()
@@ -8,6 +8,8 @@ import cmapy
 from vispy.scene import SceneCanvas
 from vispy.scene.visuals import Markers, Line
 from snub.gui.tracks import TracePlot, TrackGroup, Heatmap
+from snub.gui.tracks.heatmap import colorize, prepare_heatmap
+from snub.gui.utils import load_data
 
 
 """
@@ -19,6 +21,15 @@ class SpikePlot(Heatmap):
 """
 
 
+def prepare_spikeplot(config, props):
+    """Load a spike plot's data and build its heatmap pyramid (used to hydrate
+    placeholders in the background)"""
+    # the firing rate heatmap is passed to `Heatmap` as `data_path`, and the
+    # spike plot's colormap is not forwarded (so the heatmap uses the default)
+    props = dict(props, data_path=props["heatmap_path"], colormap="viridis")
+    prepare_heatmap(config, props)
+
+
 class SpikePlot(Heatmap):
     def __init__(
         self,
@@ -33,7 +44,7 @@ class SpikePlot(Heatmap):
     ):
         super().__init__(config, selected_intervals, data_path=heatmap_path, **kwargs)
         self.heatmap_range = heatmap_range
-        spike_data = np.load(spikes_path)
+        spike_data = load_data(spikes_path)
         self.spike_times, self.spike_labels = spike_data[:, 0], spike_data[:, 1].astype(
             int
         )
@@ -101,18 +112,20 @@ class SpikePlot(Heatmap):
         return np.vstack((self.spike_times, ycoords)).T
 
     def spike_colors(self):
-        image_data = self.get_image_data()
-        rows = np.argsort(self.row_order)[self.spike_labels]
+        # look up the heatmap value at each spike directly, rather than
+        # resampling the whole heatmap to a uniform time grid
+        bins = (self.intervals - self.intervals[0, 0]) / self.min_step
+        starts, ends = bins.astype(np.int64).T
         cols = np.around(
             (self.spike_times - self.intervals[0, 0]) / self.min_step
         ).astype(int)
-        colors = (
-            image_data[rows, np.clip(cols, 0, image_data.shape[1] - 1)].astype(
-                np.float32
-            )
-            / 255
-        )
-        return colors
+        cols = np.clip(cols, 0, int(bins[-1, 1]) - 1)
+        ixs = np.searchsorted(starts, cols, side="right") - 1
+        valid = (ixs >= 0) & (cols < ends[np.maximum(ixs, 0)])
+        values = np.zeros(len(cols))
+        values[valid] = self.data[self.spike_labels[valid], ixs[valid]]
+        image_data = colorize(values, self.colormap, self.vmin, self.vmax)
+        return image_data.astype(np.float32) / 255
 
     def zoom_in_vertical(self):
         super().zoom_in_vertical()
@@ -3,12 +3,16 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 import pyqtgraph as pg
 import numpy as np
-import pickle
 import os
 
 from snub.gui.tracks import Track, TrackGroup
 from snub.io.project import _random_color
-from snub.gui.utils import CHECKED_ICON_PATH, UNCHECKED_ICON_PATH, CustomContextMenu
+from snub.gui.utils import (
+    CHECKED_ICON_PATH,
+    UNCHECKED_ICON_PATH,
+    CustomContextMenu,
+    load_data,
+)
 
 
 class CheckableComboBox(QComboBox):
@@ -66,6 +70,7 @@ class TracePlot(Track):
         self.trace_label_margin = trace_label_margin
         self.linewidth = linewidth
         self.bound_rois = None if len(bound_rois) == 0 else bound_rois
+        self.rois_are_bound = False
 
         self.auto_yaxis_limits = True
         self.yaxis_limits = (0, 1)
@@ -78,7 +83,7 @@ class TracePlot(Track):
         if data is not None:
             self.data = data
         else:
-            self.data = pickle.load(open(data_path, "rb"))
+            self.data = load_data(data_path)
 
         if initial_visible_traces is not None:
             self.visible_traces = set(initial_visible_traces)
@@ -210,6 +215,7 @@ class TracePlot(Track):
         self.update_controls_geometry()
 
     def bind_rois(self, roiplot):
+        self.rois_are_bound = True
         self.visible_traces_signal.connect(roiplot.update_visible_contours)
         self.visible_traces_signal.emit(self.visible_traces)
 
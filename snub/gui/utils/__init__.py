@@ -1,4 +1,5 @@
 from .interval import IntervalIndex
+from .spatial import GridIndex, rectangle_difference
 from .widgets import (
     AdjustColormapDialog,
     HeaderMixin,
@@ -7,3 +8,17 @@ from .widgets import (
     UNCHECKED_ICON_PATH,
     CustomContextMenu,
 )
+from .loading import (
+    load_data,
+    load_mmap,
+    cached,
+    derived,
+    prefetch,
+    evict,
+    data_paths,
+    DiskCache,
+    get_disk_cache,
+    FrameCache,
+    Placeholder,
+)
+from .profiling import Profiler, ProfilerWidget
@@ -11,16 +11,57 @@ def sum_by_index(x, ixs, n):
 
 
 class IntervalIndexBase:
+    """
+    Sorted set of intervals with overlap queries. Each modification increments
+    ``version`` and records the time span it affected in ``changed_span``
+    (``None`` if the whole set may have changed), so that consumers that were
+    up to date before the change can update incrementally.
+    """
+
     def __init__(self, intervals=np.empty((0, 2)), **kwargs):
         self.intervals = intervals
+        self.version = 0
+        self.changed_span = None
+        self._tree = None
+        self._monotonic = None
+
+    def record_change(self, start=None, end=None):
+        self.version += 1
+        self.changed_span = None if start is None else (start, end)
+
+    def tree(self, ref_intervals):
+        """Search tree for ``ref_intervals``, reused while the same array is
+        queried (intervals are never modified in place)"""
+        if self._tree is None or self._tree[0] is not ref_intervals:
+            self._tree = (ref_intervals, self.build_tree(ref_intervals))
+        return self._tree[1]
+
+    def build_tree(self, ref_intervals):
+        raise NotImplementedError()
+
+    def is_monotonic(self):
+        """Whether both the starts and ends of the intervals are non-decreasing
+        (e.g. consecutive time bins), so that the intervals containing any
+        location form a contiguous range (cached)"""
+        if self._monotonic is None or self._monotonic[0] is not self.intervals:
+            monotonic = np.all(np.diff(self.intervals, axis=0) >= 0)
+            self._monotonic = (self.intervals, monotonic)
+        return self._monotonic[1]
+
+    def overlapping(self, start, end):
+        """Indexes of the intervals that overlap ``[start, end]``"""
+        query_ixs, ref_ixs = self.all_overlaps_both(
+            self.intervals, np.array([[start, end]])
+        )
+        return np.unique(ref_ixs)
 
     def clear(self):
         self.intervals = np.empty((0, 2))
+        self.record_change()
 
     def set_intervals(self, intervals):
         self.clear()
-        for s, e in intervals:
-            self.add_interval(s, e)
+        self.add_intervals(intervals)
 
     def partition_intervals(self, start, end):
         ends_before = self.intervals[:, 1] < start
@@ -41,6 +82,43 @@ class IntervalIndexBase:
             merged_start, merged_end = start, end
         merged_interval = np.array([merged_start, merged_end]).reshape(1, 2)
         self.intervals = np.vstack((pre, merged_interval, post))
+        self.record_change(start, end)
+
+    def add_intervals(self, intervals):
+        """Add an ``(N,2)`` array of intervals, merging all overlaps at once"""
+        intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+        self.intervals = merge_intervals(np.vstack((self.intervals, intervals)))
+        if intervals.shape[0] > 0:
+            self.record_change(intervals[:, 0].min(), intervals[:, 1].max())
+
+    def remove_intervals(self, intervals):
+        """Remove an ``(N,2)`` array of intervals (equivalent to calling
+        :py:meth:`remove_interval` for each one, but vectorized)"""
+        removed = merge_intervals(np.asarray(intervals, dtype=float).reshape(-1, 2))
+        if removed.shape[0] == 0 or self.intervals.shape[0] == 0:
+            return
+        self.record_change(removed[0, 0], removed[-1, 1])
+        # intersect current intervals with the gaps between removed intervals
+        gaps = np.column_stack(
+            (
+                np.hstack(([-np.inf], removed[:, 1])),
+                np.hstack((removed[:, 0], [np.inf])),
+            )
+        )
+        first = np.searchsorted(gaps[:, 1], self.intervals[:, 0], side="left")
+        last = np.searchsorted(gaps[:, 0], self.intervals[:, 1], side="right")
+        counts = np.maximum(last - first, 0)
+        ixs = np.repeat(np.arange(self.intervals.shape[0]), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        gap_ixs = np.repeat(first, counts) + offsets
+        original = self.intervals[ixs]
+        starts = np.maximum(original[:, 0], gaps[gap_ixs, 0])
+        ends = np.minimum(original[:, 1], gaps[gap_ixs, 1])
+        untouched = (gaps[gap_ixs, 0] < starts) & (ends < gaps[gap_ixs, 1])
+        keep = (starts < ends) | untouched
+        self.intervals = np.column_stack((starts[keep], ends[keep]))
 
     def remove_interval(self, start, end):
         pre, intersect, post = self.partition_intervals(start, end)
@@ -52,8 +130,51 @@ class IntervalIndexBase:
             if intersect[-1, 1] > end:
                 post_intersect = np.array([end, intersect[-1, 1]])
         self.intervals = np.vstack((pre, pre_intersect, post_intersect, post))
+        self.record_change(start, end)
+
+    def coverage(self, locations):
+        """Total length of the intervals that lies before each location (assumes
+        the intervals are sorted and disjoint)"""
+        starts, ends = self.intervals[:, 0], self.intervals[:, 1]
+        cumulative_lengths = np.hstack(([0], np.cumsum(ends - starts)))
+        ixs = np.searchsorted(starts, locations, side="right") - 1
+        partial = np.clip(locations - starts[ixs], 0, (ends - starts)[ixs])
+        return np.where(ixs >= 0, cumulative_lengths[ixs] + partial, 0)
+
+    def pixel_runs(self, current_range, width):
+        """
+        Runs of pixel columns that overlap an interval when the time range
+        ``current_range`` is drawn across ``width`` pixels (assumes the
+        intervals are sorted and disjoint). Only the intervals overlapping the
+        range are considered, and intervals narrower than a pixel are merged
+        into the columns they touch, so the number of runs is at most
+        ``width``. Returns an ``(N,2)`` array of ``[first, last + 1]`` columns.
+        """
+        width = max(int(width), 0)
+        starts, ends = self.intervals[:, 0], self.intervals[:, 1]
+        lo = np.searchsorted(ends, current_range[0], side="right")
+        hi = np.searchsorted(starts, current_range[1], side="left")
+        if hi <= lo or width == 0:
+            return np.empty((0, 2), dtype=int)
+        # column k spans [edges[k], edges[k+1]) and is covered if some
+        # interval starts before its right edge and ends after its left edge
+        edges = np.linspace(*current_range, width + 1)
+        started = np.searchsorted(starts[lo:hi], edges[1:], side="left")
+        ended = np.searchsorted(ends[lo:hi], edges[:-1], side="right")
+        covered = np.hstack(([False], started > ended, [False]))
+        changes = np.flatnonzero(covered[1:] != covered[:-1])
+        return changes.reshape(-1, 2)
 
     def intersection_proportions(self, query_intervals):
+        query_lengths = query_intervals[:, 1] - query_intervals[:, 0] + 1e-10
+        if self.intervals.shape[0] == 0:
+            return np.zeros(query_intervals.shape[0])
+        if np.all(self.intervals[1:, 0] >= self.intervals[:-1, 1]):
+            # sorted and disjoint (always true for merged selections)
+            intersection_lengths = self.coverage(query_intervals[:, 1]) - self.coverage(
+                query_intervals[:, 0]
+            )
+            return intersection_lengths / query_lengths
         query_ixs, ref_ixs = self.all_overlaps_both(self.intervals, query_intervals)
         if len(query_ixs) > 0:
             intersection_starts = np.maximum(
@@ -66,7 +187,6 @@ class IntervalIndexBase:
             query_intersection_lengths = sum_by_index(
                 intersection_lengths, query_ixs, query_intervals.shape[0]
             )
-            query_lengths = query_intervals[:, 1] - query_intervals[:, 0] + 1e-10
             return query_intersection_lengths / query_lengths
         else:
             return np.zeros(query_intervals.shape[0])
@@ -75,6 +195,16 @@ class IntervalIndexBase:
         raise NotImplementedError()
 
     def intervals_containing(self, query_locations):
+        if self.is_monotonic():
+            # binary search for the range of intervals containing each location
+            first = np.searchsorted(self.intervals[:, 1], query_locations, "left")
+            last = np.searchsorted(self.intervals[:, 0], query_locations, "right")
+            counts = np.maximum(last - first, 0)
+            query_ixs = np.repeat(np.arange(len(query_locations)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            return np.repeat(first, counts) + offsets, query_ixs
         query_ixs, ref_ixs = self.all_containments_both(self.intervals, query_locations)
         valid_containments = np.all(
             [
@@ -86,6 +216,17 @@ class IntervalIndexBase:
         return ref_ixs[valid_containments], query_ixs[valid_containments]
 
 
+def merge_intervals(intervals):
+    """Sort intervals and merge those that overlap"""
+    if intervals.shape[0] == 0:
+        return np.empty((0, 2))
+    intervals = intervals[np.argsort(intervals[:, 0], kind="stable")]
+    ends = np.maximum.accumulate(intervals[:, 1])
+    group_starts = np.hstack(([True], intervals[1:, 0] > ends[:-1]))
+    group_ends = np.hstack((group_starts[1:], [True]))
+    return np.column_stack((intervals[group_starts, 0], ends[group_ends]))
+
+
 try:
     from ncls import NCLS
 
@@ -105,18 +246,18 @@ try:
                 np.arange(intervals_discretized.shape[0]),
             )
 
+        def build_tree(self, ref_intervals):
+            return NCLS(*self.preprocess_for_ncls(ref_intervals))
+
         def all_containments_both(self, ref_intervals, query_locations):
             query_locations = (query_locations / self.min_step).astype(int)
-            ncls = NCLS(*self.preprocess_for_ncls(ref_intervals))
-            return ncls.all_containments_both(
+            return self.tree(ref_intervals).all_containments_both(
                 query_locations, query_locations, np.arange(len(query_locations))
             )
 
         def all_overlaps_both(self, ref_intervals, query_intervals):
             query_intervals = self.preprocess_for_ncls(query_intervals)
-            ref_intervals = self.preprocess_for_ncls(ref_intervals)
-            ncls = NCLS(*ref_intervals)
-            return ncls.all_overlaps_both(*query_intervals)
+            return self.tree(ref_intervals).all_overlaps_both(*query_intervals)
 
 except:
     from interlap import InterLap
@@ -125,10 +266,13 @@ except:
         def __init__(self, **kwargs):
             super().__init__(**kwargs)
 
-        def all_overlaps_both(self, ref_intervals, query_intervals):
-            inter = InterLap(
+        def build_tree(self, ref_intervals):
+            return InterLap(
                 ranges=[(s, e, i) for i, (s, e) in enumerate(ref_intervals)]
             )
+
+        def all_overlaps_both(self, ref_intervals, query_intervals):
+            inter = self.tree(ref_intervals)
             query_ixs, ref_ixs = [], []
             for i, (s, e) in enumerate(query_intervals):
                 overlap_ixs = [interval[2] for interval in inter.find((s, e))]
@@ -0,0 +1,463 @@
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from scipy.sparse import load_npz
+import threading
+import traceback
+import hashlib
+import pickle
+import json
+import os
+import numpy as np
+from vidio import VideoReader
+
+from snub.gui.utils.widgets import HeaderMixin
+from snub.io.hdf5 import is_dataset_reference, parse_dataset_reference, read_dataset
+
+DATA_EXTENSIONS = (".npy", ".npz", ".p", ".txt")
+
+_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def cached(key, func, *args, **kwargs):
+    """
+    Return ``func(*args, **kwargs)``, memoized under ``key``. Thread-safe: if the
+    value is currently being computed in another thread (e.g. by a background
+    prefetch), wait for that computation rather than repeating it.
+    """
+    with _cache_lock:
+        future = _cache.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _cache[key] = future
+    if owner:
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            with _cache_lock:
+                _cache.pop(key, None)
+            future.set_exception(e)
+    return future.result()
+
+
+def derived(name, sources, params, func, disk_cache=None):
+    """
+    Return ``func()``, where ``func`` computes data derived from the files in
+    ``sources`` using parameters ``params``. The result is memoized (see
+    :py:func:`cached`) and, if a :py:class:`DiskCache` is given, also stored on
+    disk so that it can be reused the next time the project is opened.
+    """
+    key = (name,) + tuple(sources) + tuple(params)
+    if disk_cache is None:
+        return cached(key, func)
+    else:
+        return cached(key, disk_cache.fetch, name, sources, params, func)
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func`` in the background thread pool and return a future"""
+    return _executor.submit(func, *args, **kwargs)
+
+
+def _read_file(path):
+    if is_dataset_reference(path):
+        return read_dataset(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npy":
+        return np.load(path)
+    elif ext == ".npz":
+        return load_npz(path)
+    elif ext == ".p":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    else:
+        with open(path, "r") as f:
+            return f.read()
+
+
+def load_data(path):
+    """
+    Load a project data file, reusing the result of any previous (or ongoing)
+    load of the same path. The loader is chosen based on file extension:
+    ``.npy`` (numpy array), ``.npz`` (scipy sparse matrix), ``.p`` (pickle) and
+    anything else as text. Dataset references (see
+    :py:func:`snub.io.hdf5.dataset_reference`) are read in full from their
+    HDF5 file.
+    Returned values are shared, so they should be copied
+    before being modified in place.
+    """
+    return cached(("file", os.path.abspath(path)), _read_file, path)
+
+
+def load_mmap(path):
+    """
+    Memory-map a ``.npy`` data file (read-only), so that only the parts that are
+    accessed are read from disk. Other files are loaded with :py:func:`load_data`.
+    """
+    if not path.lower().endswith(".npy"):
+        return load_data(path)
+    return cached(("mmap", os.path.abspath(path)), np.load, path, mmap_mode="r")
+
+
+def prefetch(paths):
+    """Load each path in the background and return a future that completes when
+    all have been loaded"""
+    return submit(lambda: [load_data(path) for path in paths])
+
+
+def evict(*paths):
+    """
+    Remove cached values. If ``paths`` are given, only values computed from those
+    files (or from files within those directories) are removed, otherwise the
+    entire cache is cleared.
+    """
+    with _cache_lock:
+        if len(paths) == 0:
+            _cache.clear()
+            return
+        paths = [os.path.abspath(path) for path in paths]
+        prefixes = tuple(path + os.path.sep for path in paths)
+        for key in list(_cache.keys()):
+            for k in key[1:]:
+                if isinstance(k, str):
+                    k = os.path.abspath(k)
+                    if k in paths or k.startswith(prefixes):
+                        del _cache[key]
+                        break
+
+
+def data_paths(props):
+    """List the data files (see ``DATA_EXTENSIONS``) and HDF5 dataset references
+    in a widget's properties"""
+    paths = []
+    for k, v in props.items():
+        if k.endswith("_paths") and isinstance(v, dict):
+            vs = v.values()
+        elif k.endswith("_path") and isinstance(v, str):
+            vs = [v]
+        else:
+            continue
+        paths += [
+            p
+            for p in vs
+            if p.lower().endswith(DATA_EXTENSIONS) or is_dataset_reference(p)
+        ]
+    return paths
+
+
+class DiskCache:
+    """
+    Content-addressed store for derived data (e.g. heatmap pyramids and ROI
+    contours). Each entry is keyed on a hash of the contents of its source files
+    and the parameters used to compute it, so entries remain valid when the
+    project is moved and are ignored if a source file changes. When the total
+    size of the cache exceeds ``size_limit``, the least recently used entries
+    are deleted.
+
+    Values must be numpy arrays or lists of numpy arrays.
+
+    Parameters
+    ----------
+    directory: str
+        Directory where cached data are stored.
+
+    size_limit: float
+        Maximum size of the cache in megabytes.
+    """
+
+    def __init__(self, directory, size_limit):
+        self.directory = directory
+        self.size_limit = size_limit * 1e6
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, "file_hashes.json")
+        os.makedirs(directory, exist_ok=True)
+        try:
+            self.file_hashes = json.load(open(self.index_path, "r"))
+        except (OSError, ValueError):
+            self.file_hashes = {}
+
+    def file_hash(self, path):
+        """Hash of a file's contents (recomputed only if its size or
+        modification time has changed). For HDF5 dataset references, the
+        hash identifies the file by path, size and modification time rather
+        than by content, to avoid reading large NWB files."""
+        if is_dataset_reference(path):
+            file_path, dataset_path, transpose = parse_dataset_reference(path)
+            stat = os.stat(file_path)
+            key = repr((file_path, dataset_path, transpose, stat.st_size))
+            key += repr(stat.st_mtime_ns)
+            return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            size, mtime, digest = self.file_hashes.get(path, (None, None, None))
+        if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 24), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            with self.lock:
+                self.file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest)
+                _atomic_write(
+                    self.index_path, lambda f: f.write(json.dumps(self.file_hashes))
+                )
+        return digest
+
+    def entry_path(self, name, sources, params):
+        digests = [self.file_hash(path) for path in sources]
+        key = repr((name, digests, tuple(params))).encode()
+        digest = hashlib.blake2b(key, digest_size=16).hexdigest()
+        return os.path.join(self.directory, "{}.{}.npz".format(name, digest))
+
+    def fetch(self, name, sources, params, func):
+        """Load a cached value, or compute it with ``func`` and store it"""
+        path = self.entry_path(name, sources, params)
+        try:
+            with np.load(path) as f:
+                n = len(f.files) - 1
+                value = [f["arr_{}".format(i)] for i in range(n)]
+                if f["is_array"]:
+                    value = value[0]
+            os.utime(path)  # mark as recently used
+            return value
+        except (OSError, ValueError, KeyError):
+            pass
+        value = func()
+        is_array = isinstance(value, np.ndarray)
+        arrays = [value] if is_array else list(value)
+        try:
+            _atomic_write(
+                path,
+                lambda f: np.savez(f, *arrays, is_array=is_array),
+                mode="wb",
+            )
+            self.enforce_size_limit()
+        except OSError as e:
+            print("Could not write to cache: {}".format(e))
+        return value
+
+    def enforce_size_limit(self):
+        """Delete least recently used entries until the cache is small enough"""
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz"):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total_size <= self.size_limit:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                total_size -= size
+
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz"):
+                    os.remove(os.path.join(self.directory, name))
+
+
+_disk_caches = {}
+
+
+def get_disk_cache(config):
+    """Return the project's :py:class:`DiskCache`, or None if disk caching is
+    disabled (i.e. ``config["cache_size_limit"]`` is 0)"""
+    directory = config["cache_directory"]
+    if config["cache_size_limit"] <= 0:
+        return None
+    with _cache_lock:
+        if not directory in _disk_caches:
+            try:
+                _disk_caches[directory] = DiskCache(
+                    directory, config["cache_size_limit"]
+                )
+            except OSError as e:
+                print("Could not create cache directory: {}".format(e))
+                _disk_caches[directory] = None
+        return _disk_caches[directory]
+
+
+class FrameCache:
+    """
+    Least-recently-used cache of decoded video frames for one or more videos,
+    with read-ahead in a background thread. Frames are decoded in order by a
+    single worker, so read-ahead benefits from sequential decoding.
+
+    Parameters
+    ----------
+    video_paths: dict
+        Dictionary mapping video names to video paths.
+
+    channel: int, default=None
+        If given, only this channel of each frame is kept.
+
+    max_frames: int, default=64
+        Maximum number of frames (across all videos) retained in the cache.
+
+    read_ahead: int, default=16
+        Number of frames after the requested one to decode in the background
+        when calling :py:meth:`prefetch`.
+    """
+
+    def __init__(self, video_paths, channel=None, max_frames=64, read_ahead=16):
+        self.readers = {name: VideoReader(path) for name, path in video_paths.items()}
+        self.reader_locks = {name: threading.Lock() for name in video_paths}
+        self.channel = channel
+        self.max_frames = max_frames
+        self.read_ahead = read_ahead
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.generation = 0
+
+    def get(self, name, i):
+        """Return frame ``i`` of video ``name`` (decoding it if not cached)"""
+        key = (name, i)
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return self.frames[key]
+        with self.reader_locks[name]:
+            frame = self.readers[name][i]
+        if self.channel is not None:
+            frame = np.ascontiguousarray(frame[:, :, self.channel])
+        with self.lock:
+            self.frames[key] = frame
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+        return frame
+
+    def prefetch(self, name, i):
+        """Decode the frames following ``i`` in video ``name``, and frame ``i`` in
+        every other video, in the background. Calling this again cancels any
+        read-ahead that has not yet finished."""
+        self.generation += 1
+        self.executor.submit(self._read_ahead, name, i, self.generation)
+
+    def _read_ahead(self, name, i, generation):
+        end = min(i + self.read_ahead + 1, len(self.readers[name]))
+        keys = [(name, j) for j in range(i + 1, end)]
+        keys += [(other, i) for other in self.readers if other != name]
+        for key in keys:
+            if generation != self.generation:
+                return
+            try:
+                self.get(*key)
+            except Exception:
+                return
+
+    def close(self):
+        """Stop reading ahead and close the video readers"""
+        self.generation += 1
+        self.executor.shutdown(wait=True)
+        for name, reader in self.readers.items():
+            with self.reader_locks[name]:
+                reader.close()
+
+
+def _atomic_write(path, write, mode="w"):
+    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class Placeholder(HeaderMixin, QWidget):
+    """
+    Lightweight stand-in for a track or panel whose data is still being loaded.
+    The placeholder shows the widget's header so that the layout is final from the
+    start. Calling :py:meth:`load` runs ``prepare`` in the background thread pool
+    and emits ``loaded`` (in the GUI thread) when it finishes, after which the
+    stack replaces the placeholder with the widget returned by ``factory``.
+    Collapsed placeholders are loaded when first expanded.
+
+    Parameters
+    ----------
+    widget_type: str
+        Key of the widget in the project config (e.g. ``"heatmap"``)
+
+    props: dict
+        Widget properties from the project config
+
+    factory: callable
+        Function that constructs the widget from its properties
+
+    prepare: callable
+        Function that loads/precomputes the widget's data (run in the background)
+    """
+
+    loaded = pyqtSignal()
+
+    def __init__(self, config, widget_type, props, factory, prepare):
+        super().__init__()
+        self.widget_type = widget_type
+        self.props = props
+        self.factory = factory
+        self.prepare = prepare
+        self.future = None
+        self.error = None
+        self.order = props.get("order", 0)
+        self.size_ratio = props.get("size_ratio", 1)
+        self.height_ratio = props.get("height_ratio", 1)
+        self.layout_mode = config["layout_mode"]
+        self.status = QLabel("Loading...")
+        self.status.setAlignment(Qt.AlignCenter)
+        self.status.setStyleSheet("QLabel { color: rgb(120,120,120); }")
+        super().initUI(**props)
+        self.layout.addWidget(self.status)
+        self.update_layout()
+
+    def load(self):
+        if self.future is None:
+            self.future = submit(self.prepare, self.props)
+            self.future.add_done_callback(self._done)
+
+    def wait(self):
+        """Block until loading has finished"""
+        self.load()
+        self.error = self.future.exception()
+
+    def _done(self, future):
+        # called from a worker thread; the signal is delivered in the GUI thread
+        self.error = future.exception()
+        if self.error is not None:
+            traceback.print_exception(
+                type(self.error), self.error, self.error.__traceback__
+            )
+        try:
+            self.loaded.emit()
+        except RuntimeError:
+            pass  # the placeholder was deleted (e.g. its tab was closed)
+
+    def toggle_visiblity(self, *args):
+        super().toggle_visiblity(*args)
+        if self.is_visible:
+            self.load()
+
+    def change_layout_mode(self, layout_mode):
+        self.layout_mode = layout_mode
+        self.save_current_size()
+        self.update_layout()
+
+    def update_current_time(self, t):
+        pass
+
+    def update_current_range(self, current_range):
+        pass
+
+    def update_selected_intervals(self):
+        pass
+
+    def update_time_unit(self, show_min_step):
+        pass
+
+    def set_interacting(self, interacting):
+        pass
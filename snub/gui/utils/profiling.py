@@ -0,0 +1,209 @@
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+from collections import defaultdict, deque
+import numpy as np
+import time
+import json
+
+PROFILED_METHODS = [
+    "paintEvent",
+    "update_current_time",
+    "update_current_range",
+    "update_selected_intervals",
+]
+
+
+class Profiler:
+    """
+    Records the latency of hot-path methods (see ``PROFILED_METHODS``) for a set
+    of widgets. Methods are wrapped on the widget instances, so profiling has no
+    cost when it is not enabled.
+
+    Parameters
+    ----------
+    max_samples: int, default=10000
+        Maximum number of latencies retained for each (widget, method) pair.
+
+    max_trace_events: int, default=1000000
+        Maximum number of calls retained for trace export.
+    """
+
+    def __init__(self, max_samples=10000, max_trace_events=1000000):
+        self.max_samples = max_samples
+        self.samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.trace_events = deque(maxlen=max_trace_events)
+        self.instrumented = []
+        self.start_time = time.perf_counter()
+
+    def instrument(self, widget, name):
+        """Wrap the profiled methods of ``widget``, recording calls under ``name``"""
+        for method_name in PROFILED_METHODS:
+            if hasattr(widget, method_name):
+                original = widget.__dict__.get(method_name)
+                method = getattr(widget, method_name)
+                setattr(widget, method_name, self._wrap(method, name, method_name))
+                self.instrumented.append((widget, method_name, original))
+
+    def instrument_project(self, project_tab):
+        """Instrument every track and panel in a project tab (or any other widget,
+        including the widget itself)"""
+        from snub.gui.tracks import Track
+        from snub.gui.panels import Panel
+
+        widgets = project_tab.findChildren(Track) + project_tab.findChildren(Panel)
+        if isinstance(project_tab, (Track, Panel)):
+            widgets.insert(0, project_tab)
+        for widget in widgets:
+            self.instrument(widget, widget_name(widget))
+
+    def uninstrument(self):
+        """Restore all wrapped methods"""
+        for widget, method_name, original in self.instrumented[::-1]:
+            try:
+                if original is None:
+                    delattr(widget, method_name)
+                else:
+                    setattr(widget, method_name, original)
+            except RuntimeError:
+                pass  # widget was already deleted
+        self.instrumented = []
+
+    def _wrap(self, method, name, method_name):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(name, method_name, start, time.perf_counter())
+
+        return wrapper
+
+    def record(self, name, method_name, start, end):
+        self.samples[(name, method_name)].append(end - start)
+        self.trace_events.append((name, method_name, start, end))
+
+    def reset(self):
+        self.samples.clear()
+        self.trace_events.clear()
+
+    def histogram(self, name, method_name, bins=np.logspace(-5, 0, 26)):
+        """Histogram of call latencies (in seconds) for one widget method"""
+        return np.histogram(self.samples[(name, method_name)], bins=bins)
+
+    def summary(self):
+        """
+        Latency statistics for each profiled (widget, method) pair, sorted by
+        total time spent. Each row is ``(name, method, calls, p50, p99, total)``
+        with times in milliseconds.
+        """
+        rows = []
+        for (name, method_name), samples in self.samples.items():
+            samples = np.array(samples) * 1000
+            p50, p99 = np.percentile(samples, [50, 99])
+            rows.append((name, method_name, len(samples), p50, p99, samples.sum()))
+        return sorted(rows, key=lambda row: -row[5])
+
+    def export_chrome_trace(self, path):
+        """Save recorded calls in Chrome trace format (viewable in chrome://tracing
+        or https://ui.perfetto.dev)"""
+        thread_ids = {}
+        events = []
+        for name, method_name, start, end in self.trace_events:
+            events.append(
+                {
+                    "name": method_name,
+                    "cat": name,
+                    "ph": "X",
+                    "ts": (start - self.start_time) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": 0,
+                    "tid": thread_ids.setdefault(name, len(thread_ids)),
+                }
+            )
+        for name, tid in thread_ids.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 0,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+def widget_name(widget):
+    """Label a widget by its class and the name of its closest named ancestor"""
+    label = type(widget).__name__
+    parent = widget
+    while parent is not None:
+        if isinstance(getattr(parent, "name", None), str) and parent.name:
+            return "{} ({})".format(parent.name, label)
+        parent = parent.parent()
+    return label
+
+
+class ProfilerWidget(QDockWidget):
+    """Dockable table showing p50/p99 latency of each profiled widget method"""
+
+    columns = ["Widget", "Method", "Calls", "p50 (ms)", "p99 (ms)", "Total (ms)"]
+
+    def __init__(self, profiler, parent=None, refresh_interval=1000):
+        super().__init__("Profiling", parent)
+        self.profiler = profiler
+        self.table = QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().hide()
+
+        reset_button = QPushButton("Reset")
+        reset_button.clicked.connect(self.reset)
+        export_button = QPushButton("Export trace")
+        export_button.clicked.connect(self.export_trace)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch(0)
+        buttons.addWidget(reset_button)
+        buttons.addWidget(export_button)
+        contents = QWidget()
+        layout = QVBoxLayout(contents)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+        self.setWidget(contents)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(refresh_interval)
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        rows = self.profiler.summary()
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                if isinstance(value, float):
+                    value = "{:.2f}".format(value)
+                self.table.setItem(i, j, QTableWidgetItem(str(value)))
+
+    def reset(self):
+        self.profiler.reset()
+        self.refresh()
+
+    def export_trace(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "Export Trace", "", "JSON Files (*.json)", options=options
+        )
+        if file_name:
+            if not file_name.lower().endswith(".json"):
+                file_name += ".json"
+            try:
+                self.profiler.export_chrome_trace(file_name)
+            except Exception as e:
+                QMessageBox.warning(self, "Error", f"Failed to export trace: {str(e)}")
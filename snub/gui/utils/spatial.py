@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class GridIndex:
+    """
+    Uniform-grid spatial index for answering rectangle queries on a fixed set
+    of 2D points. Points are sorted by grid cell (row-major), so the points in
+    any horizontal run of cells form a contiguous block and a rectangle query
+    only touches the points in the cells it overlaps.
+
+    Parameters
+    ----------
+    points: ndarray
+        ``(N,2)`` array of point coordinates
+
+    points_per_cell: int, default=16
+        Average number of points per cell used to choose the grid resolution
+    """
+
+    def __init__(self, points, points_per_cell=16):
+        self.points = np.asarray(points)
+        n = max(len(self.points), 1)
+        self.n_cells = max(1, int(np.sqrt(n / points_per_cell)))
+        if len(self.points) > 0:
+            self.lo = self.points.min(0)
+            self.hi = self.points.max(0)
+        else:
+            self.lo = self.hi = np.zeros(2)
+        self.cell_size = (self.hi - self.lo) / self.n_cells
+        self.cell_size[self.cell_size == 0] = 1
+        cx, cy = self.cell_coordinates(self.points).T
+        cell_ids = cy * self.n_cells + cx
+        self.order = np.argsort(cell_ids, kind="stable")
+        self.cell_starts = np.searchsorted(
+            cell_ids[self.order], np.arange(self.n_cells**2 + 1)
+        )
+
+    def cell_coordinates(self, points):
+        cells = np.floor((points - self.lo) / self.cell_size).astype(int)
+        return np.clip(cells, 0, self.n_cells - 1).reshape(-1, 2)
+
+    def query(self, lo, hi):
+        """Indexes of points ``p`` with ``lo <= p <= hi`` (elementwise)"""
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        if np.any(hi < self.lo) or np.any(lo > self.hi) or np.any(hi < lo):
+            return np.empty(0, dtype=int)
+        (cx0, cy0), (cx1, cy1) = self.cell_coordinates(np.array([lo, hi]))
+        rows = np.arange(cy0, cy1 + 1) * self.n_cells
+        starts = self.cell_starts[rows + cx0]
+        ends = self.cell_starts[rows + cx1 + 1]
+        candidates = np.concatenate(
+            [self.order[s:e] for s, e in zip(starts, ends)] + [np.empty(0, int)]
+        )
+        xy = self.points[candidates]
+        inside = np.all((xy >= lo) & (xy <= hi), axis=1)
+        return candidates[inside]
+
+
+def rectangle_difference(new, old):
+    """
+    Split the part of rectangle ``new`` that lies outside of rectangle ``old``
+    into at most four rectangles. Rectangles are given as ``(lo, hi)`` pairs of
+    corner coordinates. Points on the boundary of ``old`` may be included in
+    the output.
+    """
+    (x0, y0), (x1, y1) = new
+    if old is None:
+        return [new]
+    (ox0, oy0), (ox1, oy1) = old
+    if ox0 > x1 or ox1 < x0 or oy0 > y1 or oy1 < y0:
+        return [new]
+    parts = []
+    if x0 < ox0:
+        parts.append(((x0, y0), (ox0, y1)))
+    if x1 > ox1:
+        parts.append(((ox1, y0), (x1, y1)))
+    mx0, mx1 = max(x0, ox0), min(x1, ox1)
+    if y0 < oy0:
+        parts.append(((mx0, y0), (mx1, oy0)))
+    if y1 > oy1:
+        parts.append(((mx0, oy1), (mx1, y1)))
+    return parts
@@ -3,3 +3,6 @@ from .manifold import *
 from .video import *
 from .plot import *
 from .nwb import *
+from .roi import *
+from .hdf5 import *
+from .annotations import *
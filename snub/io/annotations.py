@@ -0,0 +1,191 @@
+import numpy as np
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+ADD, REMOVE = 1, -1
+
+LOG_RECORD_DTYPE = np.dtype(
+    [("op", "<i4"), ("label", "<i4"), ("start", "<f8"), ("end", "<f8")]
+)
+
+
+def _log_path(path):
+    return path + ".log"
+
+
+def _add_interval(intervals, start, end):
+    """Add ``[start, end]`` to a sorted ``(N,2)`` array of disjoint intervals,
+    merging any intervals that it overlaps"""
+    keep_pre = intervals[:, 1] < start
+    keep_post = intervals[:, 0] > end
+    intersect = intervals[~(keep_pre | keep_post)]
+    if intersect.shape[0] > 0:
+        start = min(intersect[0, 0], start)
+        end = max(intersect[-1, 1], end)
+    return np.vstack((intervals[keep_pre], [[start, end]], intervals[keep_post]))
+
+
+def _remove_interval(intervals, start, end):
+    """Remove ``[start, end]`` from a sorted ``(N,2)`` array of disjoint
+    intervals, trimming any intervals that it partially overlaps"""
+    keep_pre = intervals[:, 1] < start
+    keep_post = intervals[:, 0] > end
+    intersect = intervals[~(keep_pre | keep_post)]
+    trimmed = []
+    if intersect.shape[0] > 0:
+        if intersect[0, 0] < start:
+            trimmed.append([intersect[0, 0], start])
+        if intersect[-1, 1] > end:
+            trimmed.append([end, intersect[-1, 1]])
+    return np.vstack(
+        (intervals[keep_pre], np.reshape(trimmed, (-1, 2)), intervals[keep_post])
+    )
+
+
+def read_annotation_log(path):
+    """
+    Read the edit log of an annotation file (see
+    :py:class:`snub.io.annotations.AnnotationStore`). A partially written
+    record at the end of the log (e.g. after a crash) is ignored.
+
+    Returns
+    -------
+    records: structured ndarray
+        Edits with fields ``op`` (+1 to add an interval, -1 to remove it),
+        ``label`` (index of the label in sorted order), ``start`` and ``end``.
+    """
+    log_path = _log_path(path)
+    if not os.path.exists(log_path):
+        return np.empty(0, dtype=LOG_RECORD_DTYPE)
+    count = os.path.getsize(log_path) // LOG_RECORD_DTYPE.itemsize
+    return np.fromfile(log_path, dtype=LOG_RECORD_DTYPE, count=count)
+
+
+def load_annotations(path):
+    """
+    Load annotations saved by :py:func:`snub.io.annotations.save_annotations`,
+    applying any edits that were appended to the log since the file was last
+    compacted.
+
+    Parameters
+    ----------
+    path: str
+        Path of the annotation file. Files ending in ``.json`` are read as a
+        dict mapping each label to a list of intervals; otherwise the file is
+        read as a binary (``.npz``) snapshot.
+
+    Returns
+    -------
+    annotations: dict
+        Mapping from each label to a sorted ``(N,2)`` array of intervals.
+    """
+    if path.lower().endswith(".json"):
+        with open(path, "r") as f:
+            annotations = {
+                label: np.array(intervals, dtype=float).reshape(-1, 2)
+                for label, intervals in json.load(f).items()
+            }
+    else:
+        with np.load(path) as snapshot:
+            bounds = np.hstack(([0], np.cumsum(snapshot["counts"])))
+            annotations = {
+                str(label): snapshot["intervals"][s:e]
+                for label, s, e in zip(snapshot["labels"], bounds[:-1], bounds[1:])
+            }
+    labels = sorted(annotations.keys())
+    for op, label_ix, start, end in read_annotation_log(path).tolist():
+        edit = _add_interval if op == ADD else _remove_interval
+        label = labels[label_ix]
+        annotations[label] = edit(annotations[label], start, end)
+    return annotations
+
+
+def save_annotations(path, annotations):
+    """
+    Save annotations as a snapshot and clear the edit log (see
+    :py:func:`snub.io.annotations.load_annotations`). The snapshot is written
+    to a temporary file and then moved into place, so an interrupted save
+    leaves the previous snapshot intact.
+
+    Parameters
+    ----------
+    path: str
+        Path of the annotation file. Annotations are saved in json format if
+        the path ends in ``.json`` and in binary (``.npz``) format otherwise.
+
+    annotations: dict
+        Mapping from each label to a list or ``(N,2)`` array of intervals.
+    """
+    labels = sorted(annotations.keys())
+    intervals = [np.array(annotations[l], dtype=float).reshape(-1, 2) for l in labels]
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if path.lower().endswith(".json"):
+            content = {l: ixs.tolist() for l, ixs in zip(labels, intervals)}
+            f.write(json.dumps(content, indent=4).encode())
+        else:
+            np.savez(
+                f,
+                labels=np.array(labels, dtype=str),
+                counts=np.array([len(ixs) for ixs in intervals], dtype=int),
+                intervals=np.vstack([np.empty((0, 2))] + intervals),
+            )
+    os.replace(tmp_path, path)
+    # each edit overwrites the span it covers, so replaying a log on a snapshot
+    # that already includes it has no effect, and a crash before the log is
+    # cleared is harmless
+    with open(_log_path(path), "wb"):
+        pass
+
+
+class AnnotationStore:
+    """
+    Persist annotations as a snapshot plus an append-only log of edits (see
+    :py:func:`snub.io.annotations.load_annotations`). Writes are performed in
+    order on a background thread, so callers never wait for the disk. Each edit
+    appends one fixed-size record to the log, and the snapshot is rewritten
+    (and the log cleared) by :py:meth:`compact`.
+
+    Parameters
+    ----------
+    path: str
+        Path of the annotation file.
+
+    compact_every: int, default=1000
+        Number of logged edits after which :py:attr:`needs_compaction` is true.
+    """
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.compact_every = compact_every
+        self.log_length = len(read_annotation_log(path))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def needs_compaction(self):
+        return self.log_length >= self.compact_every
+
+    def load(self):
+        return load_annotations(self.path)
+
+    def append(self, op, label_ix, start, end):
+        """Log that ``[start, end]`` was added (``op=1``) or removed (``op=-1``)
+        for the label with index ``label_ix`` in sorted order"""
+        record = np.array([(op, label_ix, start, end)], dtype=LOG_RECORD_DTYPE)
+        self.log_length += 1
+        return self.executor.submit(self._write_record, record.tobytes())
+
+    def _write_record(self, record):
+        with open(_log_path(self.path), "ab") as f:
+            f.write(record)
+
+    def compact(self, annotations):
+        """Replace the snapshot with ``annotations`` and clear the log. The
+        interval arrays must not be modified in place after calling this."""
+        self.log_length = 0
+        return self.executor.submit(save_annotations, self.path, annotations)
+
+    def flush(self):
+        """Wait for all pending writes to finish"""
+        self.executor.submit(lambda: None).result()
@@ -0,0 +1,188 @@
+import numpy as np
+import h5py
+import os
+
+REFERENCE_SEPARATOR = "::"
+
+
+def dataset_reference(file_path, dataset_path, transpose=False):
+    """
+    Create a string that refers to a dataset inside an HDF5 file (such as an
+    NWB file). References can be used in place of the data path of a heatmap
+    (see :py:func:`snub.io.project.add_heatmap`), in which case the data are
+    not copied into the project. The whole dataset is still read into memory
+    when the project is opened, so linking saves disk space but not memory.
+    Other widgets (e.g. traceplots and spikeplots) do not accept references.
+    The format is ``"<file_path>::<dataset_path>"``, with the suffix
+    ``"::T"`` if the dataset should be transposed when read.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the HDF5 file.
+
+    dataset_path: str
+        Path of the dataset within the HDF5 file (e.g.
+        ``"/processing/ophys/Fluorescence/RoiResponseSeries/data"``).
+
+    transpose: bool, default=False
+        Whether the dataset should be transposed when read.
+
+    Returns
+    -------
+    reference: str
+    """
+    parts = [os.path.realpath(file_path), dataset_path]
+    if transpose:
+        parts.append("T")
+    return REFERENCE_SEPARATOR.join(parts)
+
+
+def parse_dataset_reference(reference):
+    """
+    Split a dataset reference (see :py:func:`snub.io.hdf5.dataset_reference`)
+    into the file path, dataset path and transpose flag. Returns None if
+    ``reference`` is not a dataset reference.
+    """
+    parts = reference.split(REFERENCE_SEPARATOR)
+    if len(parts) == 2:
+        return parts[0], parts[1], False
+    elif len(parts) == 3 and parts[2] == "T":
+        return parts[0], parts[1], True
+    else:
+        return None
+
+
+def is_dataset_reference(path):
+    return isinstance(path, str) and parse_dataset_reference(path) is not None
+
+
+def block_slices(dataset, block_size=256):
+    """
+    Split the first axis of an HDF5 dataset (or any array) into slices that
+    each span roughly ``block_size`` megabytes and are aligned to the
+    dataset's chunks, so that each chunk is read from disk only once.
+    """
+    shape = dataset.shape
+    if len(shape) == 0:
+        return [slice(None)]
+    row_bytes = dataset.dtype.itemsize * int(np.prod(shape[1:]))
+    rows = max(int(block_size * 1e6 // max(row_bytes, 1)), 1)
+    chunks = getattr(dataset, "chunks", None)
+    if chunks is not None:
+        rows = max(rows // chunks[0], 1) * chunks[0]
+    return [slice(i, min(i + rows, shape[0])) for i in range(0, shape[0], rows)]
+
+
+def iter_blocks(dataset, block_size=256):
+    """Iterate over ``(slice, block)`` pairs covering the first axis of a
+    dataset (see :py:func:`snub.io.hdf5.block_slices`)"""
+    if not hasattr(dataset, "dtype"):
+        dataset = np.asarray(dataset)
+    for s in block_slices(dataset, block_size):
+        yield s, dataset[s]
+
+
+def nan_min_max(dataset, block_size=256):
+    """Minimum and maximum values of a dataset (ignoring NaNs), computed block
+    by block so that memory usage is bounded by ``block_size`` megabytes"""
+    lo, hi = np.inf, -np.inf
+    for _, block in iter_blocks(dataset, block_size):
+        if block.size > 0:
+            lo, hi = min(lo, np.nanmin(block)), max(hi, np.nanmax(block))
+    return lo, hi
+
+
+class LazyDataset:
+    """
+    Read-only view of a dataset referenced by
+    :py:func:`snub.io.hdf5.dataset_reference`. The file is opened with an
+    HDF5 chunk cache large enough to hold one block of reads, and data are
+    read in blocks that are aligned to the dataset's chunks along its first
+    axis, so memory usage is bounded by ``block_size`` plus the output.
+
+    Parameters
+    ----------
+    reference: str
+        Dataset reference.
+
+    block_size: int, default=256
+        Approximate size of each block read from the file (in megabytes).
+    """
+
+    def __init__(self, reference, block_size=256):
+        parsed = parse_dataset_reference(reference)
+        if parsed is None:
+            raise AssertionError(
+                '"{}" is not a valid dataset reference'.format(reference)
+            )
+        self.file_path, self.dataset_path, self.transpose = parsed
+        self.block_size = block_size
+        with self.open() as dataset:
+            self.stored_shape = dataset.shape
+            self.dtype = dataset.dtype
+            self.slices = block_slices(dataset, block_size)
+
+    @property
+    def shape(self):
+        return self.stored_shape[::-1] if self.transpose else self.stored_shape
+
+    def open(self):
+        return _DatasetContext(self.file_path, self.dataset_path, self.block_size * 1e6)
+
+    def blocks(self):
+        """Iterate over ``(slice, block)`` pairs covering the stored dataset"""
+        with self.open() as dataset:
+            for s in self.slices:
+                yield s, dataset[s]
+
+    def read(self):
+        """Read the whole dataset into memory (transposed if necessary)"""
+        out = np.empty(self.stored_shape, dtype=self.dtype)
+        for s, block in self.blocks():
+            out[s] = block
+        return out.T if self.transpose else out
+
+    def save(self, path):
+        """Write the dataset (transposed if necessary) to a .npy file block by
+        block, so that memory usage is bounded by ``block_size``"""
+        out = np.lib.format.open_memmap(
+            path, mode="w+", dtype=self.dtype, shape=self.shape
+        )
+        for s, block in self.blocks():
+            if self.transpose:
+                out[..., s] = block.T
+            else:
+                out[s] = block
+        out.flush()
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+    def nan_min_max(self):
+        """Minimum and maximum values (ignoring NaNs), computed block by block"""
+        with self.open() as dataset:
+            return nan_min_max(dataset, self.block_size)
+
+
+class _DatasetContext:
+    def __init__(self, file_path, dataset_path, cache_size):
+        self.file_path = file_path
+        self.dataset_path = dataset_path
+        self.cache_size = cache_size
+
+    def __enter__(self):
+        self.file = h5py.File(
+            self.file_path, "r", rdcc_nbytes=int(self.cache_size), rdcc_nslots=10007
+        )
+        return self.file[self.dataset_path]
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+def read_dataset(reference):
+    """Read the whole dataset referred to by ``reference`` into a numpy array
+    (see :py:func:`snub.io.hdf5.dataset_reference`)"""
+    return LazyDataset(reference).read()
@@ -51,6 +51,44 @@ def firing_rates(spike_times, spike_labels, window_size=0.2, window_step=0.05):
     return heatmap, (start_time - 1 / 2) * window_step
 
 
+def scatter_density(xy_coordinates, resolution=512):
+    """Count the number of points in each cell of a grid spanning a scatter plot.
+    Used to render the scatter plot as an image when it is zoomed out
+    (see :py:func:`snub.io.project.add_scatter`).
+
+    Parameters
+    ----------
+    xy_coordinates : ndarray
+        2D coordinates as a ``(N,2)`` array.
+
+    resolution: int, default=512
+        Number of grid cells along each axis.
+
+    Returns
+    -------
+    density: ndarray
+        ``(resolution,resolution)`` array of point counts, where rows
+        correspond to y-coordinates and columns to x-coordinates.
+
+    extent: ndarray
+        Boundaries ``[xmin, xmax, ymin, ymax]`` of the grid.
+    """
+    xy_coordinates = np.asarray(xy_coordinates)
+    if len(xy_coordinates) == 0:
+        return np.zeros((resolution, resolution), dtype=np.float32), np.array(
+            [0.0, 1.0, 0.0, 1.0]
+        )
+    (xmin, ymin), (xmax, ymax) = xy_coordinates.min(0), xy_coordinates.max(0)
+    xmax, ymax = max(xmax, xmin + 1e-10), max(ymax, ymin + 1e-10)
+    density = np.histogram2d(
+        xy_coordinates[:, 1],
+        xy_coordinates[:, 0],
+        bins=resolution,
+        range=[[ymin, ymax], [xmin, xmax]],
+    )[0]
+    return density.astype(np.float32), np.array([xmin, xmax, ymin, ymax])
+
+
 def bin_data(data, binsize, axis=-1, return_intervals=False):
     """Bin data using non-overlaping windows along `axis`
 
@@ -1,13 +1,44 @@
 import pynwb
+import h5py
+import functools
+import multiprocessing
 import os
+import shutil
+import tempfile
 import numpy as np
 import snub.io.project
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from snub.io.hdf5 import LazyDataset, dataset_reference, iter_blocks, nan_min_max
 from vidio import VideoReader
 
 
 EPS = 1e-6
 
 
+def _get_nwb_type_mapping(link_data=False):
+    """Map each supported NWB type to the function that adds it to a project"""
+    nwb_type_mapping = {
+        "IntervalSeries": add_interval_series,
+        "RoiResponseSeries": add_roi_response_series,
+        "TimeSeries": add_generic_timeseries,
+        "PoseEstimation": add_pose_estimation,
+        "ImageSeries": add_image_series,
+        "LabelSeries": add_label_series,
+        "TimeIntervals": add_time_intervals,
+        "Position": add_position,
+        "SpatialSeries": add_spatial_series,
+        "Units": add_ephys_units,
+        "Events": add_events,
+    }
+    if link_data:
+        for neurodata_type in ["RoiResponseSeries", "TimeSeries", "LabelSeries"]:
+            nwb_type_mapping[neurodata_type] = functools.partial(
+                nwb_type_mapping[neurodata_type], link_data=True
+            )
+    return nwb_type_mapping
+
+
 def create_project_from_nwb(
     project_directory,
     nwb_path,
@@ -15,6 +46,8 @@ def create_project_from_nwb(
     use_full_path=True,
     project_options={},
     subplot_options={},
+    link_data=False,
+    n_workers=1,
 ):
     """
     Given an NWB file and a specification of the branches of the file to be visualized,
@@ -44,21 +77,30 @@ def create_project_from_nwb(
     subplot_options, dict
         Additonal key word arguments to be passed to the specific subplot-adding functions
         as a dict mapping dataset names to dicts of options. The names should be full paths
-        if use_full_path is True, or just the names of the leaf nodes otherwise.
-    """
-    nwb_type_mapping = {
-        "IntervalSeries": add_interval_series,
-        "RoiResponseSeries": add_roi_response_series,
-        "TimeSeries": add_generic_timeseries,
-        "PoseEstimation": add_pose_estimation,
-        "ImageSeries": add_image_series,
-        "LabelSeries": add_label_series,
-        "TimeIntervals": add_time_intervals,
-        "Position": add_position,
-        "SpatialSeries": add_spatial_series,
-        "Units": add_ephys_units,
-        "Events": add_events,
-    }
+        if use_full_path is True, or just the names of the leaf nodes otherwise. For
+        Events, the option ``"raster"`` adds the events as a spikeplot instead of a
+        traceplot (see :py:func:`snub.io.nwb.add_events`).
+
+    link_data : bool, default=False
+        If True, heatmap data (from ROI response series, label series and
+        high-dimensional timeseries) are read directly from the NWB file when
+        the project is opened instead of being copied into the project
+        directory (see :py:func:`snub.io.hdf5.dataset_reference`). This
+        avoids duplicating large datasets on disk, but the NWB file must
+        remain at its current location and the data are still read into
+        memory in full when the project is opened. Other data (e.g. traces
+        and spikes) are always copied.
+
+    n_workers : int, default=1
+        Number of processes used to convert datasets in parallel (``None`` to
+        use one per CPU, capped at the number of datasets). Each process opens
+        the NWB file read-only. Worker processes are started with the "spawn"
+        method, which re-imports the calling script, so when ``n_workers > 1``
+        the call must be inside an ``if __name__ == "__main__":`` block. If
+        the worker processes fail to start, the remaining datasets are
+        converted serially.
+    """
+    nwb_type_mapping = _get_nwb_type_mapping(link_data)
 
     with pynwb.NWBHDF5IO(nwb_path, mode="r", load_namespaces=True) as io:
         nwbfile = io.read()
@@ -94,26 +136,138 @@ def create_project_from_nwb(
         )
 
         # Add data
-        for child in children:
-            name = _generate_name(child, use_full_path)
-
-            if name in subplot_options:
-                opts = subplot_options[name]
-            else:
-                opts = {}
-
+        names = [_generate_name(child, use_full_path) for child in children]
+        options = [subplot_options.get(name, {}) for name in names]
+        if n_workers is None:
+            n_workers = min(os.cpu_count() or 1, len(children))
+
+        if n_workers == 1:
+            for child, name, opts in zip(children, names, options):
+                try:  # try/except catches malformed data
+                    nwb_type_mapping[child.neurodata_type](
+                        project_directory, child, name, start_time, end_time, opts
+                    )
+                except Exception as e:
+                    print(f"Skipping data {name} because of error: {e}")
+            return
+
+        object_ids = [child.object_id for child in children]
+
+    # Convert each dataset in a separate process. Workers write to their own
+    # scratch copy of the project, which is then merged into the project in
+    # the original dataset order (so the config is never written concurrently)
+    scratch_root = tempfile.mkdtemp(prefix=".nwb_import_", dir=project_directory)
+    num_merged = 0
+    try:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+            futures = []
+            for i, (object_id, name, opts) in enumerate(
+                zip(object_ids, names, options)
+            ):
+                scratch_directory = os.path.join(scratch_root, str(i))
+                os.makedirs(scratch_directory)
+                shutil.copy(
+                    os.path.join(project_directory, "config.json"), scratch_directory
+                )
+                future = executor.submit(
+                    _convert_dataset,
+                    os.path.abspath(nwb_path),
+                    object_id,
+                    scratch_directory,
+                    name,
+                    start_time,
+                    end_time,
+                    opts,
+                    link_data,
+                )
+                futures.append((name, scratch_directory, future))
+
+            base_config = snub.io.project.load_config(project_directory)
+            for name, scratch_directory, future in futures:
+                try:  # try/except catches malformed data
+                    future.result()
+                    _merge_project(scratch_directory, project_directory, base_config)
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    print(f"Skipping data {name} because of error: {e}")
+                num_merged += 1
+    except BrokenProcessPool:
+        pass
+    finally:
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+    # a broken pool is not a problem with the data (e.g. the workers could not
+    # import the calling script), so convert the remaining datasets serially
+    if num_merged < len(object_ids):
+        print(
+            "Warning: worker processes terminated unexpectedly (parallel conversion "
+            'requires an `if __name__ == "__main__":` guard). Converting the '
+            "remaining datasets serially."
+        )
+        remaining = list(zip(object_ids, names, options))[num_merged:]
+        for object_id, name, opts in remaining:
             try:  # try/except catches malformed data
-                nwb_type_mapping[child.neurodata_type](
-                    project_directory, child, name, start_time, end_time, opts
+                _convert_dataset(
+                    nwb_path,
+                    object_id,
+                    project_directory,
+                    name,
+                    start_time,
+                    end_time,
+                    opts,
+                    link_data,
                 )
             except Exception as e:
                 print(f"Skipping data {name} because of error: {e}")
 
 
+def _convert_dataset(
+    nwb_path,
+    object_id,
+    project_directory,
+    name,
+    start_time,
+    end_time,
+    options,
+    link_data,
+):
+    """Add one object from an NWB file to a project (run in a worker process,
+    or serially if the worker processes failed)"""
+    nwb_type_mapping = _get_nwb_type_mapping(link_data)
+    with pynwb.NWBHDF5IO(nwb_path, mode="r", load_namespaces=True) as io:
+        obj = io.read().objects[object_id]
+        nwb_type_mapping[obj.neurodata_type](
+            project_directory, obj, name, start_time, end_time, options
+        )
+
+
+def _merge_project(source_directory, project_directory, base_config):
+    """
+    Move the data files in ``source_directory`` into ``project_directory`` and
+    add the dataviews in its config, i.e. those that were added after it was
+    copied from ``base_config``.
+    """
+    source_config = snub.io.project.load_config(source_directory)
+    config = snub.io.project.load_config(project_directory)
+    for key, dataviews in source_config.items():
+        if isinstance(dataviews, list) and isinstance(base_config.get(key), list):
+            config[key] += dataviews[len(base_config[key]) :]
+    for file_name in os.listdir(source_directory):
+        if file_name != "config.json":
+            os.replace(
+                os.path.join(source_directory, file_name),
+                os.path.join(project_directory, file_name),
+            )
+    snub.io.project.save_config(project_directory, config)
+
+
 def _get_start_end_times(objects):
     """
     Given a list of objects from an NWB file, returns the earliest and latest timestamps
-    from the object or its children.
+    from the object or its children. Timestamps are read only at their endpoints, and
+    unsorted times (spike times and time intervals) are scanned in bounded-size blocks.
     """
     starts, ends = [], []
     for obj in objects:
@@ -122,16 +276,12 @@ def _get_start_end_times(objects):
         elif obj.neurodata_type == "Position":
             s, e = _get_start_end_times(obj.spatial_series.values())
         elif obj.neurodata_type == "Units":
-            s = obj.spike_times[()].min()
-            e = obj.spike_times[()].max()
+            s, e = nan_min_max(obj.spike_times.data)
         elif obj.neurodata_type == "TimeIntervals":
-            s = obj.start_time[()].min()
-            e = obj.stop_time[()].max()
+            s = nan_min_max(obj.start_time.data)[0]
+            e = nan_min_max(obj.stop_time.data)[1]
         else:
-            print(obj.neurodata_type, obj.name)
-            timestamps = get_timestamps(obj)
-            s = timestamps.min()
-            e = timestamps.max()
+            s, e = _get_timestamp_bounds(obj)
         starts.append(s)
         ends.append(e)
     return min(starts), max(ends)
@@ -172,6 +322,44 @@ def list_included_datasets(nwbfile, branches, nwb_type_mapping):
     return included_datasets
 
 
+def _get_regular_sampling(obj):
+    """Start time, rate and number of samples for a regularly sampled TimeSeries
+    or ImageSeries (i.e. one without explicit timestamps)"""
+    # Get start time
+    if "start" in obj.fields:
+        start = obj.start
+    elif "starting_time" in obj.fields:
+        start = obj.starting_time
+    else:
+        raise AssertionError(
+            f"TimeSeries {obj.name} has no start time. Cannot determine timestamps."
+        )
+
+    # Get rate
+    if "rate" not in obj.fields:
+        raise AssertionError(
+            f"TimeSeries {obj.name} has no rate. Cannot determine timestamps."
+        )
+    rate = obj.rate
+
+    # Get duration
+    if obj.neurodata_type == "ImageSeries":
+        T = len(VideoReader(obj.external_file[0]))
+    else:
+        T = len(obj.data)
+    return start, rate, T
+
+
+def _get_timestamp_bounds(obj):
+    """First and last timestamps of a TimeSeries or ImageSeries object. NWB
+    timestamps are in ascending order, so only the endpoints are read."""
+    if obj.timestamps is None:
+        start, rate, T = _get_regular_sampling(obj)
+        return float(start), float(start + (T - 1) / rate)
+    else:
+        return float(obj.timestamps[0]), float(obj.timestamps[-1])
+
+
 def get_timestamps(obj):
     """
     Get timestamps for a TimeSeries object or ImageSeries object.
@@ -182,30 +370,7 @@ def get_timestamps(obj):
         NWB TimeSeries or ImageSeries object.
     """
     if obj.timestamps is None:
-        # Get start time
-        if "start" in obj.fields:
-            start = obj.start
-        elif "starting_time" in obj.fields:
-            start = obj.starting_time
-        else:
-            raise AssertionError(
-                f"TimeSeries {obj.name} has no start time. Cannot determine timestamps."
-            )
-
-        # Get rate
-        if "rate" not in obj.fields:
-            raise AssertionError(
-                f"TimeSeries {obj.name} has no rate. Cannot determine timestamps."
-            )
-        rate = obj.rate
-
-        # Get duration
-        if obj.neurodata_type == "ImageSeries":
-            T = len(VideoReader(obj.external_file[0]))
-        else:
-            T = len(obj.data)
-
-        # Compute timestamps
+        start, rate, T = _get_regular_sampling(obj)
         stamps = start + np.arange(T) / rate
     else:
         stamps = obj.timestamps[:]
@@ -213,6 +378,52 @@ def get_timestamps(obj):
     return stamps
 
 
+def _heatmap_data(dataset, link_data):
+    """
+    Heatmap data from a (time x variables) dataset. Datasets stored in HDF5 are
+    returned as a reference to the NWB file if ``link_data=True`` and otherwise
+    as a transposed :py:class:`snub.io.hdf5.LazyDataset` (which is copied into
+    the project block by block). In-memory data are transposed directly.
+    """
+    if isinstance(dataset, h5py.Dataset):
+        reference = dataset_reference(
+            dataset.file.filename, dataset.name, transpose=True
+        )
+        return reference if link_data else LazyDataset(reference)
+    else:
+        return np.asarray(dataset).T
+
+
+def _interval_trace(starts, ends, start_time, end_time):
+    """
+    Step trace that equals 1 during each interval ``[starts[i], ends[i]]`` and
+    0 elsewhere, spanning ``start_time`` to ``end_time``.
+    """
+    n = min(len(starts), len(ends))
+    starts, ends = np.asarray(starts[:n]), np.asarray(ends[:n])
+    trace = np.zeros((4 * n + 2, 2))
+    trace[0, 0], trace[-1, 0] = start_time, end_time
+    trace[1:-1, 0] = np.column_stack([starts - EPS, starts, ends - EPS, ends]).ravel()
+    trace[1:-1, 1] = np.tile([0, 1, 1, 0], n)
+    return trace
+
+
+def _event_trace(timestamps, start_time, end_time):
+    """
+    Trace with a brief pulse (of width ``2*EPS``) at each timestamp, spanning
+    ``start_time`` to ``end_time``.
+    """
+    timestamps = np.asarray(timestamps)
+    n = len(timestamps)
+    trace = np.zeros((3 * n + 2, 2))
+    trace[0, 0], trace[-1, 0] = start_time, end_time
+    trace[1:-1, 0] = np.column_stack(
+        [timestamps - EPS, timestamps, timestamps + EPS]
+    ).ravel()
+    trace[1:-1, 1] = np.tile([0, 1, 0], n)
+    return trace
+
+
 def _timestamps_to_intervals(timestamps):
     """
     Given an array of timestamps, returns an array of intervals that are centered on the
@@ -251,30 +462,23 @@ def add_interval_series(project_directory, obj, name, start_time, end_time, opti
     data = obj.data[()]  # contains interval types numbers: + for start, - for end
 
     traces = {}
-    interval_types = set(data[data > 0])
+    interval_types = np.unique(data[data > 0])
     for i in interval_types:
-        trace = [[start_time, 0]]
         starts = timestamps[data == i]
         ends = timestamps[data == -i]
-        for start, end in zip(starts, ends):
-            trace.append([start - EPS, 0])
-            trace.append([start, 1])
-            trace.append([end - EPS, 1])
-            trace.append([end, 0])
-        trace.append([end_time, 0])
-        traces[str(i)] = np.array(trace)
+        traces[str(i)] = _interval_trace(starts, ends, start_time, end_time)
 
     snub.io.project.add_traceplot(project_directory, name, traces, **options)
 
 
 def add_roi_response_series(
-    project_directory, obj, name, start_time, end_time, options
+    project_directory, obj, name, start_time, end_time, options, link_data=False
 ):
     """
     Adds an ROI response series to a SNUB project in the form of a heatmap.
     """
     print(f'Adding ROI response series "{name}" as a heatmap.')
-    data = obj.data[()].T
+    data = _heatmap_data(obj.data, link_data)
     start_time = obj.starting_time
     binsize = 1 / obj.rate
 
@@ -329,29 +533,35 @@ def add_position(project_directory, obj, name, start_time, end_time, options):
 
 
 def add_generic_timeseries(
-    project_directory, obj, name, start_time, end_time, options, heatmap_threshold=10
+    project_directory,
+    obj,
+    name,
+    start_time,
+    end_time,
+    options,
+    heatmap_threshold=10,
+    link_data=False,
 ):
     """
     Adds a generic timeseries to a SNUB project in the form of a traceplot or heatmap,
     depending on the number of dimensions.
     """
-    data = obj.data[()]
     timestamps = get_timestamps(obj)
 
-    if len(data.shape) == 1:
-        data = data[:, None]
-
-    if data.shape[1] > heatmap_threshold:
+    if len(obj.data.shape) == 2 and obj.data.shape[1] > heatmap_threshold:
         print(f'Adding generic timeseries "{name}" as a heatmap.')
         snub.io.project.add_heatmap(
             project_directory,
             name,
-            data.T,
+            _heatmap_data(obj.data, link_data),
             time_intervals=_timestamps_to_intervals(timestamps),
             **options,
         )
     else:
         print(f'Adding generic timeseries "{name}" as a traceplot.')
+        data = obj.data[()]
+        if len(data.shape) == 1:
+            data = data[:, None]
         traces = {}
         for i in range(data.shape[1]):
             trace = np.vstack([timestamps, data[:, i]]).T
@@ -406,12 +616,14 @@ def add_image_series(project_directory, obj, name, start_time, end_time, options
             )
 
 
-def add_label_series(project_directory, obj, name, start_time, end_time, options):
+def add_label_series(
+    project_directory, obj, name, start_time, end_time, options, link_data=False
+):
     """
     Adds a label series to a SNUB project in the form of a heatmap.
     """
     print(f'Adding label series "{name}" as a heatmap.')
-    data = obj.data[()].T
+    data = _heatmap_data(obj.data, link_data)
     timestamps = get_timestamps(obj)
     labels = obj.vocabulary[:]
 
@@ -439,49 +651,64 @@ def add_time_intervals(project_directory, obj, name, start_time, end_time, optio
 
     starts = obj.start_time[()]
     ends = obj.stop_time[()]
-    trace = [[start_time, 0]]
-    for start, end in zip(starts, ends):
-        trace.append([start - EPS, 0])
-        trace.append([start, 1])
-        trace.append([end - EPS, 1])
-        trace.append([end, 0])
-    trace.append([end_time, 0])
-    traces = {"intervals": np.array(trace)}
+    traces = {"intervals": _interval_trace(starts, ends, start_time, end_time)}
     snub.io.project.add_traceplot(project_directory, name, traces, **options)
 
 
 def add_ephys_units(project_directory, obj, name, start_time, end_time, options):
     """
-    Adds ephys units to a SNUB project in the form of a spikeplot.
+    Adds ephys units to a SNUB project in the form of a spikeplot. Spike times are
+    read from the ragged ``spike_times`` column in blocks and written directly to
+    the spikeplot's data file.
     """
     print(f'Adding ephys units "{name}" as a spikeplot.')
 
-    spike_times_per_unit = obj.to_dataframe()["spike_times"]
-    spike_times = np.hstack(spike_times_per_unit)
-    spike_labels = np.hstack(
-        [np.ones(len(spikes)) * i for i, spikes in enumerate(spike_times_per_unit)]
+    spike_times = obj.spike_times.data
+    unit_ends = np.asarray(obj.spike_times_index.data[()])
+
+    spikes_path = os.path.join(project_directory, name + ".spikeplot_spikes.npy")
+    spike_data = np.lib.format.open_memmap(
+        spikes_path, mode="w+", dtype=np.float64, shape=(len(spike_times), 2)
     )
-    spike_data = np.vstack([spike_times, spike_labels]).T
+    for s, block in iter_blocks(spike_times):
+        spike_data[s, 0] = block
+        positions = np.arange(s.start, s.stop)
+        spike_data[s, 1] = np.searchsorted(unit_ends, positions, side="right")
+    spike_data.flush()
+    del spike_data
+    print(f"Saved spike data to {spikes_path}")
 
     snub.io.project.add_spikeplot(
         project_directory,
         name,
-        spike_data,
+        spikes_path,
         **options,
     )
 
 
 def add_events(project_directory, obj, name, start_time, end_time, options):
     """
-    Adds events to a SNUB project in the form of a traceplot.
-    """
-    print(f'Adding events "{name}" as a traceplot.')
-
-    trace = [(start_time, 0)]
-    for t in obj.timestamps[()]:
-        trace.append((t - EPS, 0))
-        trace.append((t, 1))
-        trace.append((t + EPS, 0))
-    trace.append((end_time, 0))
-    traces = {"events": np.array(trace)}
-    snub.io.project.add_traceplot(project_directory, name, traces, **options)
+    Adds events to a SNUB project in the form of a traceplot. Dense event streams
+    can instead be added as a single-row spikeplot by including ``"raster": True``
+    in the options for this dataset, or ``"raster": {...}`` to also pass key word
+    arguments to :py:func:`snub.io.project.add_spikeplot` (the remaining options are
+    only used for traceplots).
+    """
+    timestamps = obj.timestamps[()]
+    options = dict(options)
+    raster = options.pop("raster", False)
+
+    if raster:
+        print(f'Adding events "{name}" as a spikeplot.')
+        spike_data = np.zeros((len(timestamps), 2))
+        spike_data[:, 0] = timestamps
+        spikeplot_options = {"labels": ["events"]}
+        if isinstance(raster, dict):
+            spikeplot_options.update(raster)
+        snub.io.project.add_spikeplot(
+            project_directory, name, spike_data, **spikeplot_options
+        )
+    else:
+        print(f'Adding events "{name}" as a traceplot.')
+        traces = {"events": _event_trace(timestamps, start_time, end_time)}
+        snub.io.project.add_traceplot(project_directory, name, traces, **options)
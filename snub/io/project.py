@@ -10,6 +10,10 @@ import scipy.sparse
 from vidio import VideoReader
 
 from snub.io.video import generate_video_timestamps
+from snub.io.roi import roi_contours, save_contours
+from snub.io.manifold import scatter_density
+from snub.io.hdf5 import LazyDataset, is_dataset_reference
+from snub.io.annotations import load_annotations, save_annotations
 
 
 def generate_intervals(start_time, binsize, num_intervals):
@@ -54,6 +58,9 @@ def create_project(
     init_current_time=None,
     initial_playspeed=1,
     track_playhead=True,
+    lazy_loading=True,
+    cache_directory=".snub_cache",
+    cache_size_limit=2000,
 ):
     """Set up a new SNUB project by creating a directory and config.json file.
 
@@ -128,6 +135,22 @@ def create_project(
         Otherwise currently visible range rests while the playhead
         moves across the screen.
 
+    lazy_loading: bool, default=True
+        When True, the browser opens immediately with placeholders for
+        each widget, data are loaded in the background, and widgets
+        that are initially collapsed are only loaded when expanded.
+        When False, all data are loaded before the project is shown.
+
+    cache_directory: str, default=".snub_cache"
+        Directory (relative to the project directory) where data that
+        are derived when the project is opened (e.g. heatmap images
+        and ROI contours) are saved so they can be reused.
+
+    cache_size_limit: float, default=2000
+        Maximum size of the cache directory in megabytes. The least
+        recently used data are deleted when the limit is exceeded.
+        Set to 0 to disable caching.
+
     Returns
     -------
     config: dict
@@ -182,6 +205,9 @@ def create_project(
         "init_current_time": init_current_time,
         "initial_playspeed": initial_playspeed,
         "track_playhead": track_playhead,
+        "lazy_loading": lazy_loading,
+        "cache_directory": cache_directory,
+        "cache_size_limit": cache_size_limit,
         "video": [],
         "scatter": [],
         "pose3D": [],
@@ -251,6 +277,17 @@ def _get_named_dataview_index(config, dataview_type, name):
     return None if len(indexes) == 0 else indexes[0]
 
 
+def _project_relative_path(project_directory, path):
+    """Path relative to the project directory if the file is inside it
+    (so the project can be moved), otherwise the absolute path"""
+    path = os.path.realpath(path)
+    project_directory = os.path.realpath(project_directory)
+    if os.path.commonpath([path, project_directory]) == project_directory:
+        return os.path.relpath(path, project_directory)
+    else:
+        return path
+
+
 def _confirm_no_existing_dataview(config, dataview_type, name):
     index = _get_named_dataview_index(config, dataview_type, name)
     if index is not None:
@@ -635,6 +672,8 @@ def add_scatter(
     current_node_size=20,
     current_node_color=(255, 0, 0),
     selection_intersection_threshold=0.5,
+    max_markers=200000,
+    density_resolution=512,
     size_ratio=1,
     order=0,
     initial_visibility=True,
@@ -721,6 +760,15 @@ def add_scatter(
         required before the point is highlighted. A value of 1 means that
         the point's time interval must be fully covered.
 
+    max_markers: int, default=200000
+        Maximum number of points drawn as individual markers. When more
+        points than this are in view, the scatter plot is rendered as a
+        density image (precomputed using :py:func:`snub.io.manifold.scatter_density`)
+        and markers are only drawn once the view is zoomed in.
+
+    density_resolution: int, default=512
+        Resolution of the density image along each axis.
+
     size_ratio: int, default=1
         The relative space initially allocated to this data-view in the panel-stack.
         Spacing can also be adjusted within the browser.
@@ -781,10 +829,20 @@ def add_scatter(
     np.save(data_path_abs, data)
     print("Saving scatter plot data to " + data_path_abs)
 
+    # save point density for rendering when zoomed out
+    density, density_extent = scatter_density(xy_coordinates, density_resolution)
+    density_path = name + ".scatter_density.npy"
+    density_path_abs = os.path.join(project_directory, density_path)
+    np.save(density_path_abs, density)
+    print("Saving scatter plot density to " + density_path_abs)
+
     # add props to config
     props = {
         "name": name,
         "data_path": data_path,
+        "density_path": density_path,
+        "density_extent": density_extent.tolist(),
+        "max_markers": max_markers,
         "pointsize": pointsize,
         "linewidth": linewidth,
         "facecolor": facecolor,
@@ -832,6 +890,7 @@ def add_heatmap(
     heatmap_height_ratio=2,
     order=0,
     initial_visibility=True,
+    backend="qpainter",
 ):
     """Add a heatmap to your SNUB project.
     If plotting neural data, it is helpful to sort the rows of the heatmap
@@ -847,11 +906,17 @@ def add_heatmap(
         The name of the heatmap displayed in SNUB and used
         for editing the config file.
 
-    data : ndarray or str
+    data : ndarray, str or :py:class:`snub.io.hdf5.LazyDataset`
         2D array (or path to an array) where rows are variables and columns
         are time bins. Note that if data is given as a path, it will not be
         copied to the project directory. If you want to copy the data, load
-        it into memory and pass the array directly.
+        it into memory and pass the array directly. ``data`` can also be a
+        reference to a dataset in an HDF5 file such as an NWB file (see
+        :py:func:`snub.io.hdf5.dataset_reference`), in which case the data
+        are not copied into the project but are read into memory in full
+        from that file when the project is opened. A
+        :py:class:`snub.io.hdf5.LazyDataset` is copied into the project block
+        by block, so it does not need to fit in memory.
 
     time_intervals : ndarray, default=None
         Time interval (in seconds) associated with each column of the heatmap,
@@ -932,6 +997,13 @@ def add_heatmap(
         Whether the heatmap is initially visible when the project is opened.
         Visibility can also be toggled within the browser.
 
+    backend: {'qpainter', 'vispy'}, default='qpainter'
+        How the heatmap is rendered. ``'qpainter'`` draws a colored pixmap on
+        the CPU. ``'vispy'`` uploads the data to the GPU once and applies the
+        colormap in a shader, which makes zooming, panning and adjusting the
+        colormap range faster for large heatmaps (requires OpenGL; software
+        implementations such as Mesa llvmpipe also work).
+
     Returns
     -------
     props: dict
@@ -943,7 +1015,20 @@ def add_heatmap(
     _confirm_no_existing_dataview(config, "heatmap", name)
 
     # save heatmap data
-    if isinstance(data, str):
+    if isinstance(data, LazyDataset):
+        data_path = name + ".heatmap_data.npy"
+        save_path = os.path.join(project_directory, data_path)
+        data.save(save_path)
+        data = np.load(save_path, mmap_mode="r")
+        print(f"Saved heatmap data to {save_path}")
+    elif is_dataset_reference(data):
+        data_path = data
+        data = LazyDataset(data)
+        if len(data.shape) != 2:
+            raise AssertionError(
+                "The dataset {} must be 2D after transposition".format(data_path)
+            )
+    elif isinstance(data, str):
         if not os.path.exists(data):
             raise AssertionError('The file "{}" does not exist'.format(data))
         data_path = os.path.realpath(data)
@@ -997,10 +1082,10 @@ def add_heatmap(
     elif isinstance(sort_method, str):
         from snub.io import sort
 
-        row_order = sort(data, method=sort_method)
+        row_order = sort(np.asarray(data), method=sort_method)
     else:
         try:
-            data[sort_method]
+            np.arange(data.shape[0])[sort_method]
             row_order = sort_method
         except:
             raise AssertionError(
@@ -1011,18 +1096,24 @@ def add_heatmap(
     np.save(row_order_path_abs, row_order)
     print("Saved row order to " + row_order_path_abs)
 
-    # check that the colormap is valid
+    # check that the colormap and backend are valid
     try:
         cmapy.cmap(colormap)
     except:
         raise AssertionError(
             f'""{colormap}"" is not a valid colormap. See https://matplotlib.org/stable/gallery/color/colormap_reference.html for a list of options'
         )
+    if backend not in ["qpainter", "vispy"]:
+        raise AssertionError('`backend` must be "qpainter" or "vispy"')
+    if isinstance(data, LazyDataset):
+        data_min, data_max = data.nan_min_max()
+    else:
+        data_min, data_max = np.nanmin(data), np.nanmax(data)
     if vmin is None:
-        vmin = float(np.nanmin(data))
+        vmin = float(data_min)
         print("Set vmin to {}".format(vmin))
     if vmax is None:
-        vmax = float(np.nanmax(data))
+        vmax = float(data_max)
         print("Set vmax to {}".format(vmax))
 
     # generare random colors for traceplot or roiplot
@@ -1049,6 +1140,7 @@ def add_heatmap(
         "order": order,
         "row_colors": row_colors,
         "initial_visibility": initial_visibility,
+        "backend": backend,
     }
 
     config["heatmap"].append(props)
@@ -1102,8 +1194,9 @@ def add_spikeplot(
         Spike times and unit labels as a ``(N,2)`` array or a path to such an array. The
         first column contains the spike times (in seconds) and the second column contains
         the unit labels (as integers). Note that if spike_data is given as a path, it
-        will not be copied to the project directory. If you want to copy the data, load
-        it into memory and pass the array directly.
+        will not be copied to the project directory (and is memory-mapped rather than
+        loaded). If you want to copy the data, load it into memory and pass the array
+        directly.
 
     heatmap_range: float, default=10
         Defines the zoom-level at which the spike-view converts to a heatmap-view. The
@@ -1133,8 +1226,8 @@ def add_spikeplot(
     if isinstance(spike_data, str):
         if not os.path.exists(spike_data):
             raise AssertionError('The file "{}" does not exist'.format(spike_data))
-        spike_data = np.load(spike_data)
-        spikes_path = os.path.realpath(spike_data)
+        spikes_path = _project_relative_path(project_directory, spike_data)
+        spike_data = np.load(spike_data, mmap_mode="r")
     else:
         spikes_path = name + ".spikeplot_spikes.npy"
         save_path = os.path.join(project_directory, spikes_path)
@@ -1353,6 +1446,12 @@ def add_roiplot(
     )
     print("Saved ROIs to " + rois_path_abs)
 
+    # save roi contours
+    contours_path = name + ".roi_contours.npy"
+    contours_path_abs = os.path.join(project_directory, contours_path)
+    save_contours(contours_path_abs, roi_contours(rois, rois.shape[1:]))
+    print("Saved ROI contours to " + contours_path_abs)
+
     # confirm that all videos have the same number of frames
     videolengths = {
         name: len(VideoReader(videopath)) for name, videopath in videopaths.items()
@@ -1457,6 +1556,7 @@ def add_roiplot(
     props = {
         "name": name,
         "rois_path": rois_path,
+        "contours_path": contours_path,
         "dimensions": rois.shape[1:],
         "video_paths": videopaths_rel,
         "timestamps_path": timestamps_path_rel,
@@ -1484,12 +1584,15 @@ def add_pose3D(
     joint_labels=None,
     joint_colors=None,
     link_colors=None,
+    animal_labels=None,
+    animal_colors=None,
     floor_bounds=None,
     floor_height=0,
     floor_spacing=10,
     floor_color=(1, 1, 1, 0.5),
     joint_size=5,
     link_width=2,
+    interpolate=False,
     height_ratio=1,
     order=0,
     initial_visibility=True,
@@ -1508,7 +1611,10 @@ def add_pose3D(
     data : ndarray | str
         3D array with axes (time, keypoints, dims) containing the coordinates
         of each keypoint at each time. Use NaN values to represent missing data.
-        Can be the array itself or the relative path to a npy file.
+        Can be the array itself or the relative path to a npy file. To show
+        several animals with the same skeleton, use a 4D array with axes
+        (time, animals, keypoints, dims). All animals are drawn in one viewer
+        and can be shown or hidden individually from its context menu.
 
     time_intervals : ndarray | str, default=None
         Time interval (in seconds) associated with each pose in the data array,
@@ -1544,6 +1650,16 @@ def add_pose3D(
         Array of colors for each link. If ``link_colors=None``,
         all links are assigned the color white.
 
+    animal_labels: list of str, default=None
+        Label for each animal (only used when ``data`` is 4D). If
+        ``animal_labels=None``, the labels are generated based on the order
+        of the animals.
+
+    animal_colors: ndarray, default=None
+        Array of colors for each animal (only used when ``data`` is 4D). If
+        given, the joints and links of each animal are drawn in its color
+        instead of ``joint_colors`` and ``link_colors``.
+
     floor_bounds: (float,float,float,float), default=None
         Bounds of the floor in the format ``(xmin,xmax,ymin,ymax)``.
 
@@ -1562,6 +1678,12 @@ def add_pose3D(
     link_width: float, default=2
         Width of the links in the plot.
 
+    interpolate: bool, default=False
+        Whether to linearly interpolate keypoints between the centers of
+        neighboring frames (including across gaps between frames), which
+        gives smooth playback when the pose data has a low frame rate.
+        Interpolation can also be toggled within the browser.
+
     height_ratio: int, default=1
         The relative height initially allocated to this data-view in the panel-stack.
         Spacing can also be adjusted within the browser.
@@ -1586,13 +1708,19 @@ def add_pose3D(
     # load/save data
     if isinstance(data, str):
         data_path = data
-        data = np.load(os.path.join(project_directory, data_path))
+        data = np.load(os.path.join(project_directory, data_path), mmap_mode="r")
     else:
         data_path = name + ".pose3D_data.npy"
         data_path_abs = os.path.join(project_directory, data_path)
         np.save(data_path_abs, data)
         print("Saved 3D pose data to " + data_path_abs)
 
+    if data.ndim not in (3, 4):
+        raise AssertionError(
+            "`data` must have shape (time, keypoints, dims) or (time, animals, keypoints, dims)"
+        )
+    num_joints = data.shape[-2]
+
     # initialize/save time intervals
     if isinstance(time_intervals, str):
         intervals_path = time_intervals
@@ -1615,14 +1743,12 @@ def add_pose3D(
 
     # create/save joint labels
     if joint_labels is None:
-        joint_labels = [str(i) for i in range(data.shape[1])]
+        joint_labels = [str(i) for i in range(num_joints)]
         print("Creating joint labels based on keypoint order")
-    elif len(joint_labels) != data.shape[1]:
+    elif len(joint_labels) != num_joints:
         raise AssertionError(
-            "The length of `joint_labels` ({}) does not match the size of \
-            `data` along axis 1 ({})".format(
-                len(joint_labels), data.shape[1]
-            )
+            "The length of `joint_labels` ({}) does not match the number of \
+            keypoints in `data` ({})".format(len(joint_labels), num_joints)
         )
     elif len(set(joint_labels)) < len(joint_labels):
         print("joint labels are not unique: prepending integers")
@@ -1634,15 +1760,15 @@ def add_pose3D(
 
     # save joint colors
     if joint_colors is None:
-        joint_colors = np.ones((data.shape[1], 3))
+        joint_colors = np.ones((num_joints, 3))
         print("Assigning white color to all joints")
     elif np.max(joint_colors) > 1:
         joint_colors = np.array(joint_colors) / 255
         print("Normalizing joint colors: dividing by 255")
-    elif np.array(joint_colors).shape != (data.shape[1], 3):
+    elif np.array(joint_colors).shape != (num_joints, 3):
         raise AssertionError(
             "`joint_colors` must be array-like with shape (num_joints,3) \
-            where num_joints=data.shape[1]"
+            where num_joints is the number of keypoints in `data`"
         )
     joint_colors_path = name + ".joint_colors.npy"
     joint_colors_path_abs = os.path.join(project_directory, joint_colors_path)
@@ -1650,14 +1776,12 @@ def add_pose3D(
     print("Saved joint colors to " + joint_colors_path_abs)
 
     # save links
-    links = np.array(links, dtype=int)
+    links = np.array(links, dtype=int).reshape(-1, 2)
     if np.any(links[:, 0] == links[:, 1]):
         raise AssertionError("`links` cannot contain any self-edges")
-    if not np.all([links >= 0, links < data.shape[1]]):
+    if not np.all([links >= 0, links < num_joints]):
         raise AssertionError(
-            "Links must consist of pairs of node indexes >=0 and <{}".format(
-                data.shape[1]
-            )
+            "Links must consist of pairs of node indexes >=0 and <{}".format(num_joints)
         )
     links_path = name + ".pose3D_links.npy"
     links_path_abs = os.path.join(project_directory, links_path)
@@ -1681,6 +1805,37 @@ def add_pose3D(
     np.save(link_colors_path_abs, link_colors)
     print("Saved link colors to " + link_colors_path_abs)
 
+    # save animal labels and colors
+    animal_labels_path, animal_colors_path = None, None
+    if data.ndim == 4:
+        num_animals = data.shape[1]
+        if animal_labels is None:
+            animal_labels = [str(i) for i in range(num_animals)]
+            print("Creating animal labels based on animal order")
+        elif len(animal_labels) != num_animals:
+            raise AssertionError(
+                "The length of `animal_labels` ({}) does not match the number of \
+                animals in `data` ({})".format(len(animal_labels), num_animals)
+            )
+        animal_labels_path = name + ".animal_labels.txt"
+        animal_labels_path_abs = os.path.join(project_directory, animal_labels_path)
+        open(animal_labels_path_abs, "w").write("\n".join(animal_labels))
+        print("Saved animal labels to " + animal_labels_path_abs)
+
+        if animal_colors is not None:
+            animal_colors = np.array(animal_colors, dtype=float)
+            if animal_colors.shape != (num_animals, 3):
+                raise AssertionError(
+                    "`animal_colors` must be array-like with shape (num_animals,3)"
+                )
+            if np.max(animal_colors) > 1:
+                animal_colors = animal_colors / 255
+                print("Normalizing animal colors: dividing by 255")
+            animal_colors_path = name + ".animal_colors.npy"
+            animal_colors_path_abs = os.path.join(project_directory, animal_colors_path)
+            np.save(animal_colors_path_abs, animal_colors)
+            print("Saved animal colors to " + animal_colors_path_abs)
+
     if floor_bounds is None:
         floor_bounds = (0, 0, 0, 0)
 
@@ -1700,9 +1855,14 @@ def add_pose3D(
         "height_ratio": height_ratio,
         "joint_size": joint_size,
         "link_width": link_width,
+        "interpolate": interpolate,
         "order": order,
         "initial_visibility": initial_visibility,
     }
+    if animal_labels_path is not None:
+        props["animal_labels_path"] = animal_labels_path
+    if animal_colors_path is not None:
+        props["animal_colors_path"] = animal_colors_path
     config["pose3D"].append(props)
     print('Added 3D pose viewer "{}"\n'.format(name))
     save_config(project_directory, config)
@@ -1742,7 +1902,8 @@ def add_annotator(
 
     annotations: dict, default=None
         Initial annotations, as dict mapping class names of lists of intervals.
-        Required if `labels` is not given.
+        Required if `labels` is not given. Annotations are saved in a binary
+        format that can be read with :py:func:`snub.io.annotations.load_annotations`.
 
     label_color: (int,int,int), default=(255,255,255)
         Color of the labels superimposed on the annotator heatmap.
@@ -1783,9 +1944,9 @@ def add_annotator(
         assert len(labels) == len(set(labels)), "Labels are not unique"
         annotations = {label: [] for label in labels}
 
-    data_path = name + ".annotaton_data.json"
+    data_path = name + ".annotation_data.npz"
     save_path = os.path.join(project_directory, data_path)
-    json.dump(annotations, open(save_path, "w"))
+    save_annotations(save_path, annotations)
     print(f"Saved annotation data to {save_path}")
 
     # add props to config
@@ -1841,7 +2002,7 @@ def modify_annotator_label(
     # load data
     props = config["annotator"][index]
     data_path = os.path.join(project_directory, props["data_path"])
-    annotations = json.load(open(data_path))
+    annotations = load_annotations(data_path)
 
     # modify annotations
     if old_label is not None:
@@ -1856,7 +2017,7 @@ def modify_annotator_label(
         print(f'Added label "{new_label}" to annotator "{name}"')
 
     # save data
-    json.dump(annotations, open(data_path, "w"))
+    save_annotations(data_path, annotations)
 
 
 def remove_annotator_label(
@@ -1888,7 +2049,7 @@ def remove_annotator_label(
     # load data
     props = config["annotator"][index]
     data_path = os.path.join(project_directory, props["data_path"])
-    annotations = json.load(open(data_path))
+    annotations = load_annotations(data_path)
 
     # remove label
     if label not in annotations:
@@ -1897,4 +2058,4 @@ def remove_annotator_label(
     print(f'Removed label "{label}" from annotator "{name}"')
 
     # save data
-    json.dump(annotations, open(data_path, "w"))
\ No newline at end of file
+    save_annotations(data_path, annotations)
\ No newline at end of file
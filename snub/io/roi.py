@@ -0,0 +1,140 @@
+import numpy as np
+import scipy.sparse
+import cv2
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _single_roi_contour(indices, values, dims, threshold_max_ratio, blur_kernel):
+    # Blur and threshold the ROI within its bounding box (padded by the radius
+    # of the blur kernel so the result matches blurring the full field of view)
+    if len(indices) == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+    ys, xs = np.unravel_index(indices, dims)
+    pad = 5
+    y0, x0 = max(ys.min() - pad, 0), max(xs.min() - pad, 0)
+    y1, x1 = min(ys.max() + pad + 1, dims[0]), min(xs.max() + pad + 1, dims[1])
+    crop = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+    crop[ys - y0, xs - x0] = values
+    roi_blur = cv2.GaussianBlur(crop, (2 * pad + 1, 2 * pad + 1), blur_kernel)
+    roi_mask = roi_blur > roi_blur.max() * threshold_max_ratio
+    contours = cv2.findContours(
+        roi_mask.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
+    )[0]
+    if len(contours) == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+    xy = contours[0].reshape(-1, 2) + np.array([x0, y0])
+    return np.vstack((xy, xy[:1])).astype(np.int32)
+
+
+def roi_contours(rois, dims, threshold_max_ratio=0.2, blur_kernel=2, n_workers=None):
+    """
+    Compute a contour outlining each ROI. Each ROI is blurred and
+    thresholded within its bounding box, so memory usage scales with
+    the size of the ROIs rather than the field of view. ROIs are
+    processed in parallel using a pool of threads.
+
+    Parameters
+    ----------
+    rois: ndarray or scipy.sparse matrix
+        ROI shapes, either as an ``(N,H,W)`` array or as a sparse
+        ``(N,H*W)`` matrix (such as the ROI file saved by
+        :py:func:`snub.io.project.add_roiplot`).
+
+    dims: tuple(int,int)
+        Dimensions ``(H,W)`` of the field of view.
+
+    threshold_max_ratio: float, default=0.2
+        After blurring, pixels greater than ``threshold_max_ratio``
+        times the maximum value of the ROI are considered inside it.
+
+    blur_kernel: float, default=2
+        Standard deviation of the Gaussian blur.
+
+    n_workers: int, default=None
+        Number of threads to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    contours: list of ndarrays
+        Closed contour for each ROI as an ``(M,2)`` array of (x,y)
+        coordinates. Empty ROIs have an empty contour.
+    """
+    dims = tuple(dims)
+    rois = scipy.sparse.csr_matrix(rois.reshape(rois.shape[0], -1))
+    rois.sort_indices()
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    def contour(i):
+        start, end = rois.indptr[i], rois.indptr[i + 1]
+        return _single_roi_contour(
+            rois.indices[start:end],
+            rois.data[start:end],
+            dims,
+            threshold_max_ratio,
+            blur_kernel,
+        )
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(contour, range(rois.shape[0])))
+
+
+def save_contours(path, contours):
+    """
+    Save ROI contours as a single ``(M,3)`` array, where each row
+    contains the ROI index and (x,y) coordinates of one vertex.
+    See :py:func:`snub.io.roi.load_contours`.
+
+    Parameters
+    ----------
+    path: str
+        Path of the .npy file to save.
+
+    contours: list of ndarrays
+        Contour for each ROI (see :py:func:`snub.io.roi.roi_contours`).
+    """
+    roi_index = np.repeat(np.arange(len(contours)), [len(c) for c in contours])
+    coordinates = np.vstack([np.zeros((0, 2))] + [c.reshape(-1, 2) for c in contours])
+    np.save(path, np.column_stack((roi_index, coordinates)).astype(np.int32))
+
+
+def split_contours(data, num_rois):
+    """
+    Split contour vertices saved by :py:func:`snub.io.roi.save_contours`
+    into a list with one ``(M,2)`` array per ROI.
+
+    Parameters
+    ----------
+    data: ndarray
+        ``(M,3)`` array of ROI indexes and (x,y) coordinates
+
+    num_rois: int
+        Total number of ROIs (including those with empty contours)
+
+    Returns
+    -------
+    contours: list of ndarrays
+    """
+    bounds = np.searchsorted(data[:, 0], np.arange(num_rois + 1))
+    return [data[s:e, 1:] for s, e in zip(bounds[:-1], bounds[1:])]
+
+
+def load_contours(path, num_rois):
+    """
+    Load ROI contours saved by :py:func:`snub.io.roi.save_contours`.
+
+    Parameters
+    ----------
+    path: str
+        Path of the .npy file.
+
+    num_rois: int
+        Total number of ROIs (including those with empty contours)
+
+    Returns
+    -------
+    contours: list of ndarrays
+        Contour for each ROI as an ``(M,2)`` array of (x,y) coordinates.
+    """
+    return split_contours(np.load(path), num_rois)
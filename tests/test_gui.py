@@ -1,7 +1,35 @@
 import pytest
 import os
+import json
+import shutil
+import numpy as np
+import cmapy
+import h5py
+from PyQt5.QtCore import QEvent
 from PyQt5.QtWidgets import QApplication
+import snub.io.project
+import snub.io.hdf5
 from snub.gui.main import MainWindow
+from snub.gui.panels.pose3D import Pose3DPanel, set_marker_positions
+from vispy.scene.visuals import Markers
+from snub.gui.tracks.heatmap import (
+    HeatmapImage,
+    HeatmapImageGL,
+    Heatmap,
+    build_pyramid,
+    colorize,
+    map_heatmap_by_intervals,
+)
+from snub.gui.panels.roi import ROIPanel
+from snub.gui.panels.scatter import ScatterPanel
+from snub.gui.tracks.spike import SpikePlot
+from snub.gui.utils import loading
+from snub.gui.utils import (
+    GridIndex,
+    IntervalIndex,
+    Placeholder,
+    rectangle_difference,
+)
 
 
 @pytest.fixture(scope="module")
@@ -23,7 +51,423 @@ def main_window(qt_app, project_directory):
     return window
 
 
+@pytest.fixture
+def vispy_heatmap_project(project_directory, tmp_path):
+    """Copy of the test project where heatmaps are rendered with vispy."""
+    project_copy = os.path.join(tmp_path, "project")
+    shutil.copytree(project_directory, project_copy)
+    config_path = os.path.join(project_copy, "config.json")
+    config = json.load(open(config_path, "r"))
+    for props in config["heatmap"]:
+        props["backend"] = "vispy"
+    json.dump(config, open(config_path, "w"))
+    return project_copy
+
+
+@pytest.fixture
+def pose_panel(qt_app, tmp_path):
+    """3D pose viewer for a project with two animals and one pose per second."""
+    project_directory = os.path.join(tmp_path, "pose_project")
+    snub.io.project.create_project(project_directory, start_time=0, end_time=100)
+    data = np.random.uniform(size=(100, 2, 4, 3)).astype(np.float32)
+    snub.io.project.add_pose3D(
+        project_directory, "pose", data, links=[[0, 1]], start_time=0, binsize=1
+    )
+    window = MainWindow([project_directory])
+    window.tabs.currentWidget().finish_loading()
+    panel = window.findChildren(Pose3DPanel)[0]
+    yield panel, data
+
+
 def test_main_window_loads(qt_app, main_window):
     """Test to check if the main window loads without error."""
     main_window.show()
     assert main_window.isVisible()
+
+
+def test_vispy_heatmap_backend(qt_app, vispy_heatmap_project):
+    """Test that heatmaps can be rendered with the vispy backend (for headless
+    testing, run with a software OpenGL implementation such as Mesa llvmpipe)."""
+    window = MainWindow([vispy_heatmap_project])
+    window.show()
+    project_tab = window.tabs.currentWidget()
+    project_tab.finish_loading()
+    project_tab.trackStack.update_current_range([1, 3])
+    assert window.isVisible()
+
+
+def test_vispy_heatmap_tiles(qt_app, project_directory, monkeypatch):
+    """Test that vispy heatmap tiles have the same levels, sizes and placement as
+    the QPainter pyramid (including levels too narrow to be downsampled further),
+    and that missing values are kept in the textures rather than set to vmin."""
+    config = json.load(open(os.path.join(project_directory, "config.json")))
+    config["bounds"] = [0, 30]
+    monkeypatch.setattr(HeatmapImageGL, "max_tile_width", 16)
+    values = np.random.uniform(size=(4, 50))
+    values[1, :7] = np.nan
+    image = HeatmapImageGL(config, values, start_time=2, binsize=0.5, clim=(0, 1))
+    pyramid = build_pyramid(
+        colorize(np.nan_to_num(values, nan=0), "viridis", 0, 1),
+        image.downsample_ratio,
+        image.downsample_powers,
+    )
+
+    for level, scale in enumerate(image.binsize * image.downsample_options):
+        tiles = sorted((r, t) for l, r, t in image.tiles if l == level)
+        tile_values = np.hstack([tile._data for r, tile in tiles])
+        assert tile_values.shape == pyramid[level].shape[:2]
+        for (tile_range, tile), col in zip(tiles, range(0, 50, 16)):
+            assert np.isclose(tile_range[0], 2 + col * scale)
+            assert np.allclose(tile.transform.scale[:2], (scale, 1))
+            assert np.allclose(tile.transform.translate[:2], (tile_range[0], 0))
+        if level == 0:
+            assert np.array_equal(np.isnan(tile_values), np.isnan(values))
+            colors = colorize(np.nan_to_num(tile_values, nan=0), "viridis", 0, 1)
+            assert np.array_equal(colors, pyramid[0])
+
+    # NaNs use the colormap's bad color, so they follow changes in the range
+    image.set_clim((0.5, 2))
+    assert np.isnan(image.tiles[0][2]._data).sum() == 7
+    low_color = cmapy.cmap("viridis").squeeze()[0, ::-1] / 255
+    assert np.allclose(image.cmap.bad_color.rgb, low_color)
+
+
+def test_lazy_loading(qt_app, project_directory):
+    """Test that widgets start as placeholders and are replaced once loaded."""
+    window = MainWindow([project_directory])
+    window.show()
+    project_tab = window.tabs.currentWidget()
+    project_tab.finish_loading()
+    widgets = project_tab.panelStack.widgets + project_tab.trackStack.widgets
+    assert not any(isinstance(w, Placeholder) for w in widgets)
+    assert all(w.isVisible() for w in widgets)
+
+
+def test_close_tab_evicts_linked_data(qt_app, tmp_path):
+    """Test that closing a tab evicts cached data that was linked from a file
+    outside of the project directory."""
+    project_directory = os.path.join(tmp_path, "linked_project")
+    snub.io.project.create_project(project_directory, start_time=0, end_time=100)
+    h5_path = os.path.join(tmp_path, "data.h5")
+    with h5py.File(h5_path, "w") as f:
+        f.create_dataset("series/data", data=np.random.uniform(size=(100, 5)))
+    reference = snub.io.hdf5.dataset_reference(h5_path, "/series/data", True)
+    snub.io.project.add_heatmap(
+        project_directory, "heatmap", reference, start_time=0, binsize=1
+    )
+
+    window = MainWindow([project_directory])
+    window.tabs.currentWidget().finish_loading()
+    assert reference in window.tabs.currentWidget().data_paths
+    is_linked = lambda key: any(k == reference for k in key[1:])
+    assert any(is_linked(key) for key in loading._cache)
+
+    window.close_tab(0)
+    assert not any(is_linked(key) for key in loading._cache)
+
+
+def test_close_tab_closes_video_readers(qt_app, tmp_path):
+    """Test that closing a tab closes the video readers of its ROI plots."""
+    data_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+    project_directory = os.path.join(tmp_path, "roi_project")
+    snub.io.project.create_project(project_directory, start_time=0, end_time=10)
+    rois = np.zeros((2, 576, 640))
+    rois[0, 100:200, 100:200] = 1
+    rois[1, 300:400, 300:400] = 1
+    snub.io.project.add_roiplot(
+        project_directory,
+        "rois",
+        rois,
+        {"ir": os.path.join(data_directory, "ir_video.mp4")},
+        timestamps=os.path.join(data_directory, "video_timestamps.npy"),
+    )
+    window = MainWindow([project_directory])
+    window.tabs.currentWidget().finish_loading()
+    frames = window.findChildren(ROIPanel)[0].frames
+
+    window.close_tab(0)
+    QApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+    with pytest.raises(RuntimeError):
+        frames.executor.submit(lambda: None)
+
+
+def test_selection_update(qt_app, main_window):
+    """Test selecting and deselecting arrays of intervals."""
+    project_tab = main_window.tabs.currentWidget()
+    project_tab.update_selected_intervals(np.array([[1, 3], [5, 7], [2, 4]]), True)
+    assert np.allclose(project_tab.selected_intervals.intervals, [[1, 4], [5, 7]])
+    project_tab.update_selected_intervals(np.array([[2, 6]]), False)
+    assert np.allclose(project_tab.selected_intervals.intervals, [[1, 2], [6, 7]])
+    project_tab.deselect_all()
+    assert len(project_tab.selected_intervals.intervals) == 0
+
+
+def test_derived_data_cache(qt_app, project_directory, tmp_path):
+    """Test that derived data are cached on disk and reused when the project is
+    reopened."""
+    project_copy = os.path.join(tmp_path, "project")
+    shutil.copytree(project_directory, project_copy)
+    cache_directory = os.path.join(project_copy, ".snub_cache")
+    shutil.rmtree(cache_directory, ignore_errors=True)
+
+    window = MainWindow([project_copy])
+    window.tabs.currentWidget().finish_loading()
+    entries = [f for f in os.listdir(cache_directory) if f.endswith(".npz")]
+    assert len(entries) > 0
+
+    window.reload_data()
+    window.tabs.currentWidget().finish_loading()
+    assert sorted(f for f in os.listdir(cache_directory) if f.endswith(".npz")) == (
+        sorted(entries)
+    )
+
+
+def test_profiling_mode(qt_app, project_directory, tmp_path):
+    """Test that profiling mode records widget latencies and exports a trace."""
+    window = MainWindow([project_directory], profile=True)
+    window.show()
+    project_tab = window.tabs.currentWidget()
+    project_tab.finish_loading()
+    project_tab.update_current_time(1.0)
+    project_tab.trackStack.update_current_range([1, 3])
+    qt_app.processEvents()
+    assert len(window.profiler.summary()) > 0
+
+    trace_path = os.path.join(tmp_path, "trace.json")
+    window.profiler.export_chrome_trace(trace_path)
+    assert len(json.load(open(trace_path))["traceEvents"]) > 0
+
+    window.set_profiling(False)
+    assert len(window.profiler.instrumented) == 0
+
+
+def test_heatmap_interacting_preview(qt_app, main_window):
+    """Test the coarse heatmap preview shown during coalesced pan/zoom updates,
+    including when the view is at the coarsest level of the pyramid."""
+    project_tab = main_window.tabs.currentWidget()
+    project_tab.finish_loading()
+    track_stack = project_tab.trackStack
+    images = [
+        w for w in track_stack.findChildren(HeatmapImage) if type(w) is HeatmapImage
+    ]
+    assert len(images) > 0
+
+    track_stack.request_range_update(list(track_stack.bounds))
+    track_stack.request_range_update(list(track_stack.bounds))
+    track_stack.apply_pending_range()
+    for image in images:
+        assert image.interacting
+        assert np.allclose(image.current_range, track_stack.bounds)
+        visible_bins = np.diff(image.current_range)[0] / image.binsize
+        image.max_display_resolution = visible_bins / image.downsample_options[-2]
+        assert image.current_downsample_index() == len(image.downsample_options) - 1
+        assert not image.get_current_pixmap().isNull()
+
+    track_stack.end_interaction()
+    assert not any(image.interacting for image in images)
+
+
+def test_heatmap_reorder_qpainter(qt_app, main_window):
+    """Test that reordering rows or changing the colormap range of a qpainter
+    heatmap rebuilds its pyramid without caching the resampled values."""
+    project_tab = main_window.tabs.currentWidget()
+    project_tab.finish_loading()
+    heatmap = [w for w in project_tab.findChildren(Heatmap) if w.backend == "qpainter"][
+        0
+    ]
+    order = heatmap.row_order[::-1].copy()
+    heatmap.update_row_order(order)
+    heatmap.update_colormap_range(0.2, 0.8)
+    assert ("heatmap_values", heatmap.data_path) not in {
+        key[:2] for key in loading._cache
+    }
+
+    values = map_heatmap_by_intervals(
+        np.asarray(heatmap.data), heatmap.intervals, heatmap.min_step
+    )
+    expected = build_pyramid(
+        colorize(values[order], heatmap.colormap, 0.2, 0.8),
+        HeatmapImage.downsample_ratio,
+        HeatmapImage.downsample_powers,
+    )
+    for level, expected_level in zip(heatmap.heatmap_image.binned_images, expected):
+        assert np.abs(level.astype(int) - expected_level).max() <= 1
+
+
+def test_spike_colors(qt_app, tmp_path):
+    """Test that spike colors match the firing rate heatmap at each spike."""
+    project_directory = os.path.join(tmp_path, "spike_project")
+    snub.io.project.create_project(project_directory, start_time=0, end_time=100)
+    spike_times = np.sort(np.random.uniform(0, 100, size=500))
+    spike_data = np.vstack((spike_times, np.random.randint(0, 5, size=500))).T
+    snub.io.project.add_spikeplot(project_directory, "spikes", spike_data)
+    window = MainWindow([project_directory])
+    window.tabs.currentWidget().finish_loading()
+    spikeplot = window.findChildren(SpikePlot)[0]
+
+    values = map_heatmap_by_intervals(
+        np.asarray(spikeplot.data), spikeplot.intervals, spikeplot.min_step
+    )
+    image_data = colorize(
+        values, spikeplot.colormap, spikeplot.vmin, spikeplot.vmax
+    ).astype(np.float32)
+    cols = np.around(
+        (spikeplot.spike_times - spikeplot.intervals[0, 0]) / spikeplot.min_step
+    ).astype(int)
+    cols = np.clip(cols, 0, image_data.shape[1] - 1)
+    expected = image_data[spikeplot.spike_labels, cols] / 255
+    assert np.allclose(spikeplot.spike_colors(), expected)
+
+
+def test_pose3D_frame_blocks(pose_panel):
+    """Test that pose frames are read in blocks, that the next block is read
+    ahead in the background, and that old blocks are evicted."""
+    panel, data = pose_panel
+    panel.read_ahead, panel.max_blocks = 8, 2
+    panel.frame_blocks.clear()
+
+    assert np.array_equal(panel.get_frame(1), data[1])
+    assert list(panel.frame_blocks) == [0]
+    assert np.array_equal(panel.get_frame(4), data[4])
+    assert list(panel.frame_blocks) == [0, 8]
+    assert np.array_equal(panel.get_frame(12), data[12])
+    assert list(panel.frame_blocks) == [8, 16]
+    assert np.array_equal(panel.get_frame(17), data[17])
+    assert np.array_equal(panel.get_frame(99), data[99])
+    assert list(panel.frame_blocks) == [16, 96]
+
+    panel.update_current_time(42.5)
+    panel.update_plot()
+    assert panel.displayed_frame_index == 42
+    positions = panel.joints._data["a_position"]
+    assert np.allclose(positions, data[42].reshape(-1, 3))
+    colors = panel.joints._data["a_bg_color"]
+    assert np.allclose(colors, panel.joint_colors_visible)
+
+
+def test_set_marker_positions(qt_app):
+    """Test that moving markers keeps their colors and sizes, including when
+    falling back to ``set_data``."""
+    colors = np.random.uniform(size=(4, 4)).astype(np.float32)
+    markers = Markers()
+    markers.set_data(pos=np.zeros((4, 3)), size=7, face_color=colors)
+    for i in range(3):
+        pos = np.random.uniform(size=(4, 3)).astype(np.float32)
+        set_marker_positions(markers, pos, size=7, face_color=colors)
+        assert np.allclose(markers._data["a_position"], pos)
+        assert np.allclose(markers._data["a_bg_color"], colors)
+        assert np.allclose(markers._data["a_size"], 7)
+
+    # the number of markers changed
+    colors = np.random.uniform(size=(6, 4)).astype(np.float32)
+    pos = np.random.uniform(size=(6, 3)).astype(np.float32)
+    set_marker_positions(markers, pos, size=7, face_color=colors)
+    assert np.allclose(markers._data["a_position"], pos)
+    assert np.allclose(markers._data["a_bg_color"], colors)
+
+
+def test_pose3D_time_lookup(pose_panel):
+    """Test that the precomputed time-to-frame lookup matches searchsorted, and
+    that interpolated frames blend the neighbouring frames."""
+    panel, data = pose_panel
+    assert panel.end_lookup.dtype == np.int32
+    for t in np.random.uniform(-10, 110, 1000):
+        for table, bounds in [
+            (panel.end_lookup, panel.frame_ends),
+            (panel.center_lookup, panel.frame_centers),
+        ]:
+            assert panel.lookup(table, bounds, t) == np.searchsorted(bounds, t)
+
+    panel.toggle_interpolate(True)
+    panel.update_current_time(10.75)
+    assert np.isclose(panel.current_frame_index, 10.25)
+    frame = panel.get_interpolated_frame(panel.current_frame_index)
+    assert np.allclose(frame, 0.75 * data[10] + 0.25 * data[11])
+    panel.update_current_time(200)
+    assert panel.current_frame_index is None
+
+
+def test_pixel_runs():
+    """Test the pixel runs used to paint annotations, including sub-pixel
+    intervals, intervals outside the visible range and zero width."""
+    intervals = IntervalIndex()
+    intervals.set_intervals(
+        [[-5, -4], [0.1, 0.12], [0.13, 0.14], [2.5, 4.2], [9.99, 10.5], [20, 21]]
+    )
+    # 10 columns of width 1 spanning [0, 10]
+    runs = intervals.pixel_runs((0, 10), 10)
+    assert runs.tolist() == [[0, 1], [2, 5], [9, 10]]
+
+    rng = np.random.default_rng(0)
+    starts = np.sort(rng.uniform(-20, 120, 500))
+    intervals.set_intervals(
+        np.column_stack([starts, starts + rng.exponential(0.2, 500)])
+    )
+    for width in [0, 1, 37, 500]:
+        runs = intervals.pixel_runs((10, 90), width)
+        edges = np.linspace(10, 90, width + 1)
+        covered = np.zeros(width, dtype=bool)
+        for s, e in intervals.intervals:
+            covered |= (s < edges[1:]) & (e > edges[:-1])
+        painted = np.zeros(width, dtype=bool)
+        for s, e in runs:
+            painted[s:e] = True
+        assert np.array_equal(painted, covered)
+    assert intervals.pixel_runs((200, 300), 100).shape == (0, 2)
+
+
+def test_grid_index():
+    """Test rectangle queries against brute force, including degenerate point
+    sets where all points share a coordinate."""
+    rng = np.random.default_rng(0)
+    uniform = rng.uniform(size=(1000, 2))
+    vertical = np.column_stack([np.full(200, 0.5), rng.uniform(size=200)])
+    for points in [uniform, vertical, np.full((50, 2), 0.5), np.empty((0, 2))]:
+        index = GridIndex(points)
+        for _ in range(100):
+            lo, hi = np.sort(rng.uniform(-0.2, 1.2, size=(2, 2)), axis=0)
+            if rng.uniform() < 0.3:
+                lo[0], hi[0] = 0.5, 0.5
+            expected = np.flatnonzero(np.all((points >= lo) & (points <= hi), axis=1))
+            assert np.array_equal(np.sort(index.query(lo, hi)), expected)
+
+
+def test_rectangle_difference():
+    """Test that the parts of a rectangle outside another cover exactly that area
+    (up to the other rectangle's boundary)."""
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        new = tuple(map(tuple, np.sort(rng.uniform(size=(2, 2)), axis=0)))
+        old = tuple(map(tuple, np.sort(rng.uniform(size=(2, 2)), axis=0)))
+        points = rng.uniform(new[0], new[1], size=(200, 2))
+        in_parts = np.zeros(len(points), dtype=bool)
+        for lo, hi in rectangle_difference(new, old):
+            assert np.all(np.array(lo) >= new[0]) and np.all(np.array(hi) <= new[1])
+            in_parts |= np.all((points >= lo) & (points <= hi), axis=1)
+        inside_old = np.all((points > old[0]) & (points < old[1]), axis=1)
+        assert np.array_equal(in_parts, ~inside_old)
+    assert rectangle_difference(((0, 0), (1, 1)), None) == [((0, 0), (1, 1))]
+
+
+def test_scatter_drag_selection(qt_app, main_window):
+    """Test that a drag selection reports each enclosed point exactly once."""
+    main_window.tabs.currentWidget().finish_loading()
+    panel = main_window.findChildren(ScatterPanel)[0]
+    points = panel.data[:, :2]
+    rng = np.random.default_rng(2)
+    press_event = object()
+    start = points.mean(0)
+    reported, expected = [], np.zeros(len(points), dtype=bool)
+    for _ in range(30):
+        current = start + rng.normal(size=2) * points.std(0)
+        lo, hi = np.minimum(start, current), np.maximum(start, current)
+        reported.append(panel.newly_enclosed_points(press_event, 1, lo, hi))
+        expected |= np.all((points >= lo) & (points <= hi), axis=1)
+    reported = np.concatenate(reported)
+    assert len(reported) == len(np.unique(reported))
+    assert np.array_equal(np.sort(reported), np.flatnonzero(expected))
+
+    # a new drag starts from an empty selection
+    new_points = panel.newly_enclosed_points(object(), 1, lo, hi)
+    enclosed = np.all((points >= lo) & (points <= hi), axis=1)
+    assert np.array_equal(np.sort(new_points), np.flatnonzero(enclosed))
@@ -1,6 +1,11 @@
 import numpy as np
 import snub.io.project
 import snub.io.manifold
+import snub.io.roi
+import snub.io.hdf5
+import snub.io.annotations
+import snub.io.nwb
+import h5py
 import os
 import shutil
 import pytest
@@ -85,3 +90,161 @@ def test_add_scatter(project_directory, data_directory):
         variables=binned_behavior_annotations.T,
         variable_labels=behavior_labels,
     )
+
+
+def test_add_roiplot(project_directory, data_directory):
+    """Test snub.io.project.add_roiplot and snub.io.roi.load_contours"""
+
+    video_path = os.path.join(data_directory, "ir_video.mp4")
+    yy, xx = np.mgrid[:64, :80]
+    centers = [(10, 10), (30, 50), (60, 75)]
+    rois = np.array([np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 8) for y, x in centers])
+    rois[rois < 0.01] = 0
+
+    props = snub.io.project.add_roiplot(
+        project_directory,
+        "rois",
+        rois,
+        {"IR": video_path},
+        fps=30,
+    )
+    contours = snub.io.roi.load_contours(
+        os.path.join(project_directory, props["contours_path"]), len(rois)
+    )
+    assert len(contours) == len(rois)
+    for (y, x), contour in zip(centers, contours):
+        assert np.all(contour.min(0) < (x, y)) and np.all(contour.max(0) > (x, y))
+
+
+def test_add_heatmap_dataset_reference(project_directory, tmp_path):
+    """Test snub.io.project.add_heatmap with data linked or copied from an HDF5 file"""
+
+    data = np.random.uniform(size=(1000, 20)).astype(np.float32)
+    h5_path = str(tmp_path / "data.h5")
+    with h5py.File(h5_path, "w") as f:
+        f.create_dataset("series/data", data=data, chunks=(100, 20))
+
+    reference = snub.io.hdf5.dataset_reference(h5_path, "/series/data", True)
+    props = snub.io.project.add_heatmap(
+        project_directory, "linked heatmap", reference, start_time=0, binsize=1
+    )
+    assert props["data_path"] == reference
+    assert not os.path.exists(
+        os.path.join(project_directory, "linked heatmap.heatmap_data.npy")
+    )
+    assert props["vmin"] == data.min() and props["vmax"] == data.max()
+
+    dataset = snub.io.hdf5.LazyDataset(reference, block_size=0.001)
+    assert dataset.shape == (20, 1000) and len(dataset.slices) == 10
+    assert np.array_equal(snub.io.hdf5.read_dataset(reference), data.T)
+
+    props = snub.io.project.add_heatmap(
+        project_directory, "copied heatmap", dataset, start_time=0, binsize=1
+    )
+    saved_data = np.load(os.path.join(project_directory, props["data_path"]))
+    assert np.array_equal(saved_data, data.T)
+
+
+def test_add_pose3D(project_directory):
+    """Test snub.io.project.add_pose3D with multiple animals"""
+
+    data = np.random.uniform(size=(100, 3, 4, 3))
+    props = snub.io.project.add_pose3D(
+        project_directory,
+        "pose",
+        data,
+        links=[[0, 1], [1, 2], [2, 3]],
+        start_time=0,
+        binsize=1 / 30,
+        animal_labels=["a", "b", "c"],
+        animal_colors=[[255, 0, 0], [0, 255, 0], [0, 0, 255]],
+    )
+    labels_path = os.path.join(project_directory, props["animal_labels_path"])
+    colors_path = os.path.join(project_directory, props["animal_colors_path"])
+    assert open(labels_path).read().split("\n") == ["a", "b", "c"]
+    assert np.array_equal(np.load(colors_path), np.eye(3))
+
+
+def test_add_annotator(project_directory):
+    """Test that annotator edits are logged and compacted into a snapshot"""
+
+    props = snub.io.project.add_annotator(
+        project_directory, "annotations", annotations={"a": [[0, 1]], "b": []}
+    )
+    path = os.path.join(project_directory, props["data_path"])
+    store = snub.io.annotations.AnnotationStore(path)
+    store.append(1, 1, 2, 3)
+    store.append(1, 0, 0.5, 4)
+    store.append(-1, 0, 2, 2.5)
+    store.flush()
+    assert len(snub.io.annotations.read_annotation_log(path)) == 3
+
+    annotations = snub.io.annotations.load_annotations(path)
+    assert np.array_equal(annotations["a"], [[0, 2], [2.5, 4]])
+    assert np.array_equal(annotations["b"], [[2, 3]])
+
+    store.compact(annotations)
+    store.flush()
+    assert len(snub.io.annotations.read_annotation_log(path)) == 0
+    snub.io.project.modify_annotator_label(project_directory, "annotations", "c", "b")
+    annotations = snub.io.annotations.load_annotations(path)
+    assert sorted(annotations) == ["a", "c"]
+    assert np.array_equal(annotations["c"], [[2, 3]])
+
+
+def test_nwb_step_traces():
+    """Test that the vectorized NWB interval/event traces match a loop over the
+    intervals/events"""
+
+    eps = snub.io.nwb.EPS
+
+    def interval_trace_loop(starts, ends, start_time, end_time):
+        trace = [[start_time, 0]]
+        for start, end in zip(starts, ends):
+            trace += [[start - eps, 0], [start, 1], [end - eps, 1], [end, 0]]
+        return np.array(trace + [[end_time, 0]])
+
+    def event_trace_loop(timestamps, start_time, end_time):
+        trace = [[start_time, 0]]
+        for t in timestamps:
+            trace += [[t - eps, 0], [t, 1], [t + eps, 0]]
+        return np.array(trace + [[end_time, 0]])
+
+    starts = np.sort(np.random.uniform(0, 100, 50))
+    ends = starts + np.random.uniform(0, 1, 50)
+    for s, e in [(starts, ends), (starts, ends[:30]), (starts[:20], ends), ([], [])]:
+        assert np.array_equal(
+            snub.io.nwb._interval_trace(s, e, -1, 101),
+            interval_trace_loop(s, e, -1, 101),
+        )
+    for timestamps in [starts, []]:
+        assert np.array_equal(
+            snub.io.nwb._event_trace(timestamps, -1, 101),
+            event_trace_loop(timestamps, -1, 101),
+        )
+
+
+def test_add_ephys_units(project_directory, tmp_path):
+    """Test that spikes streamed from an NWB units table match the spike times
+    and unit labels of the table's dataframe (including units with no spikes)"""
+    from datetime import datetime, timezone
+    import pynwb
+
+    nwbfile = pynwb.NWBFile("units", "units", datetime.now(timezone.utc))
+    for n in [5, 0, 3, 0, 8]:
+        nwbfile.add_unit(spike_times=np.sort(np.random.uniform(0, 10, n)))
+    nwb_path = str(tmp_path / "units.nwb")
+    with pynwb.NWBHDF5IO(nwb_path, "w") as io:
+        io.write(nwbfile)
+
+    with pynwb.NWBHDF5IO(nwb_path, "r") as io:
+        units = io.read().units
+        snub.io.nwb.add_ephys_units(project_directory, units, "units", 0, 10, {})
+        spike_times_per_unit = units.to_dataframe()["spike_times"]
+
+    spike_times = np.hstack(spike_times_per_unit)
+    spike_labels = np.hstack(
+        [np.ones(len(spikes)) * i for i, spikes in enumerate(spike_times_per_unit)]
+    )
+    spike_data = np.load(os.path.join(project_directory, "units.spikeplot_spikes.npy"))
+    assert np.array_equal(spike_data, np.vstack([spike_times, spike_labels]).T)